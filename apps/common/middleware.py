@@ -0,0 +1,106 @@
+import json
+import logging
+import random
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from apps.common.timing import RequestTimer, activate, install
+
+logger = logging.getLogger(__name__)
+
+# Spans reported in the Server-Timing header, in order, with their descriptions
+SPANS = {
+    'db': 'Database',
+    'chart': 'Chart rendering',
+    'template': 'Template rendering',
+}
+
+
+class ServerTimingMiddleware:
+    """
+    Time a sample of requests and report where the time went.
+
+    Sampled requests get a ``Server-Timing`` header with the database time
+    and query count, chart rendering, template rendering and total time,
+    and the same figures are logged as one JSON line. Requests outside the
+    sample (``SERVER_TIMING_SAMPLE_RATE``) pay for a single random() call.
+    Keep this first in MIDDLEWARE so the total covers the other middleware.
+    Queries are timed by one execute wrapper on every connection, which adds
+    them to the timer of the request running them (a context variable, so
+    it follows the request into sync_to_async threads under ASGI).
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'SERVER_TIMING_SAMPLE_RATE', 1.0)
+        if self.sample_rate > 0:
+            connection_created.connect(install, dispatch_uid='server_timing')
+            for connection in connections.all():
+                install(connection=connection)
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.sampled():
+            return self.get_response(request)
+
+        timer = RequestTimer()
+        request.timer = timer
+        with activate(timer):
+            response = self.get_response(request)
+        return self.report(request, response, timer)
+
+    async def __acall__(self, request):
+        if not self.sampled():
+            return await self.get_response(request)
+
+        timer = RequestTimer()
+        request.timer = timer
+        with activate(timer):
+            response = await self.get_response(request)
+        return self.report(request, response, timer)
+
+    def sampled(self):
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def report(self, request, response, timer):
+        total = timer.elapsed()
+        response['Server-Timing'] = self.header(timer, total)
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'total_ms': round(total * 1000, 2),
+            'queries': timer.counts['db'],
+            **{f'{name}_ms': round(timer.durations[name] * 1000, 2) for name in SPANS},
+        }))
+        return response
+
+    def process_template_response(self, request, response):
+        timer = getattr(request, 'timer', None)
+        if timer is not None:
+            # Rendering happens right after the template response middleware
+            started = time.perf_counter()
+            response.add_post_render_callback(
+                lambda rendered: timer.add('template', time.perf_counter() - started)
+            )
+        return response
+
+    @staticmethod
+    def header(timer, total):
+        metrics = []
+        for name, description in SPANS.items():
+            if name in timer.counts:
+                if name == 'db':
+                    description = f"{description} ({timer.counts['db']} queries)"
+                metrics.append(f'{name};dur={timer.durations[name] * 1000:.1f};desc="{description}"')
+        metrics.append(f'total;dur={total * 1000:.1f}')
+        return ', '.join(metrics)
@@ -0,0 +1,45 @@
+import json
+
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+
+def estimate_count(queryset):
+    """
+    Return the query planner's estimate of the rows in ``queryset``, or
+    None where the database does not offer one cheaply (only PostgreSQL does).
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator for admin changelists over very large tables.
+
+    Rows are counted exactly while there are at most ``exact_limit`` of them,
+    with a COUNT over a LIMIT subquery that stops early. Past that the
+    planner's estimate is used, so a page load never scans the whole table
+    just to count it; without an estimate it falls back to an exact count.
+    """
+    exact_limit = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        bounded = queryset.order_by()[:self.exact_limit + 1].count()
+        if bounded <= self.exact_limit:
+            return bounded
+        estimate = estimate_count(queryset)
+        if estimate is None:
+            return queryset.count()
+        return max(estimate, bounded)
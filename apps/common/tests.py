@@ -1,3 +1,102 @@
-from django.test import TestCase
+import asyncio
+import json
+from datetime import datetime, timedelta, timezone as dt_timezone
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, iscoroutinefunction, sync_to_async
+from django.http import HttpResponse
+from django.test import AsyncRequestFactory, TestCase, override_settings
+from django.urls import reverse
+
+from apps.common.middleware import ServerTimingMiddleware
+from apps.common.timing import RequestTimer, activate, timed
+from apps.weather.models import City, WeatherData
+
+
+@override_settings(SERVER_TIMING_SAMPLE_RATE=1.0)
+class ServerTimingMiddlewareTests(TestCase):
+    def setUp(self):
+        self.city = City.objects.create(
+            name='London',
+            country='UK',
+            latitude=51.5074,
+            longitude=-0.1278
+        )
+        WeatherData.objects.bulk_create([
+            WeatherData(
+                city=self.city, temperature=20 + i, humidity=60, pressure=1013,
+                wind_speed=5, description='Cloudy',
+                recorded_at=datetime(2025, 1, 1, tzinfo=dt_timezone.utc) + timedelta(hours=i)
+            )
+            for i in range(3)
+        ])
+
+    def metrics(self, response):
+        return {
+            metric.split(';')[0]: metric for metric in response['Server-Timing'].split(', ')
+        }
+
+    def test_detail_page_reports_db_template_and_total(self):
+        with self.assertLogs('apps.common.middleware', 'INFO') as logs:
+            response = self.client.get(reverse('city_detail', args=[self.city.pk]))
+        metrics = self.metrics(response)
+        self.assertEqual(set(metrics), {'db', 'template', 'total'})
+        self.assertRegex(metrics['db'], r'^db;dur=[\d.]+;desc="Database \(\d+ queries\)"$')
+
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['path'], reverse('city_detail', args=[self.city.pk]))
+        self.assertEqual(record['status'], 200)
+        self.assertGreater(record['queries'], 0)
+        self.assertGreater(record['template_ms'], 0)
+        self.assertEqual(record['chart_ms'], 0)
+
+    def test_chart_rendering_is_reported(self):
+        with self.assertLogs('apps.common.middleware', 'INFO'):
+            response = self.client.get(reverse('city_chart', args=[self.city.pk]), follow=True)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertIn('chart', self.metrics(response))
+
+    @override_settings(SERVER_TIMING_SAMPLE_RATE=0)
+    def test_unsampled_requests_are_untouched(self):
+        response = self.client.get(reverse('city_list'))
+        self.assertNotIn('Server-Timing', response)
+
+    def test_async_requests_are_timed(self):
+        async def view(request):
+            await sync_to_async(list)(City.objects.all())
+            return HttpResponse('ok')
+
+        middleware = ServerTimingMiddleware(view)
+        self.assertTrue(iscoroutinefunction(middleware))
+        with self.assertLogs('apps.common.middleware', 'INFO'):
+            response = async_to_sync(middleware)(AsyncRequestFactory().get('/'))
+        self.assertRegex(self.metrics(response)['db'], r'\(1 queries\)')
+
+    def test_concurrent_async_requests_count_only_their_own_queries(self):
+        async def view(request):
+            for _ in range(int(request.GET['queries'])):
+                await sync_to_async(list)(City.objects.all())
+                await asyncio.sleep(0)
+            return HttpResponse('ok')
+
+        async def both():
+            middleware = ServerTimingMiddleware(view)
+            return await asyncio.gather(
+                middleware(AsyncRequestFactory().get('/', {'queries': 1})),
+                middleware(AsyncRequestFactory().get('/', {'queries': 3})),
+            )
+
+        with self.assertLogs('apps.common.middleware', 'INFO'):
+            one, three = async_to_sync(both)()
+        self.assertRegex(self.metrics(one)['db'], r'\(1 queries\)')
+        self.assertRegex(self.metrics(three)['db'], r'\(3 queries\)')
+
+    def test_timed_is_a_no_op_outside_a_timed_request(self):
+        with timed('chart'):
+            pass
+        timer = RequestTimer()
+        with activate(timer):
+            with timed('chart'):
+                pass
+            with timed('chart'):
+                pass
+        self.assertEqual(timer.counts['chart'], 2)
@@ -0,0 +1,77 @@
+"""
+Per-request timing spans, reported by ServerTimingMiddleware.
+
+Code that wants its cost broken out wraps the work in ``timed(name)``; it
+only measures anything while a sampled request is being timed, and is a
+context variable lookup otherwise.
+"""
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_current = ContextVar('request_timer', default=None)
+
+
+class RequestTimer:
+    """Accumulated durations (seconds) and counts of the spans of one request"""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.durations = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    def add(self, name, seconds):
+        self.durations[name] += seconds
+        self.counts[name] += 1
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+def execute_wrapper(execute, sql, params, many, context):
+    """
+    Database execute wrapper adding every query to the ``db`` span of the
+    request being timed in this context. Installed once per connection, so
+    concurrent requests sharing a connection each count only their own.
+    """
+    timer = _current.get()
+    if timer is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timer.add('db', time.perf_counter() - start)
+
+
+def install(sender=None, connection=None, **kwargs):
+    """Add execute_wrapper to a database connection once (a connection_created receiver)"""
+    if execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(execute_wrapper)
+
+
+def current_timer():
+    return _current.get()
+
+
+@contextmanager
+def activate(timer):
+    token = _current.set(timer)
+    try:
+        yield timer
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def timed(name):
+    """Add the time spent in the block (or decorated function) to span ``name``"""
+    timer = _current.get()
+    if timer is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - start)
@@ -1,20 +1,182 @@
+from datetime import datetime, timezone as dt_timezone
+
 from django.contrib import admin
-from .models import City, WeatherData
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.db.models import Max, Q
+
+from apps.common.paginator import EstimatedCountPaginator
+from .exports import EXPORT_FIELDS, export_response
+from .models import City, CityStats, DailyWeather, HourlyWeather, MonthlyWeather, WeatherData
+from .search import city_prefix_index
+
+# Admin exports span cities, so they name the city on every row
+ADMIN_EXPORT_FIELDS = ('city__name',) + EXPORT_FIELDS
+
+
+class CityPrefixSearchMixin:
+    """
+    Answer the changelist search from the city prefix index instead of
+    LIKE scans: rows match when a word of their city's name or country
+    starts with the search term.
+    """
+    city_lookup = 'pk'
+    # Other text fields matched by prefix as well, as ``field__istartswith``
+    prefix_search_fields = ()
+
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term.strip():
+            return queryset, False
+        ids = city_prefix_index().city_ids(search_term)
+        condition = Q(**{f'{self.city_lookup}__in': ids})
+        for field in self.prefix_search_fields:
+            condition |= Q(**{f'{field}__istartswith': search_term.strip()})
+        return queryset.filter(condition), False
+
+
+class CityAutocompleteFilter(admin.SimpleListFilter):
+    """
+    City filter that looks cities up as you type (from /cities/suggest)
+    instead of rendering every city into a dropdown.
+    """
+    title = 'city'
+    parameter_name = 'city__id__exact'
+    template = 'admin/weather/city_autocomplete_filter.html'
+
+    def lookups(self, request, model_admin):
+        # Only the selected city is rendered; the rest are fetched on demand
+        value = self.value()
+        if value and value.isdigit():
+            city = City.objects.filter(pk=value).values_list('pk', 'name', 'country').first()
+            if city is not None:
+                return [(str(city[0]), f'{city[1]}, {city[2]}')]
+        return []
+
+    def has_output(self):
+        return True
+
+    def queryset(self, request, queryset):
+        value = self.value()
+        if not value:
+            return queryset
+        if not value.isdigit():
+            raise IncorrectLookupParameters(f'Invalid city id {value!r}')
+        return queryset.filter(city_id=value)
+
+
+class MonthBucketFilter(admin.SimpleListFilter):
+    """
+    Month filter listing the months that have readings, read from the
+    MonthlyWeather rollup instead of a DISTINCT scan over every reading.
+    """
+    title = 'month'
+    parameter_name = 'month'
+
+    def lookups(self, request, model_admin):
+        rollups = MonthlyWeather.objects.order_by()
+        stats = CityStats.objects.order_by()
+        city = request.GET.get(CityAutocompleteFilter.parameter_name, '')
+        if city.isdigit():
+            rollups = rollups.filter(city_id=city)
+            stats = stats.filter(city_id=city)
+        months = set(rollups.values_list('bucket_start', flat=True).distinct())
+        # Readings newer than the last rollup build still count
+        latest = stats.aggregate(latest=Max('last_recorded_at'))['latest']
+        if latest is not None:
+            months.add(latest)
+        months = {self._month_start(month) for month in months}
+        return [(month.strftime('%Y-%m'), month.strftime('%B %Y')) for month in sorted(months, reverse=True)]
+
+    def queryset(self, request, queryset):
+        value = self.value()
+        if not value:
+            return queryset
+        try:
+            start = datetime.strptime(value, '%Y-%m').replace(tzinfo=dt_timezone.utc)
+        except ValueError:
+            raise IncorrectLookupParameters(f'Invalid month {value!r}')
+        end = start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+        return queryset.filter(recorded_at__gte=start, recorded_at__lt=end)
+
+    @staticmethod
+    def _month_start(value):
+        return value.astimezone(dt_timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
 
 
 @admin.register(City)
-class CityAdmin(admin.ModelAdmin):
+class CityAdmin(CityPrefixSearchMixin, admin.ModelAdmin):
     """Admin interface for City model"""
     list_display = ('name', 'country', 'latitude', 'longitude')
     search_fields = ('name', 'country')
     list_filter = ('country',)
+    # Matches city_name_idx, so the admin does not add a -pk sort of its own
+    ordering = ('name', 'id')
 
 
 @admin.register(WeatherData)
-class WeatherDataAdmin(admin.ModelAdmin):
-    """Admin interface for WeatherData model"""
-    list_display = ('city', 'temperature', 'humidity', 'pressure', 
-                   'wind_speed', 'description', 'recorded_at')
+class WeatherDataAdmin(CityPrefixSearchMixin, admin.ModelAdmin):
+    """
+    Admin interface for WeatherData model.
+
+    Built for tables of tens of millions of rows: counts are estimated past
+    a few thousand rows, cities are picked by autocomplete, months come from
+    the rollups, and searches match city names through the prefix index.
+    """
+    list_display = ('city', 'temperature', 'humidity', 'pressure',
+                    'wind_speed', 'description', 'recorded_at')
+    list_select_related = ('city',)
     search_fields = ('city__name', 'description')
-    list_filter = ('city', 'recorded_at')
-    date_hierarchy = 'recorded_at'
+    search_help_text = 'City or country name, or the start of a description'
+    city_lookup = 'city_id'
+    prefix_search_fields = ('description',)
+    list_filter = (CityAutocompleteFilter, MonthBucketFilter, 'recorded_at')
+    paginator = EstimatedCountPaginator
+    # Otherwise every page load also counts the whole table
+    show_full_result_count = False
+    actions = ['export_as_csv', 'export_as_ndjson']
+
+    @admin.action(description='Export selected weather data as CSV')
+    def export_as_csv(self, request, queryset):
+        return export_response(queryset, 'csv', 'weather-data', fields=ADMIN_EXPORT_FIELDS)
+
+    @admin.action(description='Export selected weather data as NDJSON')
+    def export_as_ndjson(self, request, queryset):
+        return export_response(queryset, 'ndjson', 'weather-data', fields=ADMIN_EXPORT_FIELDS)
+
+
+@admin.register(CityStats)
+class CityStatsAdmin(CityPrefixSearchMixin, admin.ModelAdmin):
+    """Read-only admin interface for the CityStats rollup"""
+    list_display = ('city', 'reading_count', 'avg_temp', 'avg_humidity',
+                    'avg_wind_speed', 'last_recorded_at')
+    list_select_related = ('city',)
+    search_fields = ('city__name',)
+    city_lookup = 'city_id'
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(HourlyWeather, DailyWeather, MonthlyWeather)
+class WeatherRollupAdmin(admin.ModelAdmin):
+    """Read-only admin interface for the downsampled weather rollups"""
+    list_display = ('city', 'bucket_start', 'reading_count', 'temperature_mean',
+                    'humidity_mean', 'pressure_mean', 'wind_speed_mean')
+    list_select_related = ('city',)
+    list_filter = (CityAutocompleteFilter,)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
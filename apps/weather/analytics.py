@@ -0,0 +1,260 @@
+"""
+Rolling statistics and anomaly detection over one city's readings.
+
+A city's recent series is read with a single ``values_list`` query (see
+series.load_columns) into NumPy arrays, and everything is computed on the
+whole arrays at once:
+
+* rolling means and standard deviations over a trailing time window, from
+  cumulative sums and a ``searchsorted`` of the window starts, so irregular
+  sampling and gaps are handled without a loop;
+* daily (UTC) minimum and maximum with ``reduceat`` over the day
+  boundaries;
+* anomaly flags, either as the z-score of each reading against the window
+  before it, or against an exponentially weighted mean and variance. The
+  EWMA recursion is evaluated in blocks in closed form, so only the blocks,
+  not the readings, are looped over.
+
+The summary is cached under the city's version token (see caching.py), so
+it is computed again only after the city's readings change.
+"""
+from datetime import timedelta
+
+import numpy as np
+from django.core.cache import cache
+from django.utils import timezone
+
+from apps.weather.caching import city_version
+from apps.weather.managers import METRICS
+from apps.weather.pagination import EPOCH
+from apps.weather.series import load_columns
+
+# Keys carry the city's version, so this only bounds how long unused ones linger
+ANALYTICS_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+DAY_SECONDS = 24 * 60 * 60
+DEFAULT_SPAN = timedelta(days=90)
+DEFAULT_WINDOW = timedelta(days=1)
+DEFAULT_THRESHOLD = 3.0
+DEFAULT_ALPHA = 0.1
+# Readings a window must hold before its spread is trusted
+MIN_PERIODS = 6
+METHODS = ('zscore', 'ewma')
+MAX_ANOMALIES = 50
+# How the detail page names each metric and its unit
+METRIC_LABELS = {
+    'temperature': ('Temperature', '°C'),
+    'humidity': ('Humidity', '%'),
+    'pressure': ('Pressure', ' hPa'),
+    'wind_speed': ('Wind speed', ' m/s'),
+}
+
+
+def rolling_stats(timestamps, values, window, closed='right'):
+    """
+    Mean, standard deviation and count of ``values`` over the trailing
+    ``window`` seconds of each reading.
+
+    With ``closed='right'`` the window is (t - window, t] and includes the
+    reading itself; with ``'left'`` it is [t - window, t) and holds only the
+    readings before it, as used to judge whether the reading is unusual.
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    # Centring first keeps the sum of squares from cancelling catastrophically
+    centred = values - (values.mean() if len(values) else 0.0)
+    sums = np.concatenate(([0.0], np.cumsum(centred)))
+    squares = np.concatenate(([0.0], np.cumsum(centred * centred)))
+
+    index = np.arange(len(values))
+    if closed == 'right':
+        lo = np.searchsorted(timestamps, timestamps - window, side='right')
+        hi = index + 1
+    else:
+        lo = np.searchsorted(timestamps, timestamps - window, side='left')
+        hi = index
+    counts = hi - lo
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = (sums[hi] - sums[lo]) / counts
+        variances = (squares[hi] - squares[lo]) / counts - means * means
+        # Sample (n - 1) variance, like pandas' rolling std
+        variances = np.maximum(variances, 0) * counts / (counts - 1)
+    means = np.where(counts > 0, means + (values.mean() if len(values) else 0.0), np.nan)
+    stds = np.where(counts > 1, np.sqrt(variances), np.nan)
+    return means, stds, counts
+
+
+def daily_extremes(timestamps, values):
+    """Return ``(days, minimums, maximums)``: each UTC day's start (epoch seconds) and range"""
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    if not len(values):
+        return np.empty(0, dtype=np.int64), np.empty(0), np.empty(0)
+    days = timestamps // DAY_SECONDS
+    starts = np.flatnonzero(np.concatenate(([True], days[1:] != days[:-1])))
+    return (
+        days[starts] * DAY_SECONDS,
+        np.minimum.reduceat(values, starts),
+        np.maximum.reduceat(values, starts),
+    )
+
+
+def ewma(values, alpha, block=256):
+    """
+    Exponentially weighted mean of ``values``, ``m[i] = a * x[i] + (1 - a) * m[i - 1]``
+    with ``m[0] = x[0]``.
+
+    Within a block the recursion is a weighted cumulative sum; the powers of
+    ``1 - a`` it needs stay finite because blocks are short.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    result = np.empty_like(values)
+    if not len(values):
+        return result
+    decay = 1.0 - alpha
+    # Keep decay ** -block finite
+    if decay > 0:
+        block = max(1, min(block, int(600 / max(-np.log(decay), 1e-12))))
+    previous = values[0]
+    for start in range(0, len(values), block):
+        chunk = values[start:start + block]
+        steps = np.arange(1, len(chunk) + 1)
+        if decay == 0:
+            result[start:start + len(chunk)] = chunk
+        else:
+            powers = decay ** steps
+            inputs = alpha * chunk / powers
+            if start == 0:
+                # m[0] = x[0], so the first input carries no decay
+                inputs[0] = chunk[0] / decay
+                previous = 0.0
+            result[start:start + len(chunk)] = powers * (previous + np.cumsum(inputs))
+        previous = result[start + len(chunk) - 1]
+    return result
+
+
+def zscore_flags(timestamps, values, window):
+    """
+    Score each reading against the readings of the ``window`` seconds before
+    it. Returns ``(scores, expected)``; scores are NaN where the window holds
+    fewer than MIN_PERIODS readings or has no spread.
+    """
+    means, stds, counts = rolling_stats(timestamps, values, window, closed='left')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scores = (np.asarray(values, dtype=np.float64) - means) / stds
+    scores[(counts < MIN_PERIODS) | ~(stds > 0)] = np.nan
+    return scores, means
+
+
+def ewma_flags(values, alpha=DEFAULT_ALPHA):
+    """
+    Score each reading against the exponentially weighted mean and variance
+    of the readings before it. Returns ``(scores, expected)`` like
+    zscore_flags().
+    """
+    values = np.asarray(values, dtype=np.float64)
+    scores = np.full(len(values), np.nan)
+    expected = np.full(len(values), np.nan)
+    if len(values) < 2:
+        return scores, expected
+    means = ewma(values, alpha)
+    # The forecast for a reading is the mean up to the one before it
+    expected[1:] = means[:-1]
+    squares = ewma((values - np.concatenate(([values[0]], means[:-1]))) ** 2, alpha)
+    stds = np.sqrt(squares)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scores[1:] = (values[1:] - expected[1:]) / stds[:-1]
+    scores[:MIN_PERIODS] = np.nan
+    scores[1:][~(stds[:-1] > 0)] = np.nan
+    return scores, expected
+
+
+def analyse(timestamps, values, window=DEFAULT_WINDOW, method='zscore',
+            threshold=DEFAULT_THRESHOLD, alpha=DEFAULT_ALPHA):
+    """
+    Run the whole analysis over one city's series.
+
+    ``values`` maps metrics to float arrays aligned with ``timestamps``
+    (epoch seconds, oldest first). Returns a JSON-ready dict with the daily
+    extremes, the rolling statistics of the newest reading and up to
+    MAX_ANOMALIES unusual readings, newest first.
+    """
+    if method not in METHODS:
+        raise ValueError(f"'method' must be one of {', '.join(METHODS)}")
+    seconds = int(window.total_seconds())
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    summary = {'readings': len(timestamps), 'daily': {}, 'latest': {}, 'anomalies': []}
+    anomalies = []
+    for metric, column in values.items():
+        days, minimums, maximums = daily_extremes(timestamps, column)
+        summary['daily'][metric] = {
+            'days': days.tolist(),
+            'min': minimums.round(2).tolist(),
+            'max': maximums.round(2).tolist(),
+        }
+        if not len(column):
+            continue
+        means, stds, _ = rolling_stats(timestamps, column, seconds)
+        summary['latest'][metric] = {
+            'mean': round(float(means[-1]), 2),
+            'std': None if np.isnan(stds[-1]) else round(float(stds[-1]), 2),
+        }
+        if method == 'zscore':
+            scores, expected = zscore_flags(timestamps, column, seconds)
+        else:
+            scores, expected = ewma_flags(column, alpha)
+        flagged = np.flatnonzero(np.abs(np.nan_to_num(scores)) > threshold)
+        anomalies.extend(
+            (int(timestamps[i]), metric, float(column[i]), float(expected[i]), float(scores[i]))
+            for i in flagged
+        )
+    anomalies.sort(key=lambda anomaly: anomaly[0], reverse=True)
+    summary['anomaly_count'] = len(anomalies)
+    summary['anomalies'] = [
+        {
+            'timestamp': timestamp,
+            'metric': metric,
+            'value': round(value, 2),
+            'expected': round(expected, 2),
+            'score': round(score, 2),
+        }
+        for timestamp, metric, value, expected, score in anomalies[:MAX_ANOMALIES]
+    ]
+    return summary
+
+
+def city_analytics(city, span=DEFAULT_SPAN, window=DEFAULT_WINDOW, method='zscore',
+                   threshold=DEFAULT_THRESHOLD, alpha=DEFAULT_ALPHA, metrics=METRICS):
+    """
+    Return analyse() over the ``span`` before a city's newest reading,
+    cached until the city's readings change.
+    """
+    stats = getattr(city, 'weather_stats', None)
+    last = stats.last_recorded_at if stats is not None else None
+    if last is None:
+        return analyse(np.empty(0, dtype=np.int64), {metric: np.empty(0) for metric in metrics},
+                       window, method, threshold, alpha)
+
+    key = (
+        f'weather:analytics:{city.pk}:{city_version(city.pk)}:{int(span.total_seconds())}:'
+        f'{int(window.total_seconds())}:{method}:{threshold}:{alpha}:{",".join(metrics)}'
+    )
+    summary = cache.get(key)
+    if summary is None:
+        end = last + timedelta(seconds=1)
+        timestamps, values = load_columns([city.pk], end - span, end, metrics)[city.pk]
+        summary = analyse(timestamps, values, window, method, threshold, alpha)
+        cache.set(key, summary, ANALYTICS_CACHE_TIMEOUT)
+    return summary
+
+
+def unusual_readings(summary, limit=10):
+    """The newest anomalies of a summary, with local datetimes and labels for the templates"""
+    return [
+        {
+            **anomaly,
+            'recorded_at': timezone.localtime(EPOCH + timedelta(seconds=anomaly['timestamp'])),
+            'label': METRIC_LABELS[anomaly['metric']][0],
+            'unit': METRIC_LABELS[anomaly['metric']][1],
+        }
+        for anomaly in summary['anomalies'][:limit]
+    ]
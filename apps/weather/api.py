@@ -0,0 +1,464 @@
+import hmac
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.core.exceptions import RequestDataTooBig
+from django.http import Http404, HttpResponse, JsonResponse
+from django.middleware.csrf import CsrfViewMiddleware
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.decorators import method_decorator
+from django.utils.text import slugify
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+
+from .analytics import DEFAULT_SPAN, DEFAULT_THRESHOLD, DEFAULT_WINDOW, METHODS, city_analytics
+from .caching import city_page_validators, conditional_page
+from .compare import (
+    DEFAULT_MAX_POINTS as DEFAULT_COMPARE_POINTS, compare_chart, compare_cities, default_range,
+)
+from .exports import CONTENT_TYPES, export_response
+from .live import Batch, body_lines, live_writer
+from .managers import METRICS
+from .models import City
+from .rollups import HOUR, RAW, load_columns as load_rollup_columns, pick_resolution
+from .search import DEFAULT_SUGGESTIONS, city_prefix_index
+from .series import latest_range, load_arrays, load_columns, lttb
+from .spatial import city_index
+
+DEFAULT_SERIES_SPAN = timedelta(days=30)
+DEFAULT_MAX_POINTS = 1000
+# Raw readings one series response is downsampled from; longer ranges use rollups
+MAX_SERIES_ROWS = 250000
+MAX_POINTS_LIMIT = 10000
+MAX_COLUMN_CITIES = 100
+DEFAULT_COLUMN_SPAN = timedelta(days=7)
+# Rows one columns response may hold; narrower ranges or fewer cities beyond it
+MAX_COLUMN_ROWS = 250000
+DEFAULT_NEARBY = 10
+MAX_NEARBY = 100
+DEFAULT_BOX_LIMIT = 100
+MAX_BOX_LIMIT = 1000
+MAX_SUGGESTIONS = 50
+MAX_LIVE_READINGS = 50000
+MAX_ANALYTICS_DAYS = 366
+MAX_COMPARE_CITIES = 20
+
+
+class BadRequest(ValueError):
+    """Raised for invalid query parameters, answered with a 400"""
+
+
+def parse_time(value, name):
+    """Parse an ISO date or datetime query parameter into an aware datetime"""
+    if not value:
+        return None
+    parsed = parse_datetime(value)
+    if parsed is None:
+        day = parse_date(value)
+        if day is None:
+            raise BadRequest(f"'{name}' must be an ISO date or datetime")
+        parsed = datetime.combine(day, time.min)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def parse_int(value, name, default, minimum, maximum):
+    if value in (None, ''):
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        raise BadRequest(f"'{name}' must be an integer")
+    if not minimum <= number <= maximum:
+        raise BadRequest(f"'{name}' must be between {minimum} and {maximum}")
+    return number
+
+
+class CitySeriesView(View):
+    """
+    A city's readings as JSON, downsampled with LTTB for client-side charts.
+
+    Query parameters: ``from`` and ``to`` (ISO dates or datetimes, defaulting
+    to the last 30 days of data), ``metric`` and ``max_points``. A range
+    holding more than MAX_SERIES_ROWS readings is read from the rollup that
+    fits ``max_points`` instead (see rollups.pick_resolution).
+    """
+    def get(self, request, pk):
+        city = get_object_or_404(City.objects.select_related('weather_stats'), pk=pk)
+        try:
+            metric = request.GET.get('metric', 'temperature')
+            if metric not in METRICS:
+                raise BadRequest(f"'metric' must be one of {', '.join(METRICS)}")
+            max_points = parse_int(
+                request.GET.get('max_points'), 'max_points', DEFAULT_MAX_POINTS, 3, MAX_POINTS_LIMIT
+            )
+            start = parse_time(request.GET.get('from'), 'from')
+            end = parse_time(request.GET.get('to'), 'to')
+        except BadRequest as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        if end is None:
+            stats = getattr(city, 'weather_stats', None)
+            last = stats.last_recorded_at if stats is not None else None
+            end = (last or timezone.now()) + timedelta(seconds=1)
+        if start is None:
+            start = end - DEFAULT_SERIES_SPAN
+        if start >= end:
+            return JsonResponse({'error': "'from' must be before 'to'"}, status=400)
+
+        # One row past the cap tells a full read from a truncated one
+        resolution = RAW
+        timestamps, values = load_arrays(city.pk, start, end, (metric,), limit=MAX_SERIES_ROWS + 1)
+        values = values[metric]
+        if len(timestamps) > MAX_SERIES_ROWS:
+            resolution = pick_resolution(start, end, max_points)
+            if resolution is RAW:
+                resolution = HOUR
+            field = f'{metric}_mean'
+            timestamps, values = load_rollup_columns(resolution, [city.pk], start, end, (field,))[city.pk]
+            values = values[field]
+        keep = lttb(timestamps, values, max_points)
+        return JsonResponse({
+            'city': city.pk,
+            'metric': metric,
+            'from': start.isoformat(),
+            'to': end.isoformat(),
+            'resolution': resolution.name,
+            'total_points': len(timestamps),
+            'timestamps': timestamps[keep].tolist(),
+            'values': values[keep].round(2).tolist(),
+        })
+
+
+def parse_float(value, name, minimum, maximum):
+    if value in (None, ''):
+        raise BadRequest(f"'{name}' is required")
+    try:
+        number = float(value)
+    except ValueError:
+        raise BadRequest(f"'{name}' must be a number")
+    if not minimum <= number <= maximum:
+        raise BadRequest(f"'{name}' must be between {minimum} and {maximum}")
+    return number
+
+
+def parse_list(value, name, choices=None):
+    """Parse a comma-separated query parameter, optionally limited to ``choices``"""
+    items = [item.strip() for item in (value or '').split(',') if item.strip()]
+    if choices is not None:
+        unknown = [item for item in items if item not in choices]
+        if unknown:
+            raise BadRequest(f"'{name}' must be a subset of {', '.join(choices)}")
+    return items
+
+
+class WeatherColumnsView(View):
+    """
+    Several cities' raw readings as column-oriented JSON.
+
+    Each city gets a ``timestamps`` array of epoch seconds and one array of
+    numbers per field, so a reading's field names are not repeated on every
+    row; all rows come from a single ``values_list`` query. Query
+    parameters: ``cities`` (comma-separated ids, required), ``fields``
+    (defaults to all metrics), and ``from`` and ``to`` (ISO dates or
+    datetimes, defaulting to the DEFAULT_COLUMN_SPAN before the newest
+    reading). A range holding more than MAX_COLUMN_ROWS readings is a 400;
+    CitySeriesView downsamples long ranges instead.
+    """
+    def get(self, request):
+        try:
+            try:
+                city_ids = [int(pk) for pk in parse_list(request.GET.get('cities'), 'cities')]
+            except ValueError:
+                raise BadRequest("'cities' must be comma-separated city ids")
+            city_ids = list(dict.fromkeys(city_ids))
+            if not 1 <= len(city_ids) <= MAX_COLUMN_CITIES:
+                raise BadRequest(f"'cities' must list between 1 and {MAX_COLUMN_CITIES} city ids")
+            fields = parse_list(request.GET.get('fields'), 'fields', METRICS) or list(METRICS)
+            start = parse_time(request.GET.get('from'), 'from')
+            end = parse_time(request.GET.get('to'), 'to')
+        except BadRequest as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        if end is None:
+            end = latest_range(city_ids, DEFAULT_COLUMN_SPAN)[1]
+        if start is None:
+            start = end - DEFAULT_COLUMN_SPAN
+        if start >= end:
+            return JsonResponse({'error': "'from' must be before 'to'"}, status=400)
+        # One row past the cap tells a full response from a truncated one
+        columns = load_columns(city_ids, start, end, fields, limit=MAX_COLUMN_ROWS + 1)
+        if sum(len(timestamps) for timestamps, _ in columns.values()) > MAX_COLUMN_ROWS:
+            return JsonResponse({
+                'error': f'The range holds more than {MAX_COLUMN_ROWS} readings; '
+                         f"narrow 'from' and 'to' or ask for fewer cities"
+            }, status=400)
+
+        cities = {}
+        for city_id, (timestamps, values) in columns.items():
+            cities[str(city_id)] = {
+                'timestamps': timestamps.tolist(),
+                **{field: values[field].round(2).tolist() for field in fields},
+            }
+        return JsonResponse({
+            'from': start.isoformat(),
+            'to': end.isoformat(),
+            'fields': fields,
+            'cities': cities,
+        })
+
+
+class CityNearbyView(View):
+    """
+    The cities nearest to a point, nearest first, from the spatial index.
+
+    Query parameters: ``lat``, ``lon`` and ``k`` (how many cities).
+    """
+    def get(self, request):
+        try:
+            latitude = parse_float(request.GET.get('lat'), 'lat', -90, 90)
+            longitude = parse_float(request.GET.get('lon'), 'lon', -180, 180)
+            k = parse_int(request.GET.get('k'), 'k', DEFAULT_NEARBY, 1, MAX_NEARBY)
+        except BadRequest as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        return JsonResponse({
+            'lat': latitude,
+            'lon': longitude,
+            'cities': city_index().nearest(latitude, longitude, k),
+        })
+
+
+class CityBoxView(View):
+    """
+    The cities inside a latitude/longitude box, from the spatial index.
+
+    Query parameters: ``south``, ``west``, ``north``, ``east`` (a ``west``
+    greater than ``east`` crosses the antimeridian) and ``limit``.
+    """
+    def get(self, request):
+        try:
+            south = parse_float(request.GET.get('south'), 'south', -90, 90)
+            north = parse_float(request.GET.get('north'), 'north', south, 90)
+            west = parse_float(request.GET.get('west'), 'west', -180, 180)
+            east = parse_float(request.GET.get('east'), 'east', -180, 180)
+            limit = parse_int(request.GET.get('limit'), 'limit', DEFAULT_BOX_LIMIT, 1, MAX_BOX_LIMIT)
+        except BadRequest as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        index = city_index()
+        positions = index.within(south, west, north, east)
+        return JsonResponse({
+            'count': len(positions),
+            'cities': [index.city(position) for position in positions[:limit]],
+        })
+
+
+class CitySuggestView(View):
+    """
+    Autocomplete suggestions from the city prefix index.
+
+    Query parameters: ``q`` (matched against the start of every word of the
+    name and country, ignoring case and accents) and ``k``.
+    """
+    def get(self, request):
+        query = request.GET.get('q', '')
+        try:
+            k = parse_int(request.GET.get('k'), 'k', DEFAULT_SUGGESTIONS, 1, MAX_SUGGESTIONS)
+        except BadRequest as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        return JsonResponse({'q': query, 'cities': city_prefix_index().suggest(query, k)})
+
+
+@method_decorator(conditional_page(city_page_validators), name='dispatch')
+class CityExportView(View):
+    """
+    Stream all of a city's readings as CSV or NDJSON.
+
+    Query parameters: ``from`` and ``to`` (ISO dates or datetimes) and
+    ``gzip=1`` to compress the download on the fly.
+    """
+    def get(self, request, pk, fmt):
+        if fmt not in CONTENT_TYPES:
+            return JsonResponse({'error': f"Unknown export format '{fmt}'"}, status=404)
+        city = get_object_or_404(City, pk=pk)
+        try:
+            start = parse_time(request.GET.get('from'), 'from')
+            end = parse_time(request.GET.get('to'), 'to')
+        except BadRequest as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        queryset = city.weather_data.all()
+        if start is not None:
+            queryset = queryset.filter(recorded_at__gte=start)
+        if end is not None:
+            queryset = queryset.filter(recorded_at__lt=end)
+        compress = request.GET.get('gzip') in ('1', 'true')
+        return export_response(queryset, fmt, f'{slugify(city.name)}-weather', compress)
+
+
+@method_decorator(conditional_page(city_page_validators), name='dispatch')
+class CityAnalyticsView(View):
+    """
+    Rolling statistics, daily extremes and unusual readings of a city.
+
+    Query parameters: ``days`` (how far back from the newest reading),
+    ``window`` (hours in the rolling window), ``method`` (``zscore`` or
+    ``ewma``), ``threshold`` (the score a reading must exceed) and
+    ``metrics``.
+    """
+    def get(self, request, pk):
+        city = get_object_or_404(City.objects.select_related('weather_stats'), pk=pk)
+        try:
+            days = parse_int(request.GET.get('days'), 'days', DEFAULT_SPAN.days, 1, MAX_ANALYTICS_DAYS)
+            hours = parse_int(
+                request.GET.get('window'), 'window', int(DEFAULT_WINDOW.total_seconds() // 3600), 1, 24 * 90
+            )
+            method = request.GET.get('method', 'zscore')
+            if method not in METHODS:
+                raise BadRequest(f"'method' must be one of {', '.join(METHODS)}")
+            threshold = DEFAULT_THRESHOLD
+            if request.GET.get('threshold'):
+                threshold = parse_float(request.GET.get('threshold'), 'threshold', 0.5, 100)
+            metrics = tuple(parse_list(request.GET.get('metrics'), 'metrics', METRICS) or METRICS)
+        except BadRequest as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        summary = city_analytics(
+            city, span=timedelta(days=days), window=timedelta(hours=hours), method=method,
+            threshold=threshold, metrics=metrics,
+        )
+        return JsonResponse({'city': city.pk, 'method': method, 'threshold': threshold, **summary})
+
+
+def parse_compare(request):
+    """
+    Read the query of the comparison views: ``cities`` (comma-separated or
+    repeated ids), ``from``, ``to``, ``metric`` and ``max_points``.
+
+    Returns the keyword arguments of compare.compare_cities(). Raises
+    BadRequest, or Http404 for cities that do not exist.
+    """
+    try:
+        city_ids = [int(pk) for pk in parse_list(','.join(request.GET.getlist('cities')), 'cities')]
+    except ValueError:
+        raise BadRequest("'cities' must be comma-separated city ids")
+    city_ids = list(dict.fromkeys(city_ids))
+    if not 1 <= len(city_ids) <= MAX_COMPARE_CITIES:
+        raise BadRequest(f"'cities' must list between 1 and {MAX_COMPARE_CITIES} city ids")
+    metric = request.GET.get('metric', 'temperature')
+    if metric not in METRICS:
+        raise BadRequest(f"'metric' must be one of {', '.join(METRICS)}")
+    max_points = parse_int(
+        request.GET.get('max_points'), 'max_points', DEFAULT_COMPARE_POINTS, 3, MAX_POINTS_LIMIT
+    )
+    start = parse_time(request.GET.get('from'), 'from')
+    end = parse_time(request.GET.get('to'), 'to')
+
+    unknown = set(city_ids) - set(city_index().ids.tolist())
+    if unknown:
+        raise Http404(f'Unknown cities: {sorted(unknown)}')
+    if start is None or end is None:
+        default_start, default_end = default_range(city_ids)
+        if end is None:
+            end = default_end if start is None else start + (default_end - default_start)
+        if start is None:
+            start = end - (default_end - default_start)
+    if start >= end:
+        raise BadRequest("'from' must be before 'to'")
+    return {'city_ids': city_ids, 'start': start, 'end': end, 'metric': metric, 'max_points': max_points}
+
+
+class CompareSeriesView(View):
+    """
+    Several cities' series of one metric on a shared time grid, as JSON.
+
+    See parse_compare() for the query parameters.
+    """
+    def get(self, request):
+        try:
+            query = parse_compare(request)
+        except BadRequest as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        return JsonResponse(compare_cities(**query))
+
+
+class CompareChartView(View):
+    """One PNG chart of several cities' aligned series"""
+    def get(self, request):
+        try:
+            query = parse_compare(request)
+        except BadRequest as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        return HttpResponse(compare_chart(**query), content_type='image/png')
+
+
+def has_ingest_token(request):
+    """Whether the request carries one of the WEATHER_INGEST_TOKENS as a bearer token"""
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return False
+    return any(
+        hmac.compare_digest(token.strip().encode(), allowed.encode())
+        for allowed in getattr(settings, 'WEATHER_INGEST_TOKENS', [])
+    )
+
+
+def csrf_failure(request):
+    """Run the CSRF middleware's checks on a view marked csrf_exempt"""
+    middleware = CsrfViewMiddleware(lambda request: None)
+    middleware.process_request(request)
+    return middleware.process_view(request, None, (), {}) is not None
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class LiveReadingsView(View):
+    """
+    Accept a batch of live readings as NDJSON, one JSON object per line.
+
+    Each reading has ``recorded_at``, the four metrics, an optional
+    ``description``, and either ``city`` (its id) or the city's exact
+    ``latitude`` and ``longitude``. Readings already stored are skipped.
+    Callers authenticate with ``Authorization: Bearer <token>`` (one of
+    WEATHER_INGEST_TOKENS) or as a user allowed to add weather data.
+
+    Accepted readings are written shortly after the 202 response; a full
+    write queue is answered with 503 and Retry-After.
+    """
+    http_method_names = ['post']
+
+    def post(self, request):
+        if not has_ingest_token(request):
+            if not request.user.is_authenticated:
+                response = JsonResponse({'error': 'Authentication required'}, status=401)
+                response['WWW-Authenticate'] = 'Bearer'
+                return response
+            # Only token callers are exempt; a browser session is still
+            # checked, as the CSRF middleware would have done
+            if csrf_failure(request):
+                return JsonResponse({'error': 'CSRF verification failed'}, status=403)
+            if not request.user.has_perm('weather.add_weatherdata'):
+                return JsonResponse({'error': 'Not allowed to add weather data'}, status=403)
+
+        max_bytes = settings.DATA_UPLOAD_MAX_MEMORY_SIZE
+        try:
+            if max_bytes is not None and int(request.META.get('CONTENT_LENGTH') or 0) > max_bytes:
+                raise RequestDataTooBig(f'The body is larger than {max_bytes} bytes')
+            batch = Batch.parse(list(body_lines(request, max_bytes, MAX_LIVE_READINGS)))
+        except RequestDataTooBig as error:
+            return JsonResponse({'error': str(error)}, status=413)
+        if not len(batch):
+            return JsonResponse({'error': 'The body must hold NDJSON readings'}, status=400)
+
+        counts = live_writer().accept(batch)
+        if counts is None:
+            response = JsonResponse({'error': 'Too many readings waiting to be written'}, status=503)
+            response['Retry-After'] = '1'
+            return response
+        accepted, duplicates = counts
+        return JsonResponse({
+            'accepted': accepted,
+            'duplicates': duplicates,
+            'rejected': int((~batch.valid).sum()),
+            'errors': batch.errors,
+        }, status=202)
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class WeatherConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.weather'
+
+    def ready(self):
+        from apps.weather import receivers  # noqa: F401
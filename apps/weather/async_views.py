@@ -0,0 +1,255 @@
+"""
+Async versions of the city pages, for serving under ASGI (core/asgi.py).
+
+They are routed instead of the sync views when WEATHER_ASYNC_VIEWS is on.
+The independent queries of a page are started together with asyncio.gather
+and chart rendering runs in the chart process pool or a worker thread, so
+a slow chart never blocks the event loop. Django still runs the ORM calls
+of one request on a single thread, so gathered queries overlap with chart
+rendering and with other requests rather than with each other.
+"""
+import asyncio
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib import messages
+from django.core.handlers.asgi import ASGIRequest
+from django.db import DatabaseError
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.shortcuts import redirect, render
+from django.utils.cache import patch_cache_control
+from django.utils.decorators import method_decorator
+from django.views import View
+
+from .caching import (
+    cache_page_versioned, city_page_validators, city_page_version, city_version, conditional_page,
+    list_page_validators, list_page_version, list_version, page_timeout,
+)
+from .charts import (
+    CHART_MAX_AGE, CHART_RANGES, HISTORY_PAGE_SIZE, aget_chart_png, chart_url, chart_version,
+)
+from .analytics import city_analytics, unusual_readings
+from .api import BadRequest, parse_list
+from .models import City, CityStats, WeatherData
+from .pagination import EPOCH, MICROSECOND, KeysetPaginator, decode_cursor
+from .rollups import pick_resolution
+from .spatial import city_index
+from .streams import backend, hub, publishing, reading_event, streams_served
+from .views import city_stats, stats_aggregates
+
+MAX_STREAM_CITIES = 100
+# Readings sent to a reconnecting stream that missed them
+MAX_STREAM_REPLAY = 1000
+
+
+async def acity_stats(city):
+    """views.detail_stats(), aggregating with aaggregate if the rollup row is missing"""
+    try:
+        return city.weather_stats.as_dict()
+    except CityStats.DoesNotExist:
+        return await city.weather_data.aaggregate(**stats_aggregates())
+
+
+async def aunusual_readings(city):
+    """unusual_readings() of the cached city_analytics(), or none if they cannot be read"""
+    try:
+        return unusual_readings(await sync_to_async(city_analytics)(city))
+    except DatabaseError:
+        return []
+
+
+async def aget_city(pk):
+    city = await City.objects.select_related('weather_stats').filter(pk=pk).afirst()
+    if city is None:
+        raise Http404('No city found matching the query')
+    return city
+
+
+@method_decorator(conditional_page(list_page_validators), name='get')
+@method_decorator(cache_page_versioned(list_page_version), name='get')
+class AsyncCityListView(View):
+    """Async CityListView"""
+    template_name = 'weather/city_list.html'
+
+    async def get(self, request):
+        context = {'cache_version': list_version(), 'cache_timeout': page_timeout()}
+        try:
+            cities, extremes = await asyncio.gather(
+                self.cities(), CityStats.objects.aextremes()
+            )
+            for city in cities:
+                city.stats = city_stats(city)
+            cities_by_id = {city.id: city for city in cities}
+            context['cities'] = context['object_list'] = cities
+            context['weather_summary'] = {
+                label: cities_by_id.get(city_id) for label, city_id in extremes.items()
+            }
+        except DatabaseError as e:
+            await sync_to_async(messages.error)(
+                request, f"Database error while calculating statistics: {str(e)}"
+            )
+        return await sync_to_async(render)(request, self.template_name, context)
+
+    @staticmethod
+    async def cities():
+        return [city async for city in City.objects.select_related('weather_stats')]
+
+
+@method_decorator(conditional_page(city_page_validators), name='get')
+@method_decorator(cache_page_versioned(city_page_version), name='get')
+class AsyncCityDetailView(View):
+    """
+    Async CityDetailView.
+
+    The history page, the averages, the chart and the unusual readings are
+    fetched concurrently; the chart lands in the chart cache, so the image request that follows
+    the page is served without rendering.
+    """
+    template_name = 'weather/city_detail.html'
+
+    async def get(self, request, pk):
+        city = await aget_city(pk)
+        cursor = request.GET.get('cursor')
+        if decode_cursor(cursor) is None:
+            cursor = None
+        chart_range = request.GET.get('range')
+        stats_row = getattr(city, 'weather_stats', None)
+        if chart_range in CHART_RANGES and stats_row is not None and stats_row.last_recorded_at:
+            # Range charts do not follow the history page
+            chart_cursor = None
+        else:
+            chart_range, chart_cursor = None, cursor
+
+        context = {
+            'city': city,
+            'object': city,
+            'chart_ranges': list(CHART_RANGES),
+            'cache_version': city_version(city.pk),
+            'cache_timeout': page_timeout(),
+        }
+        try:
+            (
+                context['weather_data'], context['stats'], _, context['unusual_readings']
+            ) = await asyncio.gather(
+                KeysetPaginator(city.weather_data.all(), HISTORY_PAGE_SIZE).apage(cursor),
+                acity_stats(city),
+                aget_chart_png(city, chart_cursor, chart_range),
+                aunusual_readings(city),
+            )
+        except DatabaseError:
+            context['stats'] = city_stats(city)
+
+        if chart_range:
+            end = stats_row.last_recorded_at
+            context['chart_range'] = chart_range
+            context['chart_resolution'] = pick_resolution(end - CHART_RANGES[chart_range], end).name
+        context['temperature_chart'] = chart_url(city, cursor=chart_cursor, chart_range=chart_range)
+        context['live_updates'] = streams_served(request) and not cursor
+        return await sync_to_async(render)(request, self.template_name, context)
+
+
+# The view sets its own long-lived headers on versioned URLs
+@method_decorator(conditional_page(city_page_validators, cache_control=False), name='get')
+class AsyncCityChartView(View):
+    """Async CityChartView"""
+    async def get(self, request, pk):
+        city = await aget_city(pk)
+        chart_range = request.GET.get('range')
+        if chart_range not in CHART_RANGES:
+            chart_range = None
+        cursor = request.GET.get('cursor')
+        if decode_cursor(cursor) is None:
+            cursor = None
+
+        if request.GET.get('v') != chart_version(city):
+            return redirect(chart_url(city, cursor=cursor, chart_range=chart_range))
+
+        response = HttpResponse(
+            await aget_chart_png(city, cursor, chart_range), content_type='image/png'
+        )
+        patch_cache_control(response, public=True, max_age=CHART_MAX_AGE, immutable=True)
+        return response
+
+
+def stream_message(events):
+    """One SSE message; its id lets a reconnecting client resume after it"""
+    newest = max(event['micros'] for event in events)
+    return f'id: {newest}\nevent: readings\ndata: {json.dumps(events, separators=(",", ":"))}\n\n'
+
+
+class ReadingStreamView(View):
+    """
+    Server-Sent Events stream of the new readings of one or more cities.
+
+    Query parameter: ``cities`` (comma-separated ids). Each message is a
+    ``readings`` event whose data is a JSON array of readings; a client
+    reconnecting with ``Last-Event-ID`` first gets the readings recorded
+    after that one. Only served under ASGI, where an idle stream holds no
+    thread.
+    """
+    async def get(self, request):
+        if not publishing():
+            return JsonResponse({'error': 'Live updates are turned off'}, status=404)
+        if not isinstance(request, ASGIRequest):
+            return JsonResponse({'error': 'Streams are served by the ASGI application'}, status=501)
+        try:
+            try:
+                city_ids = [int(pk) for pk in parse_list(request.GET.get('cities'), 'cities')]
+            except ValueError:
+                raise BadRequest("'cities' must be comma-separated city ids")
+            city_ids = list(dict.fromkeys(city_ids))
+            if not 1 <= len(city_ids) <= MAX_STREAM_CITIES:
+                raise BadRequest(f"'cities' must list between 1 and {MAX_STREAM_CITIES} city ids")
+            since = request.headers.get('Last-Event-ID') or request.GET.get('last_event_id')
+            try:
+                since = int(since) if since else None
+            except ValueError:
+                raise BadRequest("'Last-Event-ID' must be an integer")
+        except BadRequest as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        index = await sync_to_async(city_index)()
+        unknown = set(city_ids) - set(index.ids.tolist())
+        if unknown:
+            return JsonResponse({'error': f'Unknown cities: {sorted(unknown)}'}, status=404)
+
+        # Subscribe before reading what was missed, so nothing falls between
+        subscription = hub().subscribe(city_ids)
+        await sync_to_async(backend().start)()
+        response = StreamingHttpResponse(
+            self.messages(subscription, since), content_type='text/event-stream'
+        )
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    @staticmethod
+    async def missed(city_ids, since):
+        rows = WeatherData.objects.filter(
+            city_id__in=city_ids, recorded_at__gt=EPOCH + since * MICROSECOND
+        ).order_by('-recorded_at', '-id').values_list(
+            'city_id', 'recorded_at', 'temperature', 'humidity', 'pressure', 'wind_speed',
+            'description', 'id',
+        )[:MAX_STREAM_REPLAY]
+        return [reading_event(*row) async for row in rows][::-1]
+
+    async def messages(self, subscription, since):
+        heartbeat = settings.WEATHER_STREAM_HEARTBEAT
+        try:
+            yield 'retry: 3000\n\n'
+            if since is not None:
+                missed = await self.missed(subscription.city_ids, since)
+                if missed:
+                    yield stream_message(missed)
+            while True:
+                try:
+                    events = await asyncio.wait_for(subscription.queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield ': keep-alive\n\n'
+                    continue
+                if events is None:
+                    return
+                yield stream_message(events)
+        finally:
+            hub().unsubscribe(subscription)
@@ -0,0 +1,113 @@
+"""
+Timing, query and memory measurements for the weather pages.
+
+Used by the ``bench_weather`` command. Each measurement runs the callable
+once under tracemalloc and CaptureQueriesContext for the query count and
+peak allocation, then ``repeat`` more times untraced for the wall time, so
+the tracing overhead does not leak into the timings.
+
+``load`` drives a running server over HTTP instead, for the
+``load_compare`` command.
+"""
+import statistics
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.cache import cache
+from django.db import connection, reset_queries
+from django.test.utils import CaptureQueriesContext
+
+Measurement = namedtuple('Measurement', ['scale', 'name', 'time_ms', 'median_ms', 'queries', 'peak_kb'])
+LoadResult = namedtuple('LoadResult', ['name', 'requests', 'errors', 'per_second', 'p50_ms', 'p95_ms'])
+
+# A measurement regresses when it is slower or bigger than the baseline by
+# more than this fraction; any extra query is a regression
+DEFAULT_THRESHOLD = 0.2
+
+
+def measure(scale, name, func, repeat=3):
+    """Measure ``func`` with cold caches; return a Measurement"""
+    cache.clear()
+    # A full query log (it is capped) would make the capture count nothing
+    reset_queries()
+    tracemalloc.start()
+    try:
+        with CaptureQueriesContext(connection) as queries:
+            func()
+        # Count now: the log is sliced lazily and later requests reset it
+        query_count = len(queries)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    timings = []
+    for _ in range(max(repeat, 1)):
+        cache.clear()
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return Measurement(
+        scale, name, round(min(timings), 3), round(statistics.median(timings), 3),
+        query_count, round(peak / 1024, 1),
+    )
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Compare Measurements against baseline ones (dicts loaded from JSON).
+
+    Returns ``(measurement, baseline entry or None, [problems])`` for every
+    measurement; ``problems`` is empty unless it regressed.
+    """
+    previous = {(entry['scale'], entry['name']): entry for entry in baseline}
+    report = []
+    for result in results:
+        before = previous.get((result.scale, result.name))
+        problems = []
+        if before is not None:
+            if result.time_ms > before['time_ms'] * (1 + threshold):
+                problems.append(f"time {before['time_ms']}ms -> {result.time_ms}ms")
+            if result.queries > before['queries']:
+                problems.append(f"queries {before['queries']} -> {result.queries}")
+            if result.peak_kb > before['peak_kb'] * (1 + threshold):
+                problems.append(f"memory {before['peak_kb']}KB -> {result.peak_kb}KB")
+        report.append((result, before, problems))
+    return report
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def _get(url, timeout):
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            response.read()
+            ok = response.status == 200
+    except (urllib.error.URLError, OSError):
+        ok = False
+    return ok, (time.perf_counter() - start) * 1000
+
+
+def load(name, base_url, paths, requests=200, concurrency=10, timeout=30):
+    """
+    GET ``paths`` (cycled) on ``base_url`` ``requests`` times from
+    ``concurrency`` threads; return a LoadResult.
+    """
+    urls = [base_url.rstrip('/') + paths[i % len(paths)] for i in range(requests)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        outcomes = list(executor.map(lambda url: _get(url, timeout), urls))
+    elapsed = time.perf_counter() - start
+    latencies = [latency for ok, latency in outcomes if ok] or [0.0]
+    return LoadResult(
+        name, requests, sum(not ok for ok, _ in outcomes), round(requests / elapsed, 1),
+        round(percentile(latencies, 0.5), 1), round(percentile(latencies, 0.95), 1),
+    )
@@ -0,0 +1,310 @@
+"""
+Versioned caching of the rendered city pages.
+
+Every city has a version token in the cache, and so does the city list as
+a whole. Cached pages and template fragments carry the token in their key,
+so bumping it (whenever a city or its readings change) makes every stale
+entry unreachable at once; nothing ever has to be found and deleted, and
+no TTL has to guess how long data stays fresh. A token that was evicted
+is simply recreated with a new value, which also just misses.
+
+The same tokens key the HTTP validators (ETag and Last-Modified, taken
+from ``updated_at``), so answering a conditional GET with 304 costs one
+query per version rather than one per request.
+"""
+import hashlib
+import threading
+import time
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Max
+from django.http import HttpResponse
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.http import condition
+
+from apps.weather.models import City
+
+LIST_VERSION_KEY = 'weather:version:cities'
+LOCATIONS_VERSION_KEY = 'weather:version:locations'
+
+
+def city_version_key(city_id):
+    return f'weather:version:city:{city_id}'
+
+
+def _new_token():
+    return str(time.time_ns())
+
+
+def _version(key):
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _new_token(), None)
+        version = cache.get(key)
+    return version
+
+
+def list_version():
+    """Version token of the city list; it changes when any city does"""
+    return _version(LIST_VERSION_KEY)
+
+
+def city_version(city_id):
+    """Version token of one city's pages"""
+    return _version(city_version_key(city_id))
+
+
+def city_versions(city_ids):
+    """Version tokens of several cities, read with one cache round trip"""
+    keys = {city_version_key(city_id): city_id for city_id in city_ids}
+    found = cache.get_many(list(keys))
+    versions = {keys[key]: version for key, version in found.items()}
+    for key, city_id in keys.items():
+        if city_id not in versions:
+            versions[city_id] = _version(key)
+    return versions
+
+
+def locations_version():
+    """Version token of the set of cities, their names and coordinates"""
+    return _version(LOCATIONS_VERSION_KEY)
+
+
+def bump_locations():
+    """Invalidate everything built from the city names and coordinates"""
+    cache.set(LOCATIONS_VERSION_KEY, _new_token(), None)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: cache.set(LOCATIONS_VERSION_KEY, _new_token(), None))
+
+
+class ProcessSnapshot:
+    """
+    A value built once per process by ``build()`` and rebuilt whenever
+    ``version()`` returns a different token, such as the in-memory indexes
+    over the cities.
+    """
+    def __init__(self, version, build):
+        self.version = version
+        self.build = build
+        self._current = (None, None)
+        self._lock = threading.Lock()
+
+    def get(self):
+        version = self.version()
+        built_for, value = self._current
+        if built_for != version:
+            with self._lock:
+                built_for, value = self._current
+                if built_for != version:
+                    value = self.build()
+                    self._current = (version, value)
+        return value
+
+
+def _set_versions(city_ids):
+    token = _new_token()
+    versions = {city_version_key(city_id): token for city_id in city_ids}
+    versions[LIST_VERSION_KEY] = token
+    cache.set_many(versions, None)
+
+
+def bump_versions(city_ids):
+    """
+    Invalidate the cached pages of ``city_ids`` and of the city list.
+
+    The bump is repeated once the surrounding transaction commits, so a page
+    rendered from the old data while it was still running is not served
+    under the new version.
+    """
+    city_ids = list(city_ids)
+    _set_versions(city_ids)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: _set_versions(city_ids))
+
+
+def list_page_version(request, **kwargs):
+    return list_version()
+
+
+def city_page_version(request, pk, **kwargs):
+    return city_version(pk)
+
+
+def page_timeout():
+    return getattr(settings, 'WEATHER_PAGE_CACHE_TIMEOUT', 60 * 60)
+
+
+def has_messages(request):
+    return bool(len(get_messages(request)))
+
+
+def _page_key(request, version, args, kwargs):
+    query = hashlib.md5(request.GET.urlencode().encode()).hexdigest()
+    return f'weather:page:{request.path}:{version(request, *args, **kwargs)}:{query}'
+
+
+def _cacheable(request):
+    return request.method in ('GET', 'HEAD') and page_timeout() > 0
+
+
+def cache_page_versioned(version):
+    """
+    Cache a view's GET responses under ``version(request, **kwargs)``.
+
+    The query string is part of the key. Only successful responses are
+    stored, and never ones that carry one-off flash messages. Works on
+    both sync and async views.
+    """
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                if not _cacheable(request) or await sync_to_async(has_messages)(request):
+                    return await view(request, *args, **kwargs)
+
+                key = _page_key(request, version, args, kwargs)
+                cached = await cache.aget(key)
+                if cached is not None:
+                    content, content_type = cached
+                    return HttpResponse(content, content_type=content_type)
+
+                response = await view(request, *args, **kwargs)
+                if response.status_code == 200 and not await sync_to_async(has_messages)(request):
+                    await cache.aset(key, (response.content, response['Content-Type']), page_timeout())
+                return response
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not _cacheable(request) or has_messages(request):
+                return view(request, *args, **kwargs)
+
+            key = _page_key(request, version, args, kwargs)
+            cached = cache.get(key)
+            if cached is not None:
+                content, content_type = cached
+                return HttpResponse(content, content_type=content_type)
+
+            response = view(request, *args, **kwargs)
+
+            def store(response):
+                if response.status_code == 200 and not has_messages(request):
+                    cache.set(key, (response.content, response['Content-Type']), page_timeout())
+
+            if hasattr(response, 'add_post_render_callback') and not response.is_rendered:
+                response.add_post_render_callback(store)
+            else:
+                store(response)
+            return response
+        return wrapper
+    return decorator
+
+
+def make_validators(values):
+    """Return ``(etag, last_modified)`` for a tuple of values, or Nones for None"""
+    if values is None:
+        return None, None
+    timestamps = [value for value in values if hasattr(value, 'timestamp')]
+    return (
+        hashlib.md5(repr(values).encode()).hexdigest()[:16],
+        max(timestamps) if timestamps else None,
+    )
+
+
+def _validators(key, rows):
+    """Return ``(etag, last_modified)`` for the values of ``rows()``, memoized under ``key``"""
+    validators = cache.get(key)
+    if validators is None:
+        validators = make_validators(rows())
+        cache.set(key, validators, page_timeout())
+    return validators
+
+
+def list_validators():
+    """Validators of the city list: its size and the newest city/stats change"""
+    return _validators(
+        f'weather:validators:list:{list_version()}',
+        lambda: tuple(City.objects.aggregate(
+            count=Count('id'), cities=Max('updated_at'), stats=Max('weather_stats__updated_at'),
+        ).values()),
+    )
+
+
+def city_validators(city_id):
+    """Validators of one city's data: its row and its stats row"""
+    return _validators(
+        f'weather:validators:city:{city_id}:{city_version(city_id)}',
+        lambda: City.objects.filter(pk=city_id).values_list(
+            'updated_at', 'weather_stats__updated_at', 'weather_stats__reading_count',
+            'weather_stats__last_recorded_at',
+        ).first(),
+    )
+
+
+def list_page_validators(request, **kwargs):
+    return list_validators()
+
+
+def city_page_validators(request, pk, **kwargs):
+    return city_validators(pk)
+
+
+def http_max_age():
+    return getattr(settings, 'WEATHER_HTTP_MAX_AGE', 60)
+
+
+def conditional_page(validators, cache_control=True):
+    """
+    Answer conditional GETs with 304 from ``validators(request, **kwargs)``.
+
+    The validators are checked before the view runs, so a 304 skips all
+    of its queries. Successful responses are marked cacheable by shared
+    caches for WEATHER_HTTP_MAX_AGE seconds unless ``cache_control`` is
+    False; responses carrying flash messages are never conditional or
+    public.
+    """
+    def decorator(view):
+        def request_validators(request, *args, **kwargs):
+            if not hasattr(request, '_weather_validators'):
+                request._weather_validators = validators(request, *args, **kwargs)
+            return request._weather_validators
+
+        conditional_view = condition(
+            etag_func=lambda *args, **kwargs: request_validators(*args, **kwargs)[0],
+            last_modified_func=lambda *args, **kwargs: request_validators(*args, **kwargs)[1],
+        )(view)
+
+        def patch_headers(response):
+            if cache_control and response.status_code in (200, 304):
+                patch_cache_control(response, public=True, max_age=http_max_age())
+            # Flash messages live in the cookie or session
+            patch_vary_headers(response, ('Cookie',))
+            return response
+
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                if await sync_to_async(has_messages)(request):
+                    response = await view(request, *args, **kwargs)
+                    patch_cache_control(response, private=True, no_cache=True)
+                    return response
+                # Compute the validators off the event loop; condition()
+                # then reads them back from the request
+                await sync_to_async(request_validators)(request, *args, **kwargs)
+                return patch_headers(await conditional_view(request, *args, **kwargs))
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if has_messages(request):
+                response = view(request, *args, **kwargs)
+                patch_cache_control(response, private=True, no_cache=True)
+                return response
+            return patch_headers(conditional_view(request, *args, **kwargs))
+        return wrapper
+    return decorator
@@ -0,0 +1,111 @@
+"""
+Rendered chart images, cached per (city, page cursor or range, data version).
+
+The data version is the city's page version (see caching.py), bumped
+whenever its readings or rollups are written in place, added or removed,
+so a chart URL that carries it can be cached forever by browsers and the
+PNG is only rendered again once the data has changed.
+"""
+from datetime import timedelta
+from urllib.parse import urlencode
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.urls import reverse
+
+from apps.common.timing import timed
+from apps.weather.caching import city_version
+from apps.weather.hotcache import hot_series
+from apps.weather.pagination import KeysetPaginator, decode_cursor
+from apps.weather.rollups import load_series
+from apps.weather.renderer import arender_records, render_records
+
+CHART_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+# Versioned chart URLs never change content, so browsers may keep them a year
+CHART_MAX_AGE = 60 * 60 * 24 * 365
+HISTORY_PAGE_SIZE = 10
+
+# Chart ranges selectable on the detail page, read from the rollups
+CHART_RANGES = {
+    '24h': timedelta(days=1),
+    '7d': timedelta(days=7),
+    '30d': timedelta(days=30),
+    '1y': timedelta(days=365),
+}
+
+
+def chart_version(city):
+    """Return a token that changes whenever the city's readings or rollups change"""
+    return city_version(city.pk)
+
+
+def chart_url(city, cursor=None, chart_range=None):
+    """Return the versioned URL of a city's temperature chart"""
+    params = {}
+    if chart_range:
+        params['range'] = chart_range
+    elif cursor:
+        params['cursor'] = cursor
+    params['v'] = chart_version(city)
+    return f"{reverse('city_chart', args=[city.pk])}?{urlencode(params)}"
+
+
+def history_page(city, cursor=None):
+    """
+    Return one keyset page of a city's weather history, newest first. The
+    newest page comes from the hot series cache when it holds the city.
+    """
+    if decode_cursor(cursor) is None:
+        series = hot_series().peek(city.pk)
+        page = series.page(HISTORY_PAGE_SIZE) if series is not None else None
+        if page is not None:
+            return page
+    return KeysetPaginator(city.weather_data.all(), HISTORY_PAGE_SIZE).page(cursor)
+
+
+def chart_points(city, cursor=None, chart_range=None):
+    """Return the readings a chart covers: one history page, or a rollup range"""
+    stats = getattr(city, 'weather_stats', None)
+    if chart_range in CHART_RANGES and stats is not None and stats.last_recorded_at:
+        end = stats.last_recorded_at + timedelta(seconds=1)
+        return load_series(city, end - CHART_RANGES[chart_range], end)
+    return None, history_page(city, cursor).object_list
+
+
+def chart_cache_key(city, cursor=None, chart_range=None):
+    variant = f'range-{chart_range}' if chart_range in CHART_RANGES else f'page-{cursor or "first"}'
+    return f'weather:chart:{city.pk}:{variant}:{chart_version(city)}'
+
+
+def get_chart_png(city, cursor=None, chart_range=None):
+    """Return the chart PNG for a city, rendering it only on a cache miss"""
+    key = chart_cache_key(city, cursor, chart_range)
+    png = cache.get(key)
+    if png is None:
+        _, points = chart_points(city, cursor, chart_range)
+        with timed('chart'):
+            png = render_records(points, 'temperature')
+        cache.set(key, png, CHART_CACHE_TIMEOUT)
+    return png
+
+
+async def achart_points(city, cursor=None, chart_range=None):
+    """Async chart_points()"""
+    stats = getattr(city, 'weather_stats', None)
+    if chart_range in CHART_RANGES and stats is not None and stats.last_recorded_at:
+        end = stats.last_recorded_at + timedelta(seconds=1)
+        return await sync_to_async(load_series)(city, end - CHART_RANGES[chart_range], end)
+    page = await KeysetPaginator(city.weather_data.all(), HISTORY_PAGE_SIZE).apage(cursor)
+    return None, page.object_list
+
+
+async def aget_chart_png(city, cursor=None, chart_range=None):
+    """Async get_chart_png(); the rendering runs off the event loop"""
+    key = chart_cache_key(city, cursor, chart_range)
+    png = await cache.aget(key)
+    if png is None:
+        _, points = await achart_points(city, cursor, chart_range)
+        with timed('chart'):
+            png = await arender_records(points, 'temperature')
+        await cache.aset(key, png, CHART_CACHE_TIMEOUT)
+    return png
@@ -0,0 +1,181 @@
+"""
+Retention of raw readings and rollups.
+
+Every level (raw readings, then the hourly, daily and monthly rollups) is
+kept for its own number of days, set in WEATHER_RETENTION. Compacting a
+level first brings the next coarser rollup up to date and rebuilds it over
+all the rows past the cutoff, so pruned rows (late and backfilled ones
+included) only lose detail, then deletes them in bounded batches. Each batch is its own short
+transaction, so no long lock is held and an interrupted run simply carries
+on where it stopped next time.
+
+Cutoffs fall on bucket boundaries of the coarser level and every batch
+deletes whole (city, coarser bucket) groups, so no bucket is ever left, or
+rebuilt, with only part of its rows. A reading backfilled into a bucket
+whose rows were already pruned rebuilds that bucket from what is left.
+
+CityStats covers the readings that are still stored, like a rebuild from
+WeatherData does, so it is recomputed for the cities raw readings were
+pruned from.
+"""
+import time
+from collections import namedtuple
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Min, Q
+from django.utils import timezone
+
+from apps.weather.caching import bump_versions
+from apps.weather.models import CityStats
+from apps.weather.rollups import DAY, HOUR, MONTH, RAW, build_rollups, chunks, next_bucket, truncate
+
+DEFAULT_BATCH_SIZE = 5000
+
+# Finest first; each level is folded into the next one before it is pruned
+LEVELS = (RAW, HOUR, DAY, MONTH)
+COARSER = {RAW.name: HOUR, HOUR.name: DAY, DAY.name: MONTH, MONTH.name: None}
+
+Compaction = namedtuple('Compaction', ['level', 'cutoff', 'rows', 'bytes'])
+
+
+def retention_policy(overrides=None):
+    """
+    Return ``{level name: days kept or None for forever}`` from
+    WEATHER_RETENTION and ``overrides``.
+
+    Raises ValueError when a level is kept for less time than a finer one,
+    because coarser rollups are rebuilt from finer ones.
+    """
+    policy = {level.name: None for level in LEVELS}
+    policy.update(getattr(settings, 'WEATHER_RETENTION', {}))
+    policy.update(overrides or {})
+
+    unknown = set(policy) - set(COARSER)
+    if unknown:
+        raise ValueError(f"Unknown retention levels: {', '.join(sorted(unknown))}")
+    for finer, coarser in zip(LEVELS, LEVELS[1:]):
+        kept, coarser_kept = policy[finer.name], policy[coarser.name]
+        if kept is not None and kept < 0:
+            raise ValueError(f'Retention of {finer.name} must not be negative')
+        if coarser_kept is not None and (kept is None or coarser_kept < kept):
+            raise ValueError(f'{coarser.name} must be kept at least as long as {finer.name}')
+    return policy
+
+
+def retention_cutoff(level, days, now=None):
+    """Oldest time still kept at ``level``, on a bucket boundary of the coarser level"""
+    if days is None:
+        return None
+    now = now or timezone.now()
+    return truncate(now - timedelta(days=days), (COARSER[level.name] or MONTH).name)
+
+
+def table_size(model):
+    """Return ``(bytes, rows)`` of a model's table with its indexes, or None if unknown"""
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                'SELECT pg_total_relation_size(oid), reltuples FROM pg_class WHERE oid = %s::regclass',
+                [table],
+            )
+            size, rows = cursor.fetchone()
+            # reltuples is an estimate and -1 before the first ANALYZE
+            if rows < 1:
+                rows = model.objects.count()
+            return size, int(rows)
+        if connection.vendor == 'sqlite':
+            try:
+                cursor.execute(
+                    'SELECT SUM(pgsize) FROM dbstat WHERE name IN '
+                    '(SELECT name FROM sqlite_master WHERE tbl_name = %s)',
+                    [table],
+                )
+            except Exception:
+                # SQLite built without the dbstat table
+                return None
+            return cursor.fetchone()[0] or 0, model.objects.count()
+    return None
+
+
+def compact(level, cutoff, batch_size=DEFAULT_BATCH_SIZE, pause=0, dry_run=False):
+    """
+    Fold ``level`` into the next coarser rollup and delete its rows older
+    than ``cutoff``, ``batch_size`` at a time. Returns a Compaction with
+    the rows deleted and an estimate of the bytes they took.
+    """
+    model = level.model
+    time_field = 'recorded_at' if level is RAW else 'bucket_start'
+    expired = model.objects.filter(**{f'{time_field}__lt': cutoff})
+
+    size = table_size(model)
+    bytes_per_row = size[0] / size[1] if size and size[1] else None
+
+    if dry_run:
+        rows = expired.count()
+    else:
+        coarser = COARSER[level.name]
+        oldest = expired.aggregate(oldest=Min(time_field))['oldest']
+        if coarser is not None:
+            build_rollups(coarser)
+            if oldest is not None:
+                # Every bucket with expired rows, however late they arrived
+                build_rollups(coarser, since=oldest, until=cutoff, resume=False)
+        city_ids = set(expired.order_by().values_list('city_id', flat=True).distinct())
+        rows = _delete(model, expired, time_field, coarser, batch_size, pause)
+        if city_ids:
+            if level is RAW:
+                for chunk in chunks(sorted(city_ids), batch_size):
+                    CityStats.objects.rebuild(chunk)
+            bump_versions(city_ids)
+
+    return Compaction(
+        level.name, cutoff, rows, round(rows * bytes_per_row) if bytes_per_row is not None else None
+    )
+
+
+def _delete(model, expired, time_field, coarser, batch_size, pause):
+    """
+    Delete ``expired`` in batches of at least ``batch_size`` rows, city by
+    city and oldest first, each extended to the end of the ``coarser``
+    bucket its last row falls in.
+    """
+    # One DELETE ... WHERE id IN (subquery) per batch: no rows are loaded
+    # into Python and no per-row signals are sent
+    table = connection.ops.quote_name(model._meta.db_table)
+    ordered = expired.order_by('city_id', time_field, 'id')
+
+    deleted = 0
+    while True:
+        last = ordered.values_list('city_id', time_field)[batch_size - 1:batch_size].first()
+        if last is None:
+            batch = expired.order_by()
+        elif coarser is not None:
+            city_id, recorded = last
+            end = next_bucket(recorded, coarser.name)
+            batch = expired.order_by().filter(
+                Q(city_id__lt=city_id) | Q(city_id=city_id, **{f'{time_field}__lt': end})
+            )
+        else:
+            batch = ordered[:batch_size]
+        subquery, params = batch.values('id').query.sql_with_params()
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {table} WHERE id IN ({subquery})', params)
+            count = cursor.rowcount
+        deleted += count
+        if last is None:
+            return deleted
+        if pause:
+            time.sleep(pause)
+
+
+def compact_all(policy, now=None, batch_size=DEFAULT_BATCH_SIZE, pause=0, dry_run=False):
+    """Compact every level with a retention limit, finest first; returns Compactions"""
+    now = now or timezone.now()
+    return [
+        compact(level, retention_cutoff(level, policy[level.name], now), batch_size, pause, dry_run)
+        for level in LEVELS
+        if policy[level.name] is not None
+    ]
@@ -0,0 +1,218 @@
+"""
+Side-by-side comparison of several cities' series.
+
+All the selected cities are read with one ``city__in`` + range query (see
+series.load_columns) and averaged onto one shared time grid with a single
+``bincount`` over every city's readings, so the series line up point for
+point whatever each city's sampling. Spans longer than RAW_COMPARE_SPAN
+are read from the coarsest rollup whose buckets fit in a grid step, each
+bucket mean weighted by its reading count, so a long span reads a few rows
+per grid point rather than every reading (readings not yet rolled up are
+left out, as on the city charts). So do shorter spans holding more than
+MAX_RAW_ROWS readings across the cities, read from the hourly rollup
+instead of loading every reading into memory. The aligned result, and the combined
+chart drawn from it, are cached under the version tokens of all the cities
+involved, so comparing N cities costs one query and one render until one
+of them changes.
+"""
+import hashlib
+from datetime import timedelta
+
+import numpy as np
+from django.core.cache import cache
+
+from apps.common.timing import timed
+from apps.weather.caching import city_versions
+from apps.weather.renderer import submit
+from apps.weather.rollups import DAY, HOUR, MONTH, RAW, load_columns as load_rollup_columns
+from apps.weather.series import latest_range, load_columns
+from apps.weather.spatial import city_index
+
+COMPARE_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+DEFAULT_SPAN = timedelta(days=7)
+DEFAULT_MAX_POINTS = 500
+# Grid steps, in seconds; the finest one that keeps the grid short enough is used
+GRID_STEPS = (
+    60, 5 * 60, 10 * 60, 15 * 60, 30 * 60, 60 * 60, 3 * 60 * 60, 6 * 60 * 60, 12 * 60 * 60,
+    24 * 60 * 60, 7 * 24 * 60 * 60, 30 * 24 * 60 * 60,
+)
+# Longer spans are read from the rollups
+RAW_COMPARE_SPAN = timedelta(days=31)
+# Shorter spans holding more readings than this (the columns API's cap) are
+# read from the hourly rollup
+MAX_RAW_ROWS = 250000
+# Each rollup with its longest bucket, in seconds, coarsest first
+ROLLUP_BUCKETS = ((MONTH, 31 * 24 * 60 * 60), (DAY, 24 * 60 * 60), (HOUR, 60 * 60))
+
+
+def grid_step(span_seconds, max_points=DEFAULT_MAX_POINTS):
+    for step in GRID_STEPS:
+        if span_seconds / step <= max_points:
+            return step
+    return int(np.ceil(span_seconds / max_points))
+
+
+def compare_source(span_seconds, step):
+    """
+    Return the resolution to read a span from and the grid step to use:
+    the raw readings up to RAW_COMPARE_SPAN, otherwise the coarsest rollup
+    whose buckets fit in ``step`` (hourly at least, the step widened to it).
+    """
+    if span_seconds <= RAW_COMPARE_SPAN.total_seconds():
+        return RAW, step
+    for resolution, bucket in ROLLUP_BUCKETS:
+        if bucket <= step:
+            return resolution, step
+    return HOUR, ROLLUP_BUCKETS[-1][1]
+
+
+def load_compare(resolution, city_ids, start, end, metric, limit=None):
+    """
+    Read every city's ``metric`` over [start, end) from ``resolution``.
+
+    Returns ``{city_id: (timestamps, values, counts, minimums, maximums)}``.
+    A raw reading counts once and is its own min and max; a rollup bucket's
+    mean counts for as many readings as the bucket holds. ``limit`` caps
+    the raw rows read, as in series.load_columns().
+    """
+    if resolution is RAW:
+        result = {}
+        columns = load_columns(city_ids, start, end, (metric,), limit=limit)
+        for city_id, (timestamps, values) in columns.items():
+            values = values[metric]
+            result[city_id] = (timestamps, values, np.ones(len(values)), values, values)
+        return result
+    fields = (f'{metric}_mean', 'reading_count', f'{metric}_min', f'{metric}_max')
+    return {
+        city_id: (timestamps, *(values[field] for field in fields))
+        for city_id, (timestamps, values)
+        in load_rollup_columns(resolution, city_ids, start, end, fields).items()
+    }
+
+
+def align(columns, start, end, step, counts=None):
+    """
+    Average each city's readings into ``step``-second buckets over
+    [start, end) (epoch seconds, ``start`` rounded down to the step).
+
+    ``columns`` maps city ids to ``(timestamps, values)``, and ``counts``
+    optionally to how many readings each value stands for. Returns
+    ``(grid, {city_id: means})`` with NaN in buckets a city has no readings
+    in; every city shares the one grid.
+    """
+    first = start - start % step
+    size = max(1, int(np.ceil((end - first) / step)))
+    grid = first + step * np.arange(size, dtype=np.int64)
+    city_ids = list(columns)
+    if not city_ids:
+        return grid, {}
+
+    # One flat bucket index across all cities: city position * size + bucket
+    lengths = [len(columns[city_id][0]) for city_id in city_ids]
+    timestamps = np.concatenate([columns[city_id][0] for city_id in city_ids]).astype(np.int64)
+    values = np.concatenate([columns[city_id][1] for city_id in city_ids]).astype(np.float64)
+    weights = (
+        np.concatenate([counts[city_id] for city_id in city_ids]).astype(np.float64)
+        if counts is not None else np.ones(len(values))
+    )
+    positions = np.repeat(np.arange(len(city_ids)), lengths)
+    buckets = (timestamps - first) // step
+    inside = (buckets >= 0) & (buckets < size)
+    flat = positions[inside] * size + buckets[inside]
+    totals = np.bincount(flat, weights=values[inside] * weights[inside], minlength=len(city_ids) * size)
+    readings = np.bincount(flat, weights=weights[inside], minlength=len(city_ids) * size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = (totals / readings).reshape(len(city_ids), size)
+    return grid, dict(zip(city_ids, means))
+
+
+def default_range(city_ids):
+    """The DEFAULT_SPAN before the newest reading of any of the cities"""
+    return latest_range(city_ids, DEFAULT_SPAN)
+
+
+def compare_key(city_ids, start, end, metric, max_points):
+    versions = city_versions(city_ids)
+    digest = hashlib.md5(
+        ','.join(f'{city_id}:{versions[city_id]}' for city_id in city_ids).encode()
+    ).hexdigest()
+    return (
+        f'weather:compare:{digest}:{int(start.timestamp())}:{int(end.timestamp())}:'
+        f'{metric}:{max_points}'
+    )
+
+
+def compare_cities(city_ids, start, end, metric='temperature', max_points=DEFAULT_MAX_POINTS):
+    """
+    Return the aligned comparison of ``city_ids`` over [start, end) as a
+    JSON-ready dict: the grid (epoch seconds), and for every city its name,
+    its bucket means (None where empty) and the count, mean, min and max of
+    its raw readings. Cached until any of the cities changes.
+    """
+    key = compare_key(city_ids, start, end, metric, max_points)
+    result = cache.get(key)
+    if result is not None:
+        return result
+
+    start_seconds, end_seconds = int(start.timestamp()), int(end.timestamp())
+    resolution, step = compare_source(
+        end_seconds - start_seconds, grid_step(end_seconds - start_seconds, max_points)
+    )
+    if resolution is RAW:
+        # One row past the cap tells a complete read from a truncated one
+        columns = load_compare(RAW, city_ids, start, end, metric, limit=MAX_RAW_ROWS + 1)
+        if sum(len(column[0]) for column in columns.values()) > MAX_RAW_ROWS:
+            resolution, step = HOUR, max(step, ROLLUP_BUCKETS[-1][1])
+    if resolution is not RAW:
+        columns = load_compare(resolution, city_ids, start, end, metric)
+    grid, means = align(
+        {city_id: column[:2] for city_id, column in columns.items()}, start_seconds, end_seconds, step,
+        counts={city_id: column[2] for city_id, column in columns.items()},
+    )
+
+    index = city_index()
+    names = {
+        int(index.ids[position]): f'{index.names[position]}, {index.countries[position]}'
+        for position in np.flatnonzero(np.isin(index.ids, city_ids))
+    }
+    cities = []
+    for city_id in city_ids:
+        _, values, counts, minimums, maximums = columns[city_id]
+        count = int(counts.sum())
+        cities.append({
+            'id': city_id,
+            'name': names.get(city_id, str(city_id)),
+            'values': [None if np.isnan(value) else round(value, 2) for value in means[city_id].tolist()],
+            'count': count,
+            'mean': round(float((values * counts).sum() / count), 2) if count else None,
+            'min': round(float(minimums.min()), 2) if count else None,
+            'max': round(float(maximums.max()), 2) if count else None,
+        })
+    result = {
+        'metric': metric,
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'resolution': resolution.name,
+        'step': step,
+        'grid': grid.tolist(),
+        'cities': cities,
+    }
+    cache.set(key, result, COMPARE_CACHE_TIMEOUT)
+    return result
+
+
+def compare_chart(city_ids, start, end, metric='temperature', max_points=DEFAULT_MAX_POINTS):
+    """Return one PNG with every city's aligned series, rendered only on a cache miss"""
+    key = compare_key(city_ids, start, end, metric, max_points) + ':png'
+    png = cache.get(key)
+    if png is None:
+        result = compare_cities(city_ids, start, end, metric, max_points)
+        # matplotlib date numbers are days since the Unix epoch
+        dates = np.asarray(result['grid'], dtype=np.float64) / (24 * 60 * 60)
+        series = [
+            (city['name'], np.array(city['values'], dtype=np.float64)) for city in result['cities']
+        ]
+        with timed('chart'):
+            png = submit(metric, dates, series).result()
+        cache.set(key, png, COMPARE_CACHE_TIMEOUT)
+    return png
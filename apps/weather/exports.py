@@ -0,0 +1,106 @@
+"""
+Constant-memory CSV and NDJSON exports of WeatherData.
+
+Rows come from a server-side cursor (``QuerySet.iterator``) as plain tuples
+and are encoded chunk by chunk, so a worker never holds more than one chunk
+of the result, however many rows are exported.
+"""
+import csv
+import json
+import zlib
+from datetime import datetime
+from decimal import Decimal
+
+from django.http import StreamingHttpResponse
+
+CHUNK_SIZE = 2000
+
+EXPORT_FIELDS = (
+    'recorded_at', 'temperature', 'humidity', 'pressure', 'wind_speed', 'description',
+)
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+class LineBuffer:
+    """Pseudo file that hands back what csv.writer writes instead of storing it"""
+    def write(self, value):
+        return value
+
+
+def export_rows(queryset, fields=EXPORT_FIELDS):
+    """Stream ``fields`` of a queryset, oldest first, as tuples"""
+    return queryset.order_by('recorded_at', 'id').values_list(*fields).iterator(
+        chunk_size=CHUNK_SIZE
+    )
+
+
+def _chunks(rows, size=CHUNK_SIZE):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _plain(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def csv_stream(rows, fields=EXPORT_FIELDS):
+    """Yield a CSV header and then one string per chunk of rows"""
+    writer = csv.writer(LineBuffer())
+    yield writer.writerow(fields)
+    for chunk in _chunks(rows):
+        yield ''.join(writer.writerow([_plain(value) for value in row]) for row in chunk)
+
+
+def ndjson_stream(rows, fields=EXPORT_FIELDS):
+    """Yield one string of newline-delimited JSON objects per chunk of rows"""
+    for chunk in _chunks(rows):
+        yield ''.join(
+            json.dumps(dict(zip(fields, map(_plain, row)))) + '\n' for row in chunk
+        )
+
+
+def gzip_stream(chunks):
+    """Gzip a stream of strings on the fly"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_stream(queryset, fmt, compress=False, fields=EXPORT_FIELDS):
+    """Return the byte/str stream of a queryset in ``fmt`` ('csv' or 'ndjson')"""
+    rows = export_rows(queryset, fields)
+    stream = csv_stream(rows, fields) if fmt == 'csv' else ndjson_stream(rows, fields)
+    return gzip_stream(stream) if compress else stream
+
+
+def export_response(queryset, fmt, filename, compress=False, fields=EXPORT_FIELDS):
+    """Return a streaming download of a queryset"""
+    if compress:
+        response = StreamingHttpResponse(
+            export_stream(queryset, fmt, True, fields), content_type='application/gzip'
+        )
+        filename = f'{filename}.{fmt}.gz'
+    else:
+        response = StreamingHttpResponse(
+            export_stream(queryset, fmt, False, fields), content_type=CONTENT_TYPES[fmt]
+        )
+        filename = f'{filename}.{fmt}'
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
@@ -0,0 +1,462 @@
+"""
+Per-process cache of the newest readings of the busiest cities.
+
+Each held city keeps its last WEATHER_HOT_READINGS readings in a ring
+buffer of NumPy arrays rather than as model instances: ids and timestamps
+as int64, the metrics as float32 and the description as a uint16 code
+into a table shared by the whole process. Next to it sit the city and its
+stats row, so the detail page's newest history page, its averages, its
+chart and its HTTP validators are all served without a query.
+
+A held city is only used while its version token in the cache (see
+caching.py) is the one it was loaded under; after a change anywhere it is
+loaded again, in two queries, on its next request. Readings created in
+this process are appended to the rings as they are committed. Up to
+WEATHER_HOT_CITIES cities are held, least recently used out first, and
+the WEATHER_HOT_WARM_CITIES with the newest readings are loaded when the
+server starts: on the ASGI lifespan startup event, or before the first
+request where there is none (see warm_on_startup and
+warm_on_first_request, which core/asgi.py and core/wsgi.py wrap their
+applications in). Nothing is queried while the modules are imported.
+
+Timestamps are kept in microseconds, not seconds, so the keyset cursors
+built from them are exactly those of the database rows.
+"""
+import copy
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+from decimal import Decimal
+
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError
+from django.db.models import F, FloatField, Window
+from django.db.models.functions import Cast, RowNumber
+
+from apps.weather.caching import city_validators, city_version, make_validators
+from apps.weather.models import City, CityStats, WeatherData
+from apps.weather.pagination import EPOCH, MICROSECOND, KeysetPaginator
+
+logger = logging.getLogger(__name__)
+
+METRICS = ('temperature', 'humidity', 'pressure', 'wind_speed')
+# Decimal fields are rendered with their model's two places
+DECIMAL_METRICS = ('temperature', 'wind_speed')
+
+
+class Descriptions:
+    """The process-wide table of description texts and their uint16 codes"""
+    limit = np.iinfo(np.uint16).max + 1
+
+    def __init__(self):
+        self.texts = []
+        self.codes = {}
+        self._lock = threading.Lock()
+
+    def code(self, text):
+        code = self.codes.get(text)
+        if code is None:
+            with self._lock:
+                code = self.codes.get(text)
+                if code is None:
+                    if len(self.texts) >= self.limit:
+                        raise OverflowError('Too many distinct descriptions for the hot series cache')
+                    code = len(self.texts)
+                    self.texts.append(text)
+                    self.codes[text] = code
+        return code
+
+
+descriptions = Descriptions()
+
+
+class HotReading:
+    """A read-only stand-in for a WeatherData row, built from a ring buffer"""
+    __slots__ = (
+        'pk', 'city_id', 'recorded_at', 'temperature', 'humidity', 'pressure', 'wind_speed',
+        'description',
+    )
+
+    def __init__(self, pk, city_id, recorded_at, temperature, humidity, pressure, wind_speed,
+                 description):
+        self.pk = pk
+        self.city_id = city_id
+        self.recorded_at = recorded_at
+        self.temperature = temperature
+        self.humidity = humidity
+        self.pressure = pressure
+        self.wind_speed = wind_speed
+        self.description = description
+
+    @property
+    def id(self):
+        return self.pk
+
+    def __repr__(self):
+        return f'<HotReading {self.pk} of city {self.city_id} at {self.recorded_at.isoformat()}>'
+
+
+def to_micros(recorded_at):
+    return (recorded_at - EPOCH) // MICROSECOND
+
+
+def stats_row(city):
+    """The values caching.city_validators() reads for a city, taken from the instance"""
+    stats = getattr(city, 'weather_stats', None)
+    if stats is None:
+        return city.updated_at, None, None, None
+    return city.updated_at, stats.updated_at, stats.reading_count, stats.last_recorded_at
+
+
+class HotSeries:
+    """
+    The newest readings of one city, at most ``capacity`` of them, in a
+    ring: the oldest is at ``start`` and each push overwrites it once full.
+
+    A series is never changed once it is shared; appends work on a copy.
+    """
+    def __init__(self, city, version, capacity, complete=True):
+        self.city = city
+        self.version = version
+        self.capacity = capacity
+        # False once older readings exist than the oldest one held
+        self.complete = complete
+        self.start = 0
+        self.size = 0
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.micros = np.zeros(capacity, dtype=np.int64)
+        self.metrics = {metric: np.zeros(capacity, dtype=np.float32) for metric in METRICS}
+        self.codes = np.zeros(capacity, dtype=np.uint16)
+        self.validators = make_validators(stats_row(city))
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        """Bytes held by the ring buffers"""
+        arrays = (self.ids, self.micros, self.codes, *self.metrics.values())
+        return sum(array.nbytes for array in arrays)
+
+    def copy(self, city, version):
+        """Return a copy of the rings for newer ``city`` and stats rows"""
+        series = copy.copy(self)
+        series.city = city
+        series.version = version
+        series.validators = make_validators(stats_row(city))
+        series.ids = self.ids.copy()
+        series.micros = self.micros.copy()
+        series.metrics = {metric: values.copy() for metric, values in self.metrics.items()}
+        series.codes = self.codes.copy()
+        return series
+
+    def newest_key(self):
+        """``(micros, id)`` of the newest reading held, or None"""
+        if not self.size:
+            return None
+        position = (self.start + self.size - 1) % self.capacity
+        return int(self.micros[position]), int(self.ids[position])
+
+    def push(self, pk, micros, values, description):
+        """Append a reading newer than all the held ones"""
+        newest = self.newest_key()
+        if newest is not None and (micros, pk) <= newest:
+            raise ValueError('Readings must be pushed oldest first')
+        if self.size == self.capacity:
+            position = self.start
+            self.start = (self.start + 1) % self.capacity
+            self.complete = False
+        else:
+            position = (self.start + self.size) % self.capacity
+            self.size += 1
+        self.ids[position] = pk
+        self.micros[position] = micros
+        for metric, value in zip(METRICS, values):
+            self.metrics[metric][position] = value
+        self.codes[position] = descriptions.code(description)
+
+    def push_reading(self, reading):
+        self.push(
+            reading.pk, to_micros(reading.recorded_at),
+            [float(getattr(reading, metric)) for metric in METRICS], reading.description,
+        )
+
+    def readings(self, count):
+        """Return up to ``count`` readings, newest first"""
+        count = min(count, self.size)
+        positions = (self.start + self.size - 1 - np.arange(count)) % self.capacity
+        columns = [
+            [Decimal(f'{value:.2f}') for value in self.metrics[metric][positions].tolist()]
+            if metric in DECIMAL_METRICS
+            else [round(value) for value in self.metrics[metric][positions].tolist()]
+            for metric in METRICS
+        ]
+        texts = descriptions.texts
+        return [
+            HotReading(pk, self.city.pk, EPOCH + micros * MICROSECOND, *values, texts[code])
+            for pk, micros, code, *values in zip(
+                self.ids[positions].tolist(), self.micros[positions].tolist(),
+                self.codes[positions].tolist(), *columns,
+            )
+        ]
+
+    def page(self, per_page):
+        """
+        Return the newest keyset page of ``per_page`` readings, or None when
+        the ring is too short to tell whether an older page exists.
+        """
+        if self.size <= per_page and not self.complete:
+            return None
+        # One extra reading tells the paginator there is an older page
+        rows = self.readings(per_page + 1)
+        return KeysetPaginator(self.city.weather_data.all(), per_page)._page(None, rows)
+
+
+def newest_readings(city_ids, limit):
+    """
+    Return ``{city_id: rows}`` of the ``limit`` newest readings of each city,
+    newest first, as ``(id, recorded_at, *METRICS, description)`` tuples
+    with the metrics cast to floats by the database.
+    """
+    floats = {f'{metric}_float': Cast(metric, FloatField()) for metric in METRICS}
+    queryset = WeatherData.objects.annotate(**floats)
+    fields = ('city_id', 'id', 'recorded_at', *floats, 'description')
+    if len(city_ids) == 1:
+        rows = queryset.filter(city_id=city_ids[0]).order_by('-recorded_at', '-id').values_list(
+            *fields
+        )[:limit]
+    else:
+        rows = queryset.filter(city_id__in=city_ids).annotate(
+            rank=Window(
+                RowNumber(), partition_by=F('city_id'),
+                order_by=(F('recorded_at').desc(), F('id').desc()),
+            )
+        ).filter(rank__lte=limit).order_by('city_id', '-recorded_at', '-id').values_list(*fields)
+    result = defaultdict(list)
+    for city_id, *row in rows:
+        result[city_id].append(row)
+    return result
+
+
+class HotSeriesCache:
+    """The HotSeries of the cities this process serves most, by city id"""
+    def __init__(self):
+        self._series = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def capacity(self):
+        return getattr(settings, 'WEATHER_HOT_READINGS', 0)
+
+    @property
+    def max_cities(self):
+        return getattr(settings, 'WEATHER_HOT_CITIES', 0)
+
+    @property
+    def enabled(self):
+        return self.capacity > 0 and self.max_cities > 0
+
+    def __len__(self):
+        return len(self._series)
+
+    def __contains__(self, city_id):
+        return city_id in self._series
+
+    def peek(self, city_id):
+        """Return the held series of a city if it is still current, without loading it"""
+        series = self._series.get(city_id)
+        if series is None or series.capacity != self.capacity or series.version != city_version(city_id):
+            return None
+        with self._lock:
+            if city_id in self._series:
+                self._series.move_to_end(city_id)
+        return series
+
+    def get(self, city_id):
+        """
+        Return a current series for a city, loading it if needed. None for a
+        city that does not exist, or when the cache is disabled.
+        """
+        if not self.enabled:
+            return None
+        city_id = int(city_id)
+        series = self.peek(city_id)
+        if series is None:
+            series = self.load([city_id]).get(city_id)
+        return series
+
+    def load(self, city_ids):
+        """Read the series of ``city_ids`` from the database (two queries) and hold them"""
+        city_ids = list(city_ids)
+        if not self.enabled or not city_ids:
+            return {}
+        capacity = self.capacity
+        # Taken before reading, so a change made meanwhile is not missed
+        versions = {city_id: city_version(city_id) for city_id in city_ids}
+        cities = City.objects.select_related('weather_stats').in_bulk(city_ids)
+        readings = newest_readings(list(cities), capacity + 1) if cities else {}
+        loaded = {}
+        for city_id, city in cities.items():
+            rows = readings.get(city_id, [])
+            series = HotSeries(city, versions[city_id], capacity, complete=len(rows) <= capacity)
+            for pk, recorded_at, *values, description in reversed(rows[:capacity]):
+                series.push(pk, to_micros(recorded_at), values, description)
+            loaded[city_id] = series
+        self.discard(set(city_ids) - set(cities))
+        self._hold(loaded)
+        return loaded
+
+    def refresh(self, city_ids):
+        """Load the held ones among ``city_ids`` again"""
+        held = [city_id for city_id in city_ids if city_id in self._series]
+        try:
+            self.load(held)
+        except DatabaseError:
+            logger.exception('Could not refresh the hot series of %d cities', len(held))
+            self.discard(held)
+
+    def append(self, readings):
+        """
+        Push newly created readings onto the rings of the cities held.
+
+        The stats rows are read again (one query), and a ring is only
+        extended when its stats count grew by exactly the readings pushed;
+        otherwise something else changed the city as well, and it is
+        loaded again instead.
+        """
+        by_city = defaultdict(list)
+        for reading in readings:
+            if reading.city_id in self._series:
+                by_city[reading.city_id].append(reading)
+        if not by_city:
+            return
+        try:
+            versions = {city_id: city_version(city_id) for city_id in by_city}
+            cities = City.objects.select_related('weather_stats').in_bulk(list(by_city))
+            updated = {}
+            stale = []
+            for city_id, new in by_city.items():
+                held = self._series.get(city_id)
+                city = cities.get(city_id)
+                before = stats_row(held.city)[2] if held is not None else None
+                after = stats_row(city)[2] if city is not None else None
+                if held is None or before is None or after != before + len(new):
+                    stale.append(city_id)
+                    continue
+                series = held.copy(city, versions[city_id])
+                try:
+                    for reading in sorted(new, key=lambda reading: (reading.recorded_at, reading.pk)):
+                        series.push_reading(reading)
+                except (TypeError, ValueError, OverflowError):
+                    stale.append(city_id)
+                    continue
+                updated[city_id] = series
+            self._hold(updated)
+            self.load(stale)
+        except DatabaseError:
+            logger.exception('Could not update the hot series of %d cities', len(by_city))
+            self.discard(by_city)
+
+    def discard(self, city_ids):
+        with self._lock:
+            for city_id in city_ids:
+                self._series.pop(city_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def memory(self):
+        """Return ``{city_id: bytes}`` held by each city's rings"""
+        return {city_id: series.nbytes for city_id, series in list(self._series.items())}
+
+    def _hold(self, loaded):
+        with self._lock:
+            for city_id, series in loaded.items():
+                self._series[city_id] = series
+                self._series.move_to_end(city_id)
+            while len(self._series) > self.max_cities:
+                self._series.popitem(last=False)
+
+
+_cache = HotSeriesCache()
+_warmed = False
+_warm_lock = threading.Lock()
+
+
+def hot_series():
+    """Return this process's HotSeriesCache"""
+    return _cache
+
+
+def warm_hot_series(count=None):
+    """
+    Load the ``count`` cities with the newest readings, WEATHER_HOT_WARM_CITIES
+    by default. Called once the server has started; a database that is not
+    reachable or migrated yet only leaves the cache cold.
+    """
+    cache = hot_series()
+    if count is None:
+        count = getattr(settings, 'WEATHER_HOT_WARM_CITIES', 0)
+    count = min(count, cache.max_cities)
+    if count < 1 or not cache.enabled:
+        return {}
+    try:
+        city_ids = list(
+            CityStats.objects.filter(last_recorded_at__isnull=False)
+            .order_by('-last_recorded_at').values_list('city_id', flat=True)[:count]
+        )
+        return cache.load(city_ids)
+    except DatabaseError:
+        logger.warning('Could not warm the hot series cache', exc_info=True)
+        return {}
+
+
+def warm_once():
+    """warm_hot_series(), the first time it is called in this process"""
+    global _warmed
+    if _warmed:
+        return
+    with _warm_lock:
+        if not _warmed:
+            warm_hot_series()
+            _warmed = True
+
+
+def warm_on_first_request(application):
+    """Wrap a WSGI application so the hot series are warmed before its first request"""
+    def warming_application(environ, start_response):
+        warm_once()
+        return application(environ, start_response)
+    return warming_application
+
+
+def warm_on_startup(application):
+    """
+    Wrap an ASGI application so the hot series are warmed on the lifespan
+    startup event, or before the first request under servers without one.
+    """
+    async def warming_application(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await sync_to_async(warm_once)()
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if not _warmed:
+            await sync_to_async(warm_once)()
+        await application(scope, receive, send)
+    return warming_application
+
+
+def hot_page_validators(request, pk, **kwargs):
+    """city_page_validators() that reads them from the hot series when it can"""
+    series = hot_series().get(pk)
+    if series is None:
+        return city_validators(pk)
+    return series.validators
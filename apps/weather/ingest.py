@@ -0,0 +1,322 @@
+"""
+Bulk ingestion of weather observations with idempotent upserts.
+
+Records are read as a stream, validated, resolved to cities through an
+in-memory lookup and written in bounded batches. A reading that already
+exists for the same (city, recorded_at) is updated in place, so re-running
+an ingest is safe. On PostgreSQL each batch is COPYed into a temporary
+staging table and merged with INSERT ... ON CONFLICT, on SQLite the same
+statement is run with executemany, and elsewhere it goes through
+bulk_create(update_conflicts=True).
+"""
+import csv
+import gzip
+import io
+import json
+import time
+from datetime import timezone as dt_timezone
+from decimal import Decimal, InvalidOperation
+
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from apps.weather.caching import bump_locations
+from apps.weather.models import City, WeatherData
+from apps.weather.signals import batched, readings_changed
+from apps.weather.streams import publish_rows, publishing
+
+DEFAULT_BATCH_SIZE = 10000
+
+# Column order of a parsed reading and of the staging table
+READING_FIELDS = (
+    'city_id', 'recorded_at', 'temperature', 'humidity', 'pressure', 'wind_speed', 'description',
+)
+UPDATE_FIELDS = ['temperature', 'humidity', 'pressure', 'wind_speed', 'description', 'updated_at']
+
+
+class IngestError(ValueError):
+    """A record that cannot be ingested"""
+
+
+def open_records(path, fmt=None):
+    """
+    Yield raw records (dicts) from a CSV or NDJSON file, optionally gzipped.
+
+    The format is taken from the file extension unless ``fmt`` is given.
+    """
+    name = path[:-3] if path.endswith('.gz') else path
+    fmt = fmt or ('csv' if name.endswith('.csv') else 'ndjson')
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8', newline='') as handle:
+        if fmt == 'csv':
+            yield from csv.DictReader(handle)
+        else:
+            for line in handle:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _decimal(record, field, limit=Decimal('1000')):
+    try:
+        value = Decimal(str(record[field])).quantize(Decimal('0.01'))
+    except (KeyError, InvalidOperation, TypeError):
+        raise IngestError(f"'{field}' must be a number")
+    if abs(value) >= limit:
+        raise IngestError(f"'{field}' is out of range")
+    return value
+
+
+def _integer(record, field, minimum=None, maximum=None):
+    try:
+        value = int(float(record[field]))
+    except (KeyError, TypeError, ValueError):
+        raise IngestError(f"'{field}' must be an integer")
+    if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+        raise IngestError(f"'{field}' must be between {minimum} and {maximum}")
+    return value
+
+
+def parse_timestamp(value):
+    """Parse an ISO timestamp; naive values are taken as UTC"""
+    recorded_at = parse_datetime(value) if isinstance(value, str) else None
+    if recorded_at is None:
+        raise IngestError("'recorded_at' must be an ISO datetime")
+    if timezone.is_naive(recorded_at):
+        recorded_at = timezone.make_aware(recorded_at, dt_timezone.utc)
+    return recorded_at
+
+
+def parse_reading(record, city_id):
+    """Validate one raw record like the model validators do; return a READING_FIELDS tuple"""
+    description = str(record.get('description') or '')
+    if len(description) > 200:
+        raise IngestError("'description' is longer than 200 characters")
+    return (
+        city_id,
+        parse_timestamp(record.get('recorded_at')),
+        _decimal(record, 'temperature'),
+        _integer(record, 'humidity', 0, 100),
+        _integer(record, 'pressure'),
+        _decimal(record, 'wind_speed'),
+        description,
+    )
+
+
+class CityResolver:
+    """
+    In-memory (name, country) -> city id lookup, loaded with one query.
+
+    Unknown cities are created in bulk when the record carries coordinates.
+    """
+    def __init__(self, create=True):
+        self.create = create
+        self.ids = {
+            self.key(name, country): pk
+            for pk, name, country in City.objects.values_list('pk', 'name', 'country')
+        }
+
+    @staticmethod
+    def key(name, country):
+        return (str(name).strip().casefold(), str(country).strip().casefold())
+
+    def resolve(self, records):
+        """Return the city id for each record (None if unknown), creating cities as needed"""
+        keys = [self.key(r.get('city', ''), r.get('country', '')) for r in records]
+        if self.create:
+            missing = {}
+            for key, record in zip(keys, records):
+                if key not in self.ids and key not in missing and key[0]:
+                    city = self._new_city(record)
+                    if city is not None:
+                        missing[key] = city
+            if missing:
+                City.objects.bulk_create(missing.values(), ignore_conflicts=True)
+                # bulk_create sends no post_save for the receivers to see
+                bump_locations()
+                self._reload(missing)
+        return [self.ids.get(key) for key in keys]
+
+    def _new_city(self, record):
+        try:
+            latitude = Decimal(str(record['latitude']))
+            longitude = Decimal(str(record['longitude']))
+        except (KeyError, InvalidOperation, TypeError):
+            return None
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            return None
+        return City(
+            name=str(record['city']).strip(),
+            country=str(record.get('country', '')).strip(),
+            latitude=latitude,
+            longitude=longitude,
+        )
+
+    def _reload(self, cities):
+        names = {city.name for city in cities.values()}
+        for pk, name, country in City.objects.filter(name__in=names).values_list('pk', 'name', 'country'):
+            self.ids[self.key(name, country)] = pk
+
+
+def upsert_readings(readings, use_copy=None):
+    """
+    Insert or update READING_FIELDS tuples in one statement batch.
+
+    Duplicate (city, recorded_at) keys inside the batch keep the last one.
+    The caller is responsible for reporting the change (readings_changed).
+    """
+    unique = {}
+    for reading in readings:
+        unique[(reading[0], reading[1])] = reading
+    readings = list(unique.values())
+    if not readings:
+        return 0
+    if use_copy is None:
+        use_copy = connection.vendor == 'postgresql'
+    with transaction.atomic():
+        if use_copy:
+            _copy_upsert(readings)
+        elif connection.vendor == 'sqlite':
+            _executemany_upsert(readings)
+        else:
+            now = timezone.now()
+            WeatherData.objects.bulk_create(
+                [
+                    WeatherData(**dict(zip(READING_FIELDS, reading)), created_at=now, updated_at=now)
+                    for reading in readings
+                ],
+                update_conflicts=True,
+                unique_fields=['city', 'recorded_at'],
+                update_fields=UPDATE_FIELDS,
+            )
+    return len(readings)
+
+
+def new_readings(readings):
+    """The READING_FIELDS tuples whose (city, recorded_at) is not stored yet"""
+    if not readings:
+        return []
+    times = [reading[1] for reading in readings]
+    stored = set(WeatherData.objects.filter(
+        city_id__in={reading[0] for reading in readings},
+        recorded_at__range=(min(times), max(times)),
+    ).values_list('city_id', 'recorded_at'))
+    return [reading for reading in readings if (reading[0], reading[1]) not in stored]
+
+
+def _upsert_sql(source):
+    table = connection.ops.quote_name(WeatherData._meta.db_table)
+    columns = ', '.join(READING_FIELDS)
+    updates = ', '.join(f'{field} = EXCLUDED.{field}' for field in UPDATE_FIELDS)
+    return (
+        f'INSERT INTO {table} ({columns}, created_at, updated_at) {source} '
+        f'ON CONFLICT (city_id, recorded_at) DO UPDATE SET {updates}'
+    )
+
+
+def _executemany_upsert(readings):
+    """Upsert with one prepared statement, skipping per-row model overhead"""
+    now = connection.ops.adapt_datetimefield_value(timezone.now())
+    adapt = connection.ops.adapt_datetimefield_value
+    placeholders = ', '.join(['%s'] * (len(READING_FIELDS) + 2))
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            _upsert_sql(f'VALUES ({placeholders})'),
+            [(city_id, adapt(recorded_at), *values, now, now)
+             for city_id, recorded_at, *values in readings],
+        )
+
+
+def _copy_upsert(readings):
+    """COPY a batch into a session-local staging table, then merge it"""
+    columns = ', '.join(READING_FIELDS)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for reading in readings:
+        writer.writerow([
+            value.isoformat() if hasattr(value, 'isoformat') else value for value in reading
+        ])
+    data = buffer.getvalue()
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'CREATE TEMP TABLE IF NOT EXISTS weather_ingest_staging ('
+            'city_id bigint, recorded_at timestamptz, temperature numeric(5, 2), '
+            'humidity integer, pressure integer, wind_speed numeric(5, 2), '
+            'description varchar(200)) ON COMMIT DELETE ROWS'
+        )
+        # An unquoted empty CSV field is NULL to COPY; description is NOT NULL
+        copy_sql = (
+            f'COPY weather_ingest_staging ({columns}) FROM STDIN '
+            'WITH (FORMAT csv, FORCE_NOT_NULL (description))'
+        )
+        raw = cursor.cursor
+        if hasattr(raw, 'copy_expert'):  # psycopg2
+            raw.copy_expert(copy_sql, io.StringIO(data))
+        else:  # psycopg 3
+            with raw.copy(copy_sql) as copy:
+                copy.write(data)
+        cursor.execute(_upsert_sql(f'SELECT {columns}, now(), now() FROM weather_ingest_staging'))
+
+
+class Ingestor:
+    """
+    Stream raw records into WeatherData in bounded batches.
+
+    Each batch is its own transaction, so a bad batch does not undo the
+    ones before it. Stats, caches and other listeners are told about the
+    touched cities once, when the whole run is done.
+    """
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, create_cities=True, use_copy=None):
+        self.batch_size = batch_size
+        self.use_copy = use_copy
+        self.cities = CityResolver(create=create_cities)
+        self.written = 0
+        self.skipped = 0
+        self.errors = []
+        self.city_ids = set()
+        self.elapsed = 0.0
+
+    @property
+    def rows_per_second(self):
+        return self.written / self.elapsed if self.elapsed else 0.0
+
+    def ingest(self, records):
+        started = time.perf_counter()
+        try:
+            with batched():
+                batch = []
+                for record in records:
+                    batch.append(record)
+                    if len(batch) >= self.batch_size:
+                        self._write(batch)
+                        batch = []
+                if batch:
+                    self._write(batch)
+        finally:
+            self.elapsed += time.perf_counter() - started
+            self.flush()
+        return self
+
+    def flush(self):
+        """Report the cities written so far to the readings_changed listeners"""
+        if self.city_ids:
+            readings_changed.send(sender=WeatherData, city_ids=self.city_ids)
+            self.city_ids = set()
+
+    def _write(self, records):
+        readings = []
+        for record, city_id in zip(records, self.cities.resolve(records)):
+            try:
+                if city_id is None:
+                    raise IngestError(f"Unknown city '{record.get('city')}'")
+                readings.append(parse_reading(record, city_id))
+            except IngestError as e:
+                self.skipped += 1
+                if len(self.errors) < 100:
+                    self.errors.append(str(e))
+        added = new_readings(readings) if publishing() else []
+        self.written += upsert_readings(readings, self.use_copy)
+        self.city_ids.update(reading[0] for reading in readings)
+        publish_rows(added)
@@ -0,0 +1,482 @@
+"""
+Live ingestion of weather readings posted by station feeds.
+
+A POSTed batch of NDJSON records is validated column by column with NumPy:
+the range checks mirror the model validators (humidity 0-100, latitude and
+longitude within the globe, decimals that fit their five digits) and run
+once per batch instead of once per record through ``full_clean``. Records
+name their city by id, or by its exact coordinates, both resolved against
+the in-process city index (see spatial.py) without a query.
+
+Feeds resend overlapping windows, so readings are checked against a Bloom
+filter of the (city, recorded_at) keys this process has already taken.
+A key the filter has never seen is new for certain and costs nothing; only
+the few it reports as possibly seen are looked up, in one query, and
+skipped if the database has them.
+
+Accepted readings are handed to a background writer and the request
+returns at once. The writer groups whatever has arrived into batches of
+WEATHER_LIVE_BATCH_SIZE and writes each with one upsert (see ingest.py),
+reporting the touched cities once per batch.
+"""
+import atexit
+import json
+import logging
+import math
+import threading
+from decimal import Decimal
+
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import RequestDataTooBig
+from django.db import DataError, IntegrityError, close_old_connections, connection
+
+from apps.weather.ingest import IngestError, new_readings, parse_timestamp, upsert_readings
+from apps.weather.models import WeatherData
+from apps.weather.pagination import EPOCH, MICROSECOND
+from apps.weather.signals import batched, readings_changed
+from apps.weather.spatial import city_index
+from apps.weather.streams import publish_rows, publishing
+
+logger = logging.getLogger(__name__)
+
+MAX_ERRORS = 100
+# Largest value of a DecimalField(max_digits=5, decimal_places=2)
+DECIMAL_LIMIT = 1000
+INTEGER_LIMIT = 2 ** 31
+
+
+class BloomFilter:
+    """
+    A fixed-size set of int64 keys that may answer "maybe" for a key it was
+    never given, at roughly ``error_rate``, but never "no" for one it was.
+
+    Once it holds ``capacity`` keys its error rate would start to climb, so
+    it starts over empty.
+    """
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        bits = math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.size = max(64, bits)
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+        self.count = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _mix(values):
+        # splitmix64 finaliser; uint64 arithmetic wraps around
+        values = values.copy()
+        values ^= values >> np.uint64(30)
+        values *= np.uint64(0xBF58476D1CE4E5B9)
+        values ^= values >> np.uint64(27)
+        values *= np.uint64(0x94D049BB133111EB)
+        values ^= values >> np.uint64(31)
+        return values
+
+    def _positions(self, keys):
+        """Return an (n, hashes) array of bit positions, by double hashing"""
+        keys = np.asarray(keys, dtype=np.int64).astype(np.uint64)
+        first = self._mix(keys)
+        second = self._mix(keys ^ np.uint64(0x9E3779B97F4A7C15)) | np.uint64(1)
+        steps = np.arange(self.hashes, dtype=np.uint64)
+        return (first[:, None] + steps[None, :] * second[:, None]) % np.uint64(self.size)
+
+    def __contains__(self, key):
+        return bool(self.contains([key])[0])
+
+    def __len__(self):
+        return self.count
+
+    def contains(self, keys):
+        """Return a bool array: False where a key was certainly never added"""
+        positions = self._positions(keys)
+        set_bits = (self.bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        return set_bits.all(axis=1)
+
+    def add(self, keys):
+        positions = self._positions(keys).ravel()
+        with self._lock:
+            if self.count + len(keys) > self.capacity:
+                self.bits[:] = 0
+                self.count = 0
+            np.bitwise_or.at(
+                self.bits, positions >> np.uint64(3),
+                np.left_shift(1, positions & np.uint64(7)).astype(np.uint8),
+            )
+            self.count += len(keys)
+
+
+def reading_keys(city_ids, micros):
+    """
+    Fold (city id, recorded_at in microseconds) into one int64 key per
+    reading for the Bloom filter; distinct readings may rarely share a key.
+    """
+    city_ids = np.asarray(city_ids, dtype=np.int64)
+    micros = np.asarray(micros, dtype=np.int64)
+    return micros * np.int64(1_000_003) + city_ids
+
+
+def _numbers(records, field):
+    """Return a float64 column of ``field``; NaN where it is missing or not a number"""
+    column = np.full(len(records), np.nan)
+    for i, record in enumerate(records):
+        value = record.get(field)
+        if value is None or isinstance(value, bool):
+            continue
+        try:
+            column[i] = float(value)
+        except (TypeError, ValueError):
+            pass
+    return column
+
+
+class Batch:
+    """
+    A posted batch of records checked as NumPy columns.
+
+    ``valid`` marks the records that passed; ``errors`` lists up to
+    MAX_ERRORS ``{'line', 'error'}`` entries for the others, where ``line``
+    counts from 1 over the non-blank lines of the body.
+    """
+    def __init__(self, records):
+        self.records = records
+        self.valid = np.ones(len(records), dtype=bool)
+        self.errors = []
+        self.city_ids = np.full(len(records), -1, dtype=np.int64)
+        self.micros = np.zeros(len(records), dtype=np.int64)
+        self.recorded_at = [None] * len(records)
+        self.columns = {}
+
+    @classmethod
+    def parse(cls, lines):
+        """Decode NDJSON ``lines``; undecodable ones are rejected, not fatal"""
+        records = []
+        broken = []
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            if not isinstance(record, dict):
+                broken.append(len(records))
+                record = {}
+            records.append(record)
+        batch = cls(records)
+        batch.reject(np.isin(np.arange(len(records)), broken), 'Each line must be a JSON object')
+        return batch.validate()
+
+    def __len__(self):
+        return len(self.records)
+
+    def reject(self, mask, message):
+        """Mark the still valid records in ``mask`` as invalid with ``message``"""
+        mask = mask & self.valid
+        for position in np.flatnonzero(mask)[:MAX_ERRORS - len(self.errors)]:
+            self.errors.append({'line': int(position) + 1, 'error': message})
+        self.valid &= ~mask
+
+    def validate(self):
+        if not len(self):
+            return self
+        columns = {field: _numbers(self.records, field) for field in (
+            'city', 'latitude', 'longitude', 'temperature', 'humidity', 'pressure', 'wind_speed',
+        )}
+
+        # The model validators, one comparison per column. Decimals are
+        # checked as they will be stored, after rounding to two places
+        for field in ('temperature', 'wind_speed'):
+            columns[field] = np.round(columns[field], 2)
+            self.reject(np.isnan(columns[field]), f"'{field}' must be a number")
+            self.reject(np.abs(columns[field]) >= DECIMAL_LIMIT, f"'{field}' is out of range")
+        for field, low, high in (('humidity', 0, 100), ('pressure', -INTEGER_LIMIT, INTEGER_LIMIT - 1)):
+            self.reject(np.isnan(columns[field]) | (columns[field] != np.trunc(columns[field])),
+                        f"'{field}' must be an integer")
+            self.reject(~((columns[field] >= low) & (columns[field] <= high)),
+                        f"'{field}' must be between {low} and {high}")
+        for field, limit in (('latitude', 90), ('longitude', 180)):
+            given = ~np.isnan(columns[field])
+            self.reject(given & (np.abs(columns[field]) > limit),
+                        f"'{field}' must be between {-limit} and {limit}")
+        lengths = np.array([len(str(record.get('description') or '')) for record in self.records])
+        self.reject(lengths > 200, "'description' is longer than 200 characters")
+
+        self._resolve_cities(columns)
+        self._parse_times()
+        self.columns = {
+            field: columns[field] for field in ('temperature', 'humidity', 'pressure', 'wind_speed')
+        }
+        self.errors.sort(key=lambda error: error['line'])
+        return self
+
+    def _resolve_cities(self, columns):
+        index = city_index()
+        by_id = ~np.isnan(columns['city'])
+        ids = np.where(by_id, columns['city'], -1).astype(np.int64)
+        self.reject(by_id & ~np.isin(ids, index.ids), "'city' is not a known city id")
+
+        by_location = ~by_id & ~np.isnan(columns['latitude']) & ~np.isnan(columns['longitude'])
+        self.reject(~by_id & ~by_location, "Each reading needs a 'city' id or the city's 'latitude' and 'longitude'")
+        located = np.flatnonzero(by_location & self.valid)
+        if len(located):
+            ids[located] = index.locate(columns['latitude'][located], columns['longitude'][located])
+            self.reject(by_location & (ids < 0), 'No city at these coordinates')
+        self.city_ids = ids
+
+    def _parse_times(self):
+        for position in np.flatnonzero(self.valid):
+            try:
+                recorded_at = parse_timestamp(self.records[position].get('recorded_at'))
+            except IngestError as e:
+                self.reject(np.arange(len(self)) == position, str(e))
+                continue
+            self.recorded_at[position] = recorded_at
+            self.micros[position] = (recorded_at - EPOCH) // MICROSECOND
+
+    def keys(self):
+        return reading_keys(self.city_ids, self.micros)
+
+    def readings(self, mask):
+        """Return the READING_FIELDS tuples of the records in ``mask``"""
+        positions = np.flatnonzero(mask)
+        columns = [self.columns[field][positions].tolist() for field in (
+            'temperature', 'humidity', 'pressure', 'wind_speed',
+        )]
+        return [
+            (city_id, self.recorded_at[position], Decimal(f'{temperature:.2f}'), int(humidity),
+             int(pressure), Decimal(f'{wind_speed:.2f}'), str(self.records[position].get('description') or ''))
+            for position, city_id, temperature, humidity, pressure, wind_speed in zip(
+                positions.tolist(), self.city_ids[positions].tolist(), *columns,
+            )
+        ]
+
+
+def valid_reading(reading):
+    """Whether a READING_FIELDS tuple passes the checks Batch.validate makes"""
+    _, recorded_at, temperature, humidity, pressure, wind_speed, description = reading
+    return (
+        recorded_at is not None
+        and abs(temperature) < DECIMAL_LIMIT and abs(wind_speed) < DECIMAL_LIMIT
+        and 0 <= humidity <= 100 and -INTEGER_LIMIT <= pressure < INTEGER_LIMIT
+        and description is not None and len(description) <= 200
+    )
+
+
+def body_lines(stream, max_bytes=None, max_lines=None, chunk_size=64 * 1024):
+    """
+    Yield the decoded lines of a request body read in chunks, so no line is
+    read whole before it is counted. Raises RequestDataTooBig once the body
+    passes ``max_bytes`` or holds more than ``max_lines`` non-blank lines.
+    """
+    size = lines = 0
+    tail = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        size += len(chunk)
+        if max_bytes is not None and size > max_bytes:
+            raise RequestDataTooBig(f'The body is larger than {max_bytes} bytes')
+        *complete, tail = (tail + chunk).split(b'\n')
+        for line in complete:
+            if line.strip():
+                lines += 1
+                if max_lines is not None and lines > max_lines:
+                    raise RequestDataTooBig(f'The body holds more than {max_lines} readings')
+            yield line.decode('utf-8', 'replace')
+    if tail.strip():
+        if max_lines is not None and lines + 1 > max_lines:
+            raise RequestDataTooBig(f'The body holds more than {max_lines} readings')
+        yield tail.decode('utf-8', 'replace')
+
+
+def stored(city_ids, micros):
+    """Return a bool array: which of these (city, recorded_at) readings are in the database"""
+    if not len(city_ids):
+        return np.zeros(0, dtype=bool)
+    pairs = list(zip(np.asarray(city_ids).tolist(), np.asarray(micros).tolist()))
+    rows = WeatherData.objects.filter(
+        city_id__in={city_id for city_id, _ in pairs},
+        recorded_at__in={EPOCH + value * MICROSECOND for _, value in pairs},
+    ).values_list('city_id', 'recorded_at')
+    found = {(city_id, (recorded_at - EPOCH) // MICROSECOND) for city_id, recorded_at in rows}
+    return np.array([pair in found for pair in pairs], dtype=bool)
+
+
+class LiveWriter:
+    """
+    Collects accepted readings and writes them in large upserts.
+
+    With WEATHER_LIVE_WRITER_THREAD a daemon thread writes a batch as soon
+    as WEATHER_LIVE_BATCH_SIZE readings are waiting, or every
+    WEATHER_LIVE_FLUSH_SECONDS; otherwise nothing is written until
+    ``drain()`` is called. At most WEATHER_LIVE_MAX_PENDING readings wait,
+    after which ``submit()`` refuses more.
+    """
+    def __init__(self):
+        self.seen = BloomFilter(self.setting('WEATHER_LIVE_FILTER_CAPACITY', 1_000_000))
+        self.written = 0
+        self.failed = 0
+        self._pending = []
+        self._condition = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = None
+
+    @staticmethod
+    def setting(name, default):
+        return getattr(settings, name, default)
+
+    @property
+    def batch_size(self):
+        return self.setting('WEATHER_LIVE_BATCH_SIZE', 10000)
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def accept(self, batch):
+        """
+        Queue the valid, not yet stored readings of ``batch``.
+
+        Returns ``(accepted, duplicates)``, or None when the queue is full.
+        """
+        keys = batch.keys()
+        # A reading repeated inside the batch is written once, its last time
+        positions = np.flatnonzero(batch.valid)[::-1]
+        pairs = np.column_stack((batch.city_ids[positions], batch.micros[positions]))
+        _, last = np.unique(pairs, axis=0, return_index=True)
+        unique = np.zeros(len(batch), dtype=bool)
+        unique[positions[last]] = True
+        duplicates = len(positions) - len(last)
+
+        maybe = np.zeros(len(batch), dtype=bool)
+        maybe[unique] = self.seen.contains(keys[unique])
+        if maybe.any():
+            known = np.zeros(len(batch), dtype=bool)
+            known[maybe] = stored(batch.city_ids[maybe], batch.micros[maybe])
+            duplicates += int(known.sum())
+            unique &= ~known
+
+        readings = batch.readings(unique)
+        if not self.submit(readings):
+            return None
+        self.seen.add(keys[unique])
+        return len(readings), duplicates
+
+    def submit(self, readings):
+        """Queue READING_FIELDS tuples; False if that would overflow the queue"""
+        if not readings:
+            return True
+        with self._condition:
+            if len(self._pending) + len(readings) > self.setting('WEATHER_LIVE_MAX_PENDING', 200000):
+                return False
+            self._pending.extend(readings)
+            if len(self._pending) >= self.batch_size:
+                self._condition.notify()
+        if self.setting('WEATHER_LIVE_WRITER_THREAD', True):
+            self._start()
+        return True
+
+    def drain(self):
+        """Write everything queued so far, in this thread; return the rows written"""
+        written = 0
+        while True:
+            with self._condition:
+                batch = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+            if not batch:
+                return written
+            written += self._write(batch)
+
+    def _write(self, readings):
+        with self._write_lock:
+            readings = self._usable(readings)
+            try:
+                # The filter misses keys stored by other processes or before a restart
+                added = new_readings(readings) if publishing() else []
+                stored = self._upsert(readings)
+            except Exception:
+                # Not the rows' fault (a lost connection, say), so not retried row by row
+                logger.exception('Could not write %d live readings', len(readings))
+                self.failed += len(readings)
+                return 0
+            if stored:
+                keys = {(reading[0], reading[1]) for reading in stored}
+                try:
+                    readings_changed.send(sender=WeatherData, city_ids={reading[0] for reading in stored})
+                    publish_rows([reading for reading in added if (reading[0], reading[1]) in keys])
+                except Exception:
+                    logger.exception('Could not report %d live readings', len(stored))
+            self.written += len(stored)
+            return len(stored)
+
+    def _usable(self, readings):
+        """
+        Drop the readings the database is known to refuse, without asking
+        it: cities deleted since they were accepted, values out of range.
+        """
+        known = np.isin([reading[0] for reading in readings], city_index().ids).tolist()
+        usable = [reading for reading, city in zip(readings, known) if city and valid_reading(reading)]
+        if len(usable) < len(readings):
+            logger.error('Dropped %d live readings the database would refuse', len(readings) - len(usable))
+            self.failed += len(readings) - len(usable)
+        return usable
+
+    def _upsert(self, readings):
+        """
+        Upsert ``readings``; if the database refuses the batch's data, write
+        its halves separately, down to the single readings it refuses.
+        Other errors are raised. Returns the readings stored.
+        """
+        if not readings:
+            return []
+        try:
+            with batched():
+                upsert_readings(readings)
+            return readings
+        except (IntegrityError, DataError):
+            if len(readings) == 1:
+                # The filter still has its key, but a resend is looked up
+                # in the database and accepted again since it is not there
+                logger.exception('Could not write the live reading %r', readings[0])
+                self.failed += 1
+                return []
+        middle = len(readings) // 2
+        return self._upsert(readings[:middle]) + self._upsert(readings[middle:])
+
+    def _start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._condition:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='weather-live-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        interval = self.setting('WEATHER_LIVE_FLUSH_SECONDS', 1.0)
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: len(self._pending) >= self.batch_size, interval)
+            try:
+                self.drain()
+            finally:
+                close_old_connections()
+
+
+_writer = LiveWriter()
+
+
+def live_writer():
+    """Return this process's LiveWriter"""
+    return _writer
+
+
+@atexit.register
+def _drain_at_exit():
+    # Readings already acknowledged to a feed are written before exiting
+    if _writer.pending:
+        _writer.drain()
+        connection.close()
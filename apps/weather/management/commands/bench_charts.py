@@ -0,0 +1,89 @@
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+import multiprocessing
+import pytz
+from django.core.management.base import BaseCommand
+from apps.weather import renderer
+from apps.weather.utils import generate_temperature_chart
+
+Reading = namedtuple('Reading', ['recorded_at', 'temperature'])
+
+
+class Command(BaseCommand):
+    help = 'Compares charts per second of the pyplot chart function and the chart renderer'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--charts',
+            type=int,
+            default=50,
+            help='Number of charts to render per variant'
+        )
+        parser.add_argument(
+            '--points',
+            type=int,
+            default=10,
+            help='Number of readings in each chart'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=multiprocessing.cpu_count(),
+            help='Threads/processes used by the parallel variants'
+        )
+
+    def handle(self, *args, **options):
+        charts = options['charts']
+        workers = options['workers']
+        base_time = datetime.now(pytz.UTC)
+        # A different series per chart, like different cities or pages
+        datasets = [
+            [
+                Reading(base_time + timedelta(hours=i), 15 + (i * 7 + n) % 11)
+                for i in range(options['points'])
+            ]
+            for n in range(charts)
+        ]
+        jobs = [
+            ('temperature', *self._job_data(readings)) for readings in datasets
+        ]
+
+        results = {}
+        results['pyplot (generate_temperature_chart)'] = self._time(
+            lambda: [generate_temperature_chart(readings) for readings in datasets]
+        )
+        results['renderer, 1 thread'] = self._time(
+            lambda: [renderer.render(*job) for job in jobs]
+        )
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results[f'renderer, {workers} threads'] = self._time(
+                lambda: list(executor.map(lambda job: renderer.render(*job), jobs))
+            )
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context('spawn')
+        ) as executor:
+            # Warm the workers up so process start-up is not measured
+            renderer.render_many(jobs[:workers], executor=executor)
+            results[f'renderer, {workers} processes'] = self._time(
+                lambda: renderer.render_many(jobs, executor=executor)
+            )
+
+        baseline = results['pyplot (generate_temperature_chart)']
+        for name, elapsed in results.items():
+            self.stdout.write(
+                f'{name:<40} {charts / elapsed:8.1f} charts/s  ({baseline / elapsed:.2f}x)'
+            )
+        self.stdout.write(self.style.SUCCESS(f'Rendered {charts} charts per variant'))
+
+    @staticmethod
+    def _job_data(readings):
+        dates, values = renderer.chart_data(readings)
+        return dates, [('temperature', values)]
+
+    @staticmethod
+    def _time(func):
+        start = time.perf_counter()
+        func()
+        return time.perf_counter() - start
@@ -0,0 +1,188 @@
+import json
+import platform
+from datetime import timedelta
+
+import django
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from apps.weather import synthetic
+from apps.weather.benchmarks import DEFAULT_THRESHOLD, compare, measure
+from apps.weather.charts import HISTORY_PAGE_SIZE
+from apps.weather.management.commands.load_weather_data import SAMPLE_CITIES
+from apps.weather.models import WeatherData
+from apps.weather.pagination import OLDER, encode_cursor
+from apps.weather.signals import batched, readings_changed
+from apps.weather.utils import generate_temperature_chart
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the weather pages and queries on growing synthetic datasets'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scales',
+            type=int,
+            nargs='+',
+            default=[10, 100, 1000, 10000],
+            help='City counts to seed and measure, in increasing order'
+        )
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=7,
+            help='Days of history per city'
+        )
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=60,
+            help='Minutes between readings'
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=3,
+            help='Timed runs per measurement (the fastest is reported)'
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Random seed of the synthetic dataset'
+        )
+        parser.add_argument(
+            '--output',
+            help='Write the results to this JSON file'
+        )
+        parser.add_argument(
+            '--compare',
+            help='Baseline JSON file from an earlier run; exit with an error on regressions'
+        )
+        parser.add_argument(
+            '--threshold',
+            type=float,
+            default=DEFAULT_THRESHOLD,
+            help='Allowed slowdown/memory growth over the baseline, as a fraction'
+        )
+        parser.add_argument(
+            '--in-place',
+            action='store_true',
+            help='Seed the configured database instead of a throwaway test database'
+        )
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['compare']:
+            try:
+                with open(options['compare']) as handle:
+                    baseline = json.load(handle)['results']
+            except (OSError, ValueError, KeyError) as e:
+                raise CommandError(f"Cannot read baseline {options['compare']}: {e}")
+
+        old_name = None
+        if not options['in_place']:
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            results = self.run_benchmarks(options)
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        for result in results:
+            self.stdout.write(
+                f'{result.scale:>6} cities  {result.name:<30} {result.time_ms:10.1f}ms '
+                f'{result.queries:5} queries {result.peak_kb:10.1f}KB'
+            )
+
+        if options['output']:
+            with open(options['output'], 'w') as handle:
+                json.dump({
+                    'meta': {
+                        'created_at': timezone.now().isoformat(),
+                        'python': platform.python_version(),
+                        'django': django.get_version(),
+                        'database': connection.vendor,
+                        'days': options['days'],
+                        'interval': options['interval'],
+                        'seed': options['seed'],
+                    },
+                    'results': [result._asdict() for result in results],
+                }, handle, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Wrote results to {options['output']}"))
+
+        if baseline is not None:
+            regressions = [
+                (result, problems)
+                for result, _, problems in compare(results, baseline, options['threshold'])
+                if problems
+            ]
+            for result, problems in regressions:
+                self.stdout.write(
+                    self.style.ERROR(f'{result.scale} cities {result.name}: ' + ', '.join(problems))
+                )
+            if regressions:
+                raise CommandError(f'{len(regressions)} measurements regressed against the baseline')
+            self.stdout.write(self.style.SUCCESS('No regressions against the baseline'))
+
+    def run_benchmarks(self, options):
+        interval = timedelta(minutes=options['interval'])
+        start, end = synthetic.time_range(options['days'], interval)
+        user = get_user_model().objects.filter(username='bench-weather').first()
+        if user is None:
+            # No password: the account can only be used through force_login
+            user = get_user_model().objects.create_superuser('bench-weather', None)
+        client = Client()
+        admin_client = Client()
+        admin_client.force_login(user)
+
+        results = []
+        seeded = []
+        for scale in sorted(options['scales']):
+            # Each scale only seeds the cities the previous one did not have
+            specs = synthetic.city_specs(scale, options['seed'], SAMPLE_CITIES)
+            cities = synthetic.create_cities(specs)[len(seeded):]
+            with batched():
+                synthetic.load_shard(cities, start, end, interval, options['seed'])
+            readings_changed.send(sender=WeatherData, city_ids={city[1] for city in cities})
+            seeded += cities
+            self.stdout.write(f'Seeded {scale} cities')
+
+            results += self.measure_scale(scale, seeded[0][1], client, admin_client, options['repeat'])
+        return results
+
+    def measure_scale(self, scale, city_id, client, admin_client, repeat):
+        detail_url = reverse('city_detail', args=[city_id])
+        readings = list(
+            WeatherData.objects.filter(city_id=city_id).order_by('-recorded_at', '-id')[:HISTORY_PAGE_SIZE]
+        )
+        oldest = WeatherData.objects.filter(city_id=city_id).order_by('recorded_at', 'id')[HISTORY_PAGE_SIZE]
+        deep_cursor = encode_cursor(OLDER, oldest.recorded_at, oldest.pk)
+
+        benchmarks = [
+            ('city_list', lambda: self.fetch(client, reverse('city_list'))),
+            ('city_detail', lambda: self.fetch(client, detail_url)),
+            ('city_detail_deep_page', lambda: self.fetch(client, detail_url, {'cursor': deep_cursor})),
+            ('temperature_chart', lambda: generate_temperature_chart(readings)),
+            # The same readings, row-wise and column-wise
+            ('city_export_ndjson', lambda: self.fetch(client, reverse('city_export_ndjson', args=[city_id]))),
+            ('api_weather_columns',
+             lambda: self.fetch(client, reverse('weather_columns'), {'cities': city_id})),
+            ('admin_city_changelist',
+             lambda: self.fetch(admin_client, reverse('admin:weather_city_changelist'))),
+            ('admin_weatherdata_changelist',
+             lambda: self.fetch(admin_client, reverse('admin:weather_weatherdata_changelist'))),
+        ]
+        return [measure(scale, name, func, repeat) for name, func in benchmarks]
+
+    @staticmethod
+    def fetch(client, url, params=None):
+        response = client.get(url, params)
+        if response.status_code != 200:
+            raise CommandError(f'GET {url} returned {response.status_code}')
+        # Streaming responses only do their work when consumed
+        return response.getvalue() if response.streaming else response.content
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+from datetime import timezone as dt_timezone
+from django.utils.dateparse import parse_datetime
+from django.utils import timezone
+from apps.weather.rollups import RESOLUTIONS, build_rollups
+
+
+class Command(BaseCommand):
+    help = 'Builds hourly, daily and monthly weather rollups incrementally'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--resolution',
+            choices=[resolution.name for resolution in RESOLUTIONS],
+            action='append',
+            help='Only build this resolution (can be repeated)'
+        )
+        parser.add_argument(
+            '--since',
+            help='Rebuild buckets from this ISO timestamp instead of the last processed one'
+        )
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Rebuild every bucket that still has source rows'
+        )
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            since = parse_datetime(options['since'])
+            if since is None:
+                raise CommandError(f"Invalid --since timestamp: {options['since']}")
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since, dt_timezone.utc)
+
+        names = options['resolution'] or [resolution.name for resolution in RESOLUTIONS]
+        # Coarser rollups are built from finer ones, so keep the dependency order
+        resolutions = [resolution for resolution in RESOLUTIONS if resolution.name in names]
+
+        try:
+            for resolution in resolutions:
+                written = build_rollups(
+                    resolution, since=since, resume=not options['full']
+                )
+                self.stdout.write(
+                    self.style.SUCCESS(f'Built {written} {resolution.name} buckets')
+                )
+        except Exception as e:
+            self.stdout.write(
+                self.style.ERROR(f'Error building weather rollups: {str(e)}')
+            )
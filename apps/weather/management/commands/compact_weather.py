@@ -0,0 +1,103 @@
+from django.core.management.base import BaseCommand, CommandError
+from datetime import timezone as dt_timezone
+from django.utils.dateparse import parse_datetime
+from django.utils import timezone
+from apps.weather.compaction import DEFAULT_BATCH_SIZE, LEVELS, compact_all, retention_policy
+
+
+class Command(BaseCommand):
+    help = 'Folds old raw readings and rollups into coarser rollups and deletes them'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--keep',
+            action='append',
+            default=[],
+            metavar='LEVEL=DAYS',
+            help=(
+                'Days to keep a level (raw, hour, day or month) for, overriding '
+                'WEATHER_RETENTION; "forever" keeps it all (can be repeated)'
+            )
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=DEFAULT_BATCH_SIZE,
+            help='Rows deleted per transaction'
+        )
+        parser.add_argument(
+            '--pause',
+            type=float,
+            default=0,
+            help='Seconds to sleep between batches, to leave room for other writers'
+        )
+        parser.add_argument(
+            '--now',
+            help='Compute the cutoffs from this ISO timestamp instead of the current time'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report what would be deleted'
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive')
+        now = None
+        if options['now']:
+            now = parse_datetime(options['now'])
+            if now is None:
+                raise CommandError(f"Invalid --now timestamp: {options['now']}")
+            if timezone.is_naive(now):
+                now = timezone.make_aware(now, dt_timezone.utc)
+
+        try:
+            policy = retention_policy(self.parse_keep(options['keep']))
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        results = compact_all(
+            policy, now, options['batch_size'], options['pause'], options['dry_run']
+        )
+        verb = 'Would delete' if options['dry_run'] else 'Deleted'
+        total_rows = total_bytes = 0
+        for result in results:
+            self.stdout.write(
+                f'{verb} {result.rows} {result.level} rows before {result.cutoff.isoformat()}'
+                f' ({self.format_bytes(result.bytes)})'
+            )
+            total_rows += result.rows
+            total_bytes += result.bytes or 0
+        for level in LEVELS:
+            if policy[level.name] is None:
+                self.stdout.write(f'Keeping all {level.name} rows')
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {total_rows} rows in total, reclaiming {self.format_bytes(total_bytes)}'
+        ))
+
+    @staticmethod
+    def parse_keep(values):
+        overrides = {}
+        for value in values:
+            level, _, days = value.partition('=')
+            if days == 'forever':
+                overrides[level] = None
+                continue
+            try:
+                overrides[level] = int(days)
+            except ValueError:
+                raise CommandError(f'Invalid --keep {value!r}; expected LEVEL=DAYS')
+        return overrides
+
+    @staticmethod
+    def format_bytes(size):
+        if size is None:
+            return 'size unknown'
+        for unit in ('bytes', 'KB', 'MB'):
+            if size < 1024:
+                break
+            size /= 1024
+        else:
+            unit = 'GB'
+        return f'~{size:.1f} {unit}'
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+from apps.weather.hotcache import hot_series, warm_hot_series
+
+
+class Command(BaseCommand):
+    help = 'Loads the hot series cache like a server does at startup and reports its memory per city'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--cities',
+            type=int,
+            help='Cities to load (default: WEATHER_HOT_WARM_CITIES)'
+        )
+        parser.add_argument(
+            '--top',
+            type=int,
+            default=20,
+            help='Number of cities listed, largest first; 0 lists them all'
+        )
+
+    def handle(self, *args, **options):
+        cache = hot_series()
+        if not cache.enabled:
+            raise CommandError('The hot series cache is disabled (WEATHER_HOT_READINGS or WEATHER_HOT_CITIES is 0)')
+
+        loaded = warm_hot_series(options['cities'])
+        memory = cache.memory()
+        total = sum(memory.values())
+        readings = sum(len(series) for series in loaded.values())
+
+        largest = sorted(memory.items(), key=lambda item: item[1], reverse=True)
+        if options['top']:
+            largest = largest[:options['top']]
+        for city_id, nbytes in largest:
+            series = loaded[city_id]
+            self.stdout.write(f'{series.city} (#{city_id}): {len(series)} readings, {nbytes:,} bytes')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(memory)} cities, {readings} readings, {total:,} bytes '
+            f'({cache.capacity} readings per city)'
+        ))
@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand
+from apps.weather.ingest import DEFAULT_BATCH_SIZE, Ingestor, open_records
+
+
+class Command(BaseCommand):
+    help = 'Streams CSV/NDJSON weather observation files into the database, upserting existing readings'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths',
+            nargs='+',
+            help='CSV or NDJSON files to ingest (optionally .gz)'
+        )
+        parser.add_argument(
+            '--format',
+            choices=['csv', 'ndjson'],
+            help='File format (default: guessed from the file extension)'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=DEFAULT_BATCH_SIZE,
+            help='Rows written per transaction'
+        )
+        parser.add_argument(
+            '--no-create-cities',
+            action='store_true',
+            help='Skip rows for unknown cities instead of creating them'
+        )
+        parser.add_argument(
+            '--no-copy',
+            action='store_true',
+            help='Use bulk_create upserts even on PostgreSQL'
+        )
+
+    def handle(self, *args, **options):
+        ingestor = Ingestor(
+            batch_size=options['batch_size'],
+            create_cities=not options['no_create_cities'],
+            use_copy=False if options['no_copy'] else None,
+        )
+
+        try:
+            for path in options['paths']:
+                ingestor.ingest(open_records(path, options['format']))
+            for error in ingestor.errors[:10]:
+                self.stdout.write(self.style.WARNING(f'Skipped: {error}'))
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f'Ingested {ingestor.written} rows, skipped {ingestor.skipped} '
+                    f'in {ingestor.elapsed:.1f}s ({ingestor.rows_per_second:,.0f} rows/s)'
+                )
+            )
+        except Exception as e:
+            self.stdout.write(
+                self.style.ERROR(f'Error ingesting weather data: {str(e)}')
+            )
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.weather.benchmarks import load
+
+
+class Command(BaseCommand):
+    help = 'Compares the throughput and latency of the WSGI and ASGI deployments under the same load'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--wsgi',
+            help='Base URL of the server running core.wsgi'
+        )
+        parser.add_argument(
+            '--asgi',
+            help='Base URL of the server running core.asgi'
+        )
+        parser.add_argument(
+            '--paths',
+            nargs='+',
+            default=['/'],
+            help='Paths to request, in turn'
+        )
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=200,
+            help='Requests sent to each server'
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=10,
+            help='Requests in flight at once'
+        )
+
+    def handle(self, *args, **options):
+        servers = [(name, options[name]) for name in ('wsgi', 'asgi') if options[name]]
+        if not servers:
+            raise CommandError('Give --wsgi and/or --asgi base URLs')
+        if options['requests'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--requests and --concurrency must be positive')
+
+        for name, url in servers:
+            result = load(name, url, options['paths'], options['requests'], options['concurrency'])
+            self.stdout.write(
+                f'{result.name:<5} {result.per_second:8.1f} req/s  p50 {result.p50_ms:8.1f}ms  '
+                f'p95 {result.p95_ms:8.1f}ms  {result.errors} errors'
+            )
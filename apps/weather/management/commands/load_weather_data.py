@@ -1,9 +1,14 @@
 import random
-from datetime import datetime, timedelta
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
 import pytz
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.core.management.base import BaseCommand
 from django.db import transaction
 from apps.weather.models import City, WeatherData
+from apps.weather.signals import batched, readings_changed
+from apps.weather import synthetic
 
 SAMPLE_CITIES = [
     {"name": "London", "country": "UK", "lat": 51.5074, "lon": -0.1278},
@@ -34,8 +39,50 @@ class Command(BaseCommand):
             default=500,
             help='Number of weather records to generate per city'
         )
+        parser.add_argument(
+            '--cities',
+            type=int,
+            help='Scale mode: number of cities (the sample cities first, then synthetic ones)'
+        )
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=30,
+            help='Scale mode: days of history per city'
+        )
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=60,
+            help='Scale mode: minutes between readings'
+        )
+        parser.add_argument(
+            '--until',
+            help='Scale mode: ISO timestamp the history ends at (default: now)'
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Scale mode: random seed; the same seed gives the same dataset'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=synthetic.DEFAULT_BATCH_SIZE,
+            help='Scale mode: rows generated and written per batch'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Scale mode: processes to shard the cities across'
+        )
 
     def handle(self, *args, **options):
+        if options['cities']:
+            return self.load_scale(options)
+
         records_per_city = options['records_per_city']
         
         try:
@@ -96,4 +143,45 @@ class Command(BaseCommand):
         except Exception as e:
             self.stdout.write(
                 self.style.ERROR(f'Error loading weather data: {str(e)}')
-            )
\ No newline at end of file
+            )
+
+    def load_scale(self, options):
+        started = time.perf_counter()
+        interval = timedelta(minutes=options['interval'])
+
+        try:
+            until = None
+            if options['until']:
+                until = parse_datetime(options['until'])
+                if until is None:
+                    raise ValueError(f"Invalid --until timestamp: {options['until']}")
+                if timezone.is_naive(until):
+                    until = timezone.make_aware(until, dt_timezone.utc)
+            start, end = synthetic.time_range(options['days'], interval, until)
+
+            specs = synthetic.city_specs(options['cities'], options['seed'], SAMPLE_CITIES)
+            cities = synthetic.create_cities(specs)
+
+            with batched():
+                if options['workers'] > 1:
+                    written = synthetic.load_shards(
+                        cities, start, end, interval, options['seed'],
+                        options['batch_size'], options['workers']
+                    )
+                else:
+                    written = synthetic.load_shard(
+                        cities, start, end, interval, options['seed'], options['batch_size']
+                    )
+            readings_changed.send(sender=WeatherData, city_ids={city[1] for city in cities})
+
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f'Successfully created {written} weather records for {len(cities)} cities '
+                    f'in {elapsed:.1f}s ({written / elapsed if elapsed else 0:,.0f} rows/s)'
+                )
+            )
+        except Exception as e:
+            self.stdout.write(
+                self.style.ERROR(f'Error loading weather data: {str(e)}')
+            )
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from apps.weather.models import CityStats
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the per-city weather statistics rollup from WeatherData'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--city',
+            type=int,
+            action='append',
+            dest='city_ids',
+            help='Only rebuild stats for this city id (can be repeated)'
+        )
+
+    def handle(self, *args, **options):
+        city_ids = options['city_ids']
+
+        try:
+            with transaction.atomic():
+                rebuilt = CityStats.objects.rebuild(city_ids)
+            self.stdout.write(
+                self.style.SUCCESS(f'Successfully rebuilt stats for {rebuilt} cities')
+            )
+        except Exception as e:
+            self.stdout.write(
+                self.style.ERROR(f'Error rebuilding city stats: {str(e)}')
+            )
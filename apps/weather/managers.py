@@ -0,0 +1,246 @@
+from datetime import timezone as dt_timezone
+
+from django.db import models
+from django.db.models import Count, F, Max, Min, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest, Least, Trunc
+from django.utils import timezone
+
+from apps.weather.signals import batched, is_batching, readings_changed, readings_created
+
+METRICS = ('temperature', 'humidity', 'pressure', 'wind_speed')
+
+# CityStats average column for each metric that has one
+AVERAGE_FIELDS = {
+    'temperature': 'avg_temp',
+    'humidity': 'avg_humidity',
+    'wind_speed': 'avg_wind_speed',
+}
+
+EXTREMES = (
+    ('hottest_city', '-avg_temp'),
+    ('coldest_city', 'avg_temp'),
+    ('most_humid_city', '-avg_humidity'),
+    ('windiest_city', '-avg_wind_speed'),
+)
+
+
+class WeatherDataQuerySet(models.QuerySet):
+    """
+    QuerySet that reports bulk writes, which never reach post_save/post_delete
+    """
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super().bulk_create(objs, *args, **kwargs)
+        if not objs or is_batching():
+            return objs
+        if kwargs.get('ignore_conflicts') or kwargs.get('update_conflicts'):
+            # We cannot tell inserted rows from skipped or updated ones
+            readings_changed.send(
+                sender=self.model, city_ids={obj.city_id for obj in objs}
+            )
+        else:
+            readings_created.send(sender=self.model, instances=objs)
+        return objs
+
+    def update(self, **kwargs):
+        city_ids = self._affected_city_ids()
+        rows = super().update(**kwargs)
+        if rows and not is_batching():
+            if 'city' in kwargs or 'city_id' in kwargs:
+                city_ids = city_ids | self._affected_city_ids()
+            readings_changed.send(sender=self.model, city_ids=city_ids)
+        return rows
+
+    update.alters_data = True
+
+    def delete(self):
+        # The hours the deleted rows fall in, so the rollups can drop them
+        hours = set(self.order_by().annotate(
+            hour=Trunc('recorded_at', 'hour', tzinfo=dt_timezone.utc)
+        ).values_list('city_id', 'hour').distinct())
+        with batched():
+            result = super().delete()
+        if result[0] and not is_batching():
+            readings_changed.send(
+                sender=self.model, city_ids={city_id for city_id, _ in hours}, deleted=hours
+            )
+        return result
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def _affected_city_ids(self):
+        return set(self.order_by().values_list('city_id', flat=True).distinct())
+
+
+WeatherDataManager = models.Manager.from_queryset(WeatherDataQuerySet)
+
+
+class CityStatsManager(models.Manager):
+    """
+    Keeps CityStats rows in step with WeatherData
+    """
+    def apply_readings(self, readings):
+        """Fold newly inserted readings into the running totals"""
+        deltas = {}
+        for reading in readings:
+            delta = deltas.setdefault(reading.city_id, {'count': 0, 'last': None})
+            delta['count'] += 1
+            for metric in METRICS:
+                value = float(getattr(reading, metric))
+                delta[f'{metric}_sum'] = delta.get(f'{metric}_sum', 0) + value
+                delta[f'{metric}_min'] = min(delta.get(f'{metric}_min', value), value)
+                delta[f'{metric}_max'] = max(delta.get(f'{metric}_max', value), value)
+            if delta['last'] is None or reading.recorded_at > delta['last']:
+                delta['last'] = reading.recorded_at
+
+        missing = []
+        now = timezone.now()
+        for city_id, delta in deltas.items():
+            count = delta['count']
+            changes = {
+                'reading_count': F('reading_count') + count,
+                'last_recorded_at': Greatest(
+                    Coalesce(F('last_recorded_at'), Value(delta['last'])), Value(delta['last'])
+                ),
+                'updated_at': now,
+            }
+            for metric in METRICS:
+                total = delta[f'{metric}_sum']
+                low, high = delta[f'{metric}_min'], delta[f'{metric}_max']
+                changes[f'{metric}_sum'] = F(f'{metric}_sum') + total
+                changes[f'{metric}_min'] = Least(Coalesce(F(f'{metric}_min'), Value(low)), Value(low))
+                changes[f'{metric}_max'] = Greatest(Coalesce(F(f'{metric}_max'), Value(high)), Value(high))
+                if metric in AVERAGE_FIELDS:
+                    # The right-hand side sees the values from before this UPDATE
+                    changes[AVERAGE_FIELDS[metric]] = (
+                        (F(f'{metric}_sum') + total) / (F('reading_count') + count)
+                    )
+            if not self.filter(city_id=city_id).update(**changes):
+                missing.append(city_id)
+
+        if missing:
+            # No running totals yet; the city may already have history
+            self.rebuild(missing)
+
+    def remove_reading(self, reading):
+        """Take a single deleted reading out of the running totals"""
+        stats = self.filter(city_id=reading.city_id).first()
+        if stats is None:
+            return
+        touches_extreme = stats.reading_count <= 1 or any(
+            float(getattr(reading, metric)) in (
+                getattr(stats, f'{metric}_min'), getattr(stats, f'{metric}_max')
+            )
+            for metric in METRICS
+        ) or reading.recorded_at == stats.last_recorded_at
+        if touches_extreme:
+            # Min/max cannot be un-applied, so recompute this one city
+            self.rebuild([reading.city_id], create=False)
+            return
+
+        changes = {'reading_count': F('reading_count') - 1, 'updated_at': timezone.now()}
+        for metric in METRICS:
+            value = float(getattr(reading, metric))
+            changes[f'{metric}_sum'] = F(f'{metric}_sum') - value
+            if metric in AVERAGE_FIELDS:
+                changes[AVERAGE_FIELDS[metric]] = (
+                    (F(f'{metric}_sum') - value) / (F('reading_count') - 1)
+                )
+        self.filter(pk=stats.pk).update(**changes)
+
+    def rebuild(self, city_ids=None, create=True):
+        """
+        Recompute stats from WeatherData, for every city or only ``city_ids``.
+
+        With ``create=False`` existing rows are updated but none are inserted,
+        which is what delete handlers need while a City is being cascaded away.
+        """
+        from apps.weather.models import WeatherData
+
+        aggregates = {
+            'reading_count': Count('id'),
+            'last_recorded_at': Max('recorded_at'),
+        }
+        for metric in METRICS:
+            aggregates[f'{metric}_sum'] = Sum(metric)
+            aggregates[f'{metric}_min'] = Min(metric)
+            aggregates[f'{metric}_max'] = Max(metric)
+
+        rows = WeatherData.objects.order_by().values('city_id').annotate(**aggregates)
+        if city_ids is not None:
+            city_ids = set(city_ids)
+            if not city_ids:
+                return 0
+            rows = rows.filter(city_id__in=city_ids)
+
+        now = timezone.now()
+        fresh = []
+        for row in rows:
+            values = self._values_from_aggregate(row)
+            if create:
+                fresh.append(self.model(city_id=row['city_id'], **values))
+            else:
+                self.filter(city_id=row['city_id']).update(updated_at=now, **values)
+
+        if fresh:
+            self.bulk_create(
+                fresh,
+                batch_size=500,
+                update_conflicts=True,
+                unique_fields=['city'],
+                update_fields=list(self._values_from_aggregate({}).keys()) + ['updated_at'],
+            )
+
+        # Cities whose readings are all gone keep a row, reset to empty
+        seen = {row['city_id'] for row in rows}
+        stale = self.exclude(city_id__in=seen)
+        if city_ids is not None:
+            stale = stale.filter(city_id__in=city_ids)
+        stale.update(updated_at=now, **self._values_from_aggregate({}))
+        return len(seen)
+
+    def extremes_queryset(self):
+        """
+        Return one row holding the city id of each dashboard extreme.
+
+        Each extreme is a scalar ORDER BY ... LIMIT 1 subquery on an indexed
+        average column, so the cost does not grow with the number of cities.
+        """
+        subqueries = {
+            label: Subquery(
+                self.filter(**{f'{ordering.lstrip("-")}__isnull': False})
+                .order_by(ordering)
+                .values('city_id')[:1]
+            )
+            for label, ordering in EXTREMES
+        }
+        return self.order_by().annotate(**subqueries).values(*subqueries)[:1]
+
+    def extremes(self):
+        """Return ``{label: city_id}`` for every dashboard extreme, in one query"""
+        return next(
+            iter(self.extremes_queryset()), {label: None for label, _ in EXTREMES}
+        )
+
+    async def aextremes(self):
+        """Async extremes()"""
+        async for row in self.extremes_queryset():
+            return row
+        return {label: None for label, _ in EXTREMES}
+
+    @staticmethod
+    def _values_from_aggregate(row):
+        count = row.get('reading_count') or 0
+        values = {
+            'reading_count': count,
+            'last_recorded_at': row.get('last_recorded_at'),
+        }
+        for metric in METRICS:
+            total = row.get(f'{metric}_sum')
+            values[f'{metric}_sum'] = float(total) if total is not None else 0
+            for bound in ('min', 'max'):
+                value = row.get(f'{metric}_{bound}')
+                values[f'{metric}_{bound}'] = float(value) if value is not None else None
+            if metric in AVERAGE_FIELDS:
+                values[AVERAGE_FIELDS[metric]] = float(total) / count if count else None
+        return values
@@ -0,0 +1,71 @@
+# Generated by Django 5.2.18 on 2026-10-16 20:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Max, Min, Sum
+
+
+def populate_city_stats(apps, schema_editor):
+    WeatherData = apps.get_model('weather', 'WeatherData')
+    CityStats = apps.get_model('weather', 'CityStats')
+    metrics = ('temperature', 'humidity', 'pressure', 'wind_speed')
+    averages = {'temperature': 'avg_temp', 'humidity': 'avg_humidity', 'wind_speed': 'avg_wind_speed'}
+
+    aggregates = {'reading_count': Count('id'), 'last_recorded_at': Max('recorded_at')}
+    for metric in metrics:
+        aggregates[f'{metric}_sum'] = Sum(metric)
+        aggregates[f'{metric}_min'] = Min(metric)
+        aggregates[f'{metric}_max'] = Max(metric)
+
+    stats = []
+    for row in WeatherData.objects.order_by().values('city_id').annotate(**aggregates):
+        values = {'reading_count': row['reading_count'], 'last_recorded_at': row['last_recorded_at']}
+        for metric in metrics:
+            values[f'{metric}_sum'] = float(row[f'{metric}_sum'])
+            values[f'{metric}_min'] = float(row[f'{metric}_min'])
+            values[f'{metric}_max'] = float(row[f'{metric}_max'])
+            if metric in averages:
+                values[averages[metric]] = float(row[f'{metric}_sum']) / row['reading_count']
+        stats.append(CityStats(city_id=row['city_id'], **values))
+    CityStats.objects.bulk_create(stats, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weather', '0002_alter_weatherdata_unique_together'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CityStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('reading_count', models.PositiveIntegerField(default=0)),
+                ('temperature_sum', models.FloatField(default=0)),
+                ('humidity_sum', models.FloatField(default=0)),
+                ('pressure_sum', models.FloatField(default=0)),
+                ('wind_speed_sum', models.FloatField(default=0)),
+                ('temperature_min', models.FloatField(blank=True, null=True)),
+                ('temperature_max', models.FloatField(blank=True, null=True)),
+                ('humidity_min', models.FloatField(blank=True, null=True)),
+                ('humidity_max', models.FloatField(blank=True, null=True)),
+                ('pressure_min', models.FloatField(blank=True, null=True)),
+                ('pressure_max', models.FloatField(blank=True, null=True)),
+                ('wind_speed_min', models.FloatField(blank=True, null=True)),
+                ('wind_speed_max', models.FloatField(blank=True, null=True)),
+                ('avg_temp', models.FloatField(blank=True, null=True)),
+                ('avg_humidity', models.FloatField(blank=True, null=True)),
+                ('avg_wind_speed', models.FloatField(blank=True, null=True)),
+                ('last_recorded_at', models.DateTimeField(blank=True, null=True)),
+                ('city', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='weather_stats', to='weather.city')),
+            ],
+            options={
+                'verbose_name_plural': 'City Stats',
+                'indexes': [models.Index(fields=['avg_temp'], name='citystats_avg_temp_idx'), models.Index(fields=['avg_humidity'], name='citystats_avg_humidity_idx'), models.Index(fields=['avg_wind_speed'], name='citystats_avg_wind_idx')],
+            },
+        ),
+        migrations.RunPython(populate_city_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,101 @@
+# Generated by Django 5.2.18 on 2026-10-16 20:28
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weather', '0003_citystats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyWeather',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('bucket_start', models.DateTimeField()),
+                ('reading_count', models.PositiveIntegerField(default=0)),
+                ('temperature_min', models.FloatField()),
+                ('temperature_max', models.FloatField()),
+                ('temperature_mean', models.FloatField()),
+                ('humidity_min', models.FloatField()),
+                ('humidity_max', models.FloatField()),
+                ('humidity_mean', models.FloatField()),
+                ('pressure_min', models.FloatField()),
+                ('pressure_max', models.FloatField()),
+                ('pressure_mean', models.FloatField()),
+                ('wind_speed_min', models.FloatField()),
+                ('wind_speed_max', models.FloatField()),
+                ('wind_speed_mean', models.FloatField()),
+                ('city', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='%(class)s_rollups', to='weather.city')),
+            ],
+            options={
+                'verbose_name_plural': 'Daily Weather',
+                'ordering': ['-bucket_start'],
+                'abstract': False,
+                'unique_together': {('city', 'bucket_start')},
+            },
+        ),
+        migrations.CreateModel(
+            name='HourlyWeather',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('bucket_start', models.DateTimeField()),
+                ('reading_count', models.PositiveIntegerField(default=0)),
+                ('temperature_min', models.FloatField()),
+                ('temperature_max', models.FloatField()),
+                ('temperature_mean', models.FloatField()),
+                ('humidity_min', models.FloatField()),
+                ('humidity_max', models.FloatField()),
+                ('humidity_mean', models.FloatField()),
+                ('pressure_min', models.FloatField()),
+                ('pressure_max', models.FloatField()),
+                ('pressure_mean', models.FloatField()),
+                ('wind_speed_min', models.FloatField()),
+                ('wind_speed_max', models.FloatField()),
+                ('wind_speed_mean', models.FloatField()),
+                ('city', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='%(class)s_rollups', to='weather.city')),
+            ],
+            options={
+                'verbose_name_plural': 'Hourly Weather',
+                'ordering': ['-bucket_start'],
+                'abstract': False,
+                'unique_together': {('city', 'bucket_start')},
+            },
+        ),
+        migrations.CreateModel(
+            name='MonthlyWeather',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('bucket_start', models.DateTimeField()),
+                ('reading_count', models.PositiveIntegerField(default=0)),
+                ('temperature_min', models.FloatField()),
+                ('temperature_max', models.FloatField()),
+                ('temperature_mean', models.FloatField()),
+                ('humidity_min', models.FloatField()),
+                ('humidity_max', models.FloatField()),
+                ('humidity_mean', models.FloatField()),
+                ('pressure_min', models.FloatField()),
+                ('pressure_max', models.FloatField()),
+                ('pressure_mean', models.FloatField()),
+                ('wind_speed_min', models.FloatField()),
+                ('wind_speed_max', models.FloatField()),
+                ('wind_speed_mean', models.FloatField()),
+                ('city', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='%(class)s_rollups', to='weather.city')),
+            ],
+            options={
+                'verbose_name_plural': 'Monthly Weather',
+                'ordering': ['-bucket_start'],
+                'abstract': False,
+                'unique_together': {('city', 'bucket_start')},
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-16 20:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weather', '0004_weather_rollups'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='city',
+            index=models.Index(fields=['name', 'id'], name='city_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='city',
+            index=models.Index(fields=['country', 'name', 'id'], name='city_country_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='weatherdata',
+            index=models.Index(fields=['city', '-recorded_at', '-id'], name='weatherdata_city_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='weatherdata',
+            index=models.Index(fields=['-recorded_at', '-id'], name='weatherdata_recent_idx'),
+        ),
+    ]
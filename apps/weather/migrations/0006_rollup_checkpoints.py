@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weather', '0005_access_path_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('resolution', models.CharField(max_length=10, unique=True)),
+                ('built_from', models.DateTimeField()),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.AddIndex(
+            model_name='dailyweather',
+            index=models.Index(fields=['updated_at'], name='dailyweather_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='hourlyweather',
+            index=models.Index(fields=['updated_at'], name='hourlyweather_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='monthlyweather',
+            index=models.Index(fields=['updated_at'], name='monthlyweather_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='weatherdata',
+            index=models.Index(fields=['updated_at'], name='weatherdata_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weather', '0006_rollup_checkpoints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupDeletion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('resolution', models.CharField(max_length=10)),
+                ('bucket_start', models.DateTimeField()),
+                ('city', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='weather.city')),
+            ],
+            options={
+                'unique_together': {('resolution', 'city', 'bucket_start')},
+            },
+        ),
+    ]
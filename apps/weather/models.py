@@ -1,6 +1,7 @@
 from django.db import models
 from django.core.validators import MinValueValidator, MaxValueValidator
 from apps.common.models import BaseModel
+from apps.weather.managers import CityStatsManager, WeatherDataManager
 
 
 class City(BaseModel):
@@ -30,6 +31,12 @@ class City(BaseModel):
         verbose_name_plural = "Cities"
         unique_together = ['latitude', 'longitude']
         ordering = ['name']
+        indexes = [
+            # Default ordering of the city list and the admin
+            models.Index(fields=['name', 'id'], name='city_name_idx'),
+            # Admin country filter and its distinct country list
+            models.Index(fields=['country', 'name', 'id'], name='city_country_name_idx'),
+        ]
 
     def __str__(self):
         return f"{self.name}, {self.country}"
@@ -52,10 +59,144 @@ class WeatherData(BaseModel):
     description = models.CharField(max_length=200)
     recorded_at = models.DateTimeField()
 
+    objects = WeatherDataManager()
+
     class Meta:
         ordering = ['-recorded_at']
         verbose_name_plural = "Weather Data"
         unique_together = ['city', 'recorded_at'] 
+        indexes = [
+            # History pages, charts and range reads of one city, newest first
+            models.Index(fields=['city', '-recorded_at', '-id'], name='weatherdata_city_recent_idx'),
+            # Admin changelist ordering and its recorded_at filters
+            models.Index(fields=['-recorded_at', '-id'], name='weatherdata_recent_idx'),
+            # Rows written since the last rollup build
+            models.Index(fields=['updated_at'], name='weatherdata_updated_idx'),
+        ]
 
     def __str__(self):
         return f"{self.city.name} - {self.recorded_at.strftime('%Y-%m-%d %H:%M')}"
+
+
+class CityStats(BaseModel):
+    """
+    Running per-city aggregates of WeatherData, kept in sync on every write
+    """
+    city = models.OneToOneField(City, on_delete=models.CASCADE, related_name='weather_stats')
+    reading_count = models.PositiveIntegerField(default=0)
+    temperature_sum = models.FloatField(default=0)
+    humidity_sum = models.FloatField(default=0)
+    pressure_sum = models.FloatField(default=0)
+    wind_speed_sum = models.FloatField(default=0)
+    temperature_min = models.FloatField(null=True, blank=True)
+    temperature_max = models.FloatField(null=True, blank=True)
+    humidity_min = models.FloatField(null=True, blank=True)
+    humidity_max = models.FloatField(null=True, blank=True)
+    pressure_min = models.FloatField(null=True, blank=True)
+    pressure_max = models.FloatField(null=True, blank=True)
+    wind_speed_min = models.FloatField(null=True, blank=True)
+    wind_speed_max = models.FloatField(null=True, blank=True)
+    # Averages are denormalised so the dashboard extremes are index lookups
+    avg_temp = models.FloatField(null=True, blank=True)
+    avg_humidity = models.FloatField(null=True, blank=True)
+    avg_wind_speed = models.FloatField(null=True, blank=True)
+    last_recorded_at = models.DateTimeField(null=True, blank=True)
+
+    objects = CityStatsManager()
+
+    class Meta:
+        verbose_name_plural = "City Stats"
+        indexes = [
+            models.Index(fields=['avg_temp'], name='citystats_avg_temp_idx'),
+            models.Index(fields=['avg_humidity'], name='citystats_avg_humidity_idx'),
+            models.Index(fields=['avg_wind_speed'], name='citystats_avg_wind_idx'),
+        ]
+
+    def __str__(self):
+        return f"Stats for {self.city_id}"
+
+    def as_dict(self):
+        """Return the averages in the shape the templates expect"""
+        return {
+            'avg_temp': self.avg_temp,
+            'avg_humidity': self.avg_humidity,
+            'avg_wind_speed': self.avg_wind_speed,
+        }
+
+
+class WeatherRollup(BaseModel):
+    """
+    Min/max/mean/count of every metric for one city over one time bucket
+    """
+    city = models.ForeignKey(City, on_delete=models.CASCADE, related_name='%(class)s_rollups')
+    bucket_start = models.DateTimeField()
+    reading_count = models.PositiveIntegerField(default=0)
+    temperature_min = models.FloatField()
+    temperature_max = models.FloatField()
+    temperature_mean = models.FloatField()
+    humidity_min = models.FloatField()
+    humidity_max = models.FloatField()
+    humidity_mean = models.FloatField()
+    pressure_min = models.FloatField()
+    pressure_max = models.FloatField()
+    pressure_mean = models.FloatField()
+    wind_speed_min = models.FloatField()
+    wind_speed_max = models.FloatField()
+    wind_speed_mean = models.FloatField()
+
+    class Meta:
+        abstract = True
+        ordering = ['-bucket_start']
+        unique_together = ['city', 'bucket_start']
+        indexes = [
+            # Buckets written since the next resolution was last built
+            models.Index(fields=['updated_at'], name='%(class)s_updated_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.city_id} - {self.bucket_start.strftime('%Y-%m-%d %H:%M')}"
+
+
+class HourlyWeather(WeatherRollup):
+    """Hourly rollup, built from raw WeatherData"""
+    class Meta(WeatherRollup.Meta):
+        verbose_name_plural = "Hourly Weather"
+
+
+class DailyWeather(WeatherRollup):
+    """Daily rollup, built from HourlyWeather"""
+    class Meta(WeatherRollup.Meta):
+        verbose_name_plural = "Daily Weather"
+
+
+class MonthlyWeather(WeatherRollup):
+    """Monthly rollup, built from DailyWeather"""
+    class Meta(WeatherRollup.Meta):
+        verbose_name_plural = "Monthly Weather"
+
+
+class RollupCheckpoint(BaseModel):
+    """When the last incremental or full build of one rollup resolution started"""
+    resolution = models.CharField(max_length=10, unique=True)
+    built_from = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.resolution} - {self.built_from.isoformat()}"
+
+
+class RollupDeletion(BaseModel):
+    """
+    A bucket of one rollup resolution that lost source rows to a delete.
+
+    Deletes leave no newer row behind to mark the bucket dirty, so the next
+    build rebuilds (or removes) each recorded bucket, then forgets it.
+    """
+    resolution = models.CharField(max_length=10)
+    city = models.ForeignKey(City, on_delete=models.CASCADE, related_name='+')
+    bucket_start = models.DateTimeField()
+
+    class Meta:
+        unique_together = ['resolution', 'city', 'bucket_start']
+
+    def __str__(self):
+        return f"{self.resolution} - {self.city_id} - {self.bucket_start.isoformat()}"
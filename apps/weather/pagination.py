@@ -0,0 +1,128 @@
+"""
+Keyset (cursor) pagination for newest-first WeatherData listings.
+
+Pages are addressed by an opaque cursor holding the ``(recorded_at, id)``
+of the row they continue from, so fetching any page is one indexed range
+scan with a LIMIT: there is no COUNT(*) and no OFFSET, and page 10,000 costs
+the same as page 1.
+"""
+import base64
+import binascii
+from collections.abc import Sequence
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db.models import Q
+
+OLDER = 'o'
+NEWER = 'n'
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def encode_cursor(direction, recorded_at, pk):
+    # Integer arithmetic: a float timestamp can be a microsecond off
+    micros = (recorded_at - EPOCH) // MICROSECOND
+    raw = f'{direction}:{micros}:{pk}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return ``(direction, recorded_at, pk)``, or None for a missing or malformed cursor"""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        direction, micros, pk = raw.split(':')
+        if direction not in (OLDER, NEWER):
+            return None
+        recorded_at = EPOCH + int(micros) * MICROSECOND
+        return direction, recorded_at, int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError, OverflowError, OSError):
+        return None
+
+
+class KeysetPage(Sequence):
+    """One page of rows plus the cursors of its neighbours"""
+    def __init__(self, object_list, paginator, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __repr__(self):
+        return f'<KeysetPage of {len(self.object_list)} rows>'
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator:
+    """
+    Paginate a queryset newest first on ``(recorded_at, id)``.
+
+    "Next" pages go back in time and "previous" pages forward. Whether a
+    newer page exists after following a "next" link is assumed rather than
+    queried, which keeps every page to a single query.
+    """
+    def __init__(self, queryset, per_page):
+        self.queryset = queryset
+        self.per_page = per_page
+
+    def query(self, cursor=None):
+        """Return the single LIMIT query that fetches the page for ``cursor``"""
+        decoded = decode_cursor(cursor)
+        if decoded is None:
+            queryset = self.queryset.order_by('-recorded_at', '-id')
+        elif decoded[0] == OLDER:
+            _, recorded_at, pk = decoded
+            # recorded_at <= ts bounds the index scan; the OR only breaks ties
+            queryset = self.queryset.filter(
+                Q(recorded_at__lt=recorded_at) | Q(id__lt=pk), recorded_at__lte=recorded_at
+            ).order_by('-recorded_at', '-id')
+        else:
+            _, recorded_at, pk = decoded
+            queryset = self.queryset.filter(
+                Q(recorded_at__gt=recorded_at) | Q(id__gt=pk), recorded_at__gte=recorded_at
+            ).order_by('recorded_at', 'id')
+        # One extra row tells us whether there is another page this way
+        return queryset[:self.per_page + 1]
+
+    def page(self, cursor=None):
+        return self._page(cursor, list(self.query(cursor)))
+
+    async def apage(self, cursor=None):
+        """Async page(), for async views"""
+        return self._page(cursor, [row async for row in self.query(cursor)])
+
+    def _page(self, cursor, rows):
+        decoded = decode_cursor(cursor)
+        anchored = decoded is not None
+        older = not anchored or decoded[0] == OLDER
+
+        more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if not older:
+            rows.reverse()
+        if not rows:
+            # Past either end; the template links back to the newest page
+            return KeysetPage(rows, self)
+
+        next_cursor = previous_cursor = None
+        if more or not older:
+            next_cursor = encode_cursor(OLDER, rows[-1].recorded_at, rows[-1].pk)
+        if anchored and (older or more):
+            previous_cursor = encode_cursor(NEWER, rows[0].recorded_at, rows[0].pk)
+        return KeysetPage(rows, self, next_cursor, previous_cursor)
@@ -0,0 +1,125 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from apps.weather.caching import bump_locations, bump_versions
+from apps.weather.hotcache import hot_series
+from apps.weather.models import City, CityStats, WeatherData
+from apps.weather.rollups import HOUR, record_deletions
+from apps.weather.signals import is_batching, readings_changed, readings_created
+from apps.weather.streams import publish_instances
+
+
+@receiver(post_save, sender=WeatherData)
+def update_stats_on_save(sender, instance, created, raw=False, **kwargs):
+    """Keep CityStats current when a single reading is saved"""
+    if raw or is_batching():
+        return
+    if created:
+        CityStats.objects.apply_readings([instance])
+    else:
+        CityStats.objects.rebuild([instance.city_id])
+
+
+@receiver(post_delete, sender=WeatherData)
+def update_stats_on_delete(sender, instance, origin=None, **kwargs):
+    """Keep CityStats current when a single reading is deleted"""
+    if is_batching() or isinstance(origin, City) or getattr(origin, 'model', None) is City:
+        # Either the caller reports the batch itself, or the whole city
+        # (and its stats row) is being deleted.
+        return
+    CityStats.objects.remove_reading(instance)
+
+
+@receiver(readings_created, sender=WeatherData)
+def update_stats_on_bulk_create(sender, instances, **kwargs):
+    CityStats.objects.apply_readings(instances)
+
+
+@receiver(readings_changed, sender=WeatherData)
+def update_stats_on_bulk_change(sender, city_ids, **kwargs):
+    CityStats.objects.rebuild(city_ids)
+
+
+@receiver(post_delete, sender=WeatherData)
+def record_rollup_deletion(sender, instance, origin=None, **kwargs):
+    """Have the next rollup build drop the reading from its hour"""
+    if is_batching() or isinstance(origin, City) or getattr(origin, 'model', None) is City:
+        return
+    record_deletions(HOUR, [(instance.city_id, instance.recorded_at)])
+
+
+@receiver(readings_changed, sender=WeatherData)
+def record_rollup_deletions_on_bulk_change(sender, city_ids, deleted=(), **kwargs):
+    if deleted:
+        record_deletions(HOUR, deleted)
+
+
+@receiver(post_save, sender=WeatherData)
+@receiver(post_delete, sender=WeatherData)
+def bump_cache_on_reading_change(sender, instance, raw=False, origin=None, **kwargs):
+    """Invalidate cached pages after the stats above are up to date"""
+    if raw or is_batching() or isinstance(origin, City) or getattr(origin, 'model', None) is City:
+        return
+    bump_versions([instance.city_id])
+
+
+@receiver(readings_created, sender=WeatherData)
+def bump_cache_on_bulk_create(sender, instances, **kwargs):
+    bump_versions({instance.city_id for instance in instances})
+
+
+@receiver(readings_changed, sender=WeatherData)
+def bump_cache_on_bulk_change(sender, city_ids, **kwargs):
+    bump_versions(city_ids)
+
+
+@receiver(post_save, sender=City)
+@receiver(post_delete, sender=City)
+def bump_cache_on_city_change(sender, instance, raw=False, **kwargs):
+    bump_versions([instance.pk])
+
+
+@receiver(post_save, sender=City)
+@receiver(post_delete, sender=City)
+def bump_locations_on_city_change(sender, instance, raw=False, **kwargs):
+    """Have every process rebuild its spatial index (see spatial.py)"""
+    bump_locations()
+
+
+# The hot series receivers come last: they read the stats and version
+# tokens the receivers above have just updated, once they are committed.
+@receiver(post_save, sender=WeatherData)
+@receiver(post_delete, sender=WeatherData)
+def update_hot_series_on_reading_change(sender, instance, created=False, raw=False, origin=None,
+                                        **kwargs):
+    if raw or is_batching() or isinstance(origin, City) or getattr(origin, 'model', None) is City:
+        return
+    if created:
+        transaction.on_commit(lambda: hot_series().append([instance]))
+    else:
+        transaction.on_commit(lambda: hot_series().refresh([instance.city_id]))
+
+
+@receiver(readings_created, sender=WeatherData)
+def update_hot_series_on_bulk_create(sender, instances, **kwargs):
+    transaction.on_commit(lambda: hot_series().append(instances))
+
+
+@receiver(readings_changed, sender=WeatherData)
+def update_hot_series_on_bulk_change(sender, city_ids, **kwargs):
+    city_ids = list(city_ids)
+    transaction.on_commit(lambda: hot_series().refresh(city_ids))
+
+
+@receiver(post_save, sender=WeatherData)
+def publish_on_save(sender, instance, created, raw=False, **kwargs):
+    """Send new readings to the reading streams (see streams.py)"""
+    if raw or is_batching() or not created:
+        return
+    publish_instances([instance])
+
+
+@receiver(readings_created, sender=WeatherData)
+def publish_on_bulk_create(sender, instances, **kwargs):
+    publish_instances(instances)
@@ -0,0 +1,156 @@
+"""
+Thread-safe chart rendering on matplotlib's object-oriented API.
+
+Nothing here touches pyplot, so there is no global figure manager and no
+backend switching. Every thread keeps its own Figure per template and
+clears it between renders, and charts can optionally be rendered in a
+pool of worker processes so request threads are not held by the CPU work.
+
+This module must not import Django models: worker processes import it
+without setting Django up.
+"""
+import asyncio
+import io
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.dates import DateFormatter, date2num
+from matplotlib.figure import Figure
+
+
+class ChartTemplate:
+    """
+    Static layout of a line chart. Figures built from it are reused per thread.
+    """
+    def __init__(self, title, ylabel, color='#4bc0c0', xlabel='Date',
+                 figsize=(10, 4), dpi=100, date_format='%m/%d %H:%M'):
+        self.title = title
+        self.ylabel = ylabel
+        self.color = color
+        self.xlabel = xlabel
+        self.figsize = figsize
+        self.dpi = dpi
+        self.date_format = date_format
+        self._local = threading.local()
+
+    def _figure(self):
+        figure = getattr(self._local, 'figure', None)
+        if figure is None:
+            figure = Figure(figsize=self.figsize, dpi=self.dpi)
+            FigureCanvasAgg(figure)
+            self._local.figure = figure
+        else:
+            figure.clear()
+        return figure
+
+    def render(self, dates, series):
+        """
+        Render one PNG. ``dates`` are matplotlib date numbers and ``series``
+        is a list of ``(label, values)`` pairs plotted on the same axes.
+        """
+        figure = self._figure()
+        axes = figure.add_subplot()
+        for index, (label, values) in enumerate(series):
+            color = self.color if index == 0 else None
+            axes.plot(dates, values, color=color, linewidth=2, label=label)
+        axes.set_title(self.title)
+        axes.set_xlabel(self.xlabel)
+        axes.set_ylabel(self.ylabel)
+        axes.xaxis.set_major_formatter(DateFormatter(self.date_format))
+        axes.grid(True, linestyle='--', alpha=0.7)
+        if len(series) > 1:
+            axes.legend(loc='upper left', fontsize='small')
+        figure.autofmt_xdate()
+
+        buffer = io.BytesIO()
+        figure.savefig(buffer, format='png', bbox_inches='tight')
+        return buffer.getvalue()
+
+
+TEMPLATES = {
+    'temperature': ChartTemplate('Temperature Over Time', 'Temperature (°C)'),
+    'humidity': ChartTemplate('Humidity Over Time', 'Humidity (%)', color='#36a2eb'),
+    'wind_speed': ChartTemplate('Wind Speed Over Time', 'Wind Speed (m/s)', color='#9966ff'),
+    'pressure': ChartTemplate('Pressure Over Time', 'Pressure (hPa)', color='#ff9f40'),
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def chart_data(records, metric='temperature'):
+    """Turn readings (anything with ``recorded_at`` and the metric) into plain arrays"""
+    dates = date2num([record.recorded_at for record in records])
+    values = [float(getattr(record, metric)) for record in records]
+    return dates, values
+
+
+def render(template_name, dates, series):
+    """Render a chart in the calling thread"""
+    return TEMPLATES[template_name].render(dates, series)
+
+
+def get_executor():
+    """
+    Return the shared chart process pool, or None when it is disabled.
+
+    The pool size comes from the WEATHER_CHART_WORKERS setting; 0 keeps
+    rendering in the calling thread.
+    """
+    global _executor
+    from django.conf import settings
+    max_workers = getattr(settings, 'WEATHER_CHART_WORKERS', 0)
+    if not max_workers:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            # spawn, not fork: forking a threaded server process is unsafe
+            _executor = ProcessPoolExecutor(
+                max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')
+            )
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
+
+
+def submit(template_name, dates, series, executor=None):
+    """Start rendering a chart and return a Future for its PNG"""
+    executor = executor or get_executor()
+    if executor is None:
+        future = Future()
+        try:
+            future.set_result(render(template_name, dates, series))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+    return executor.submit(render, template_name, dates, series)
+
+
+def render_many(jobs, executor=None):
+    """Render ``(template_name, dates, series)`` jobs, in parallel when a pool is available"""
+    futures = [submit(*job, executor=executor) for job in jobs]
+    return [future.result() for future in futures]
+
+
+def render_records(records, metric='temperature'):
+    """Render one metric of a list of readings to a PNG"""
+    dates, values = chart_data(records, metric)
+    return submit(metric, dates, [(metric, values)]).result()
+
+
+async def arender_records(records, metric='temperature'):
+    """
+    Async render_records(): the chart is drawn in the chart process pool,
+    or in a worker thread when there is none, so the event loop is not blocked.
+    """
+    dates, values = chart_data(records, metric)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), render, metric, dates, [(metric, values)])
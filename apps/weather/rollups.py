@@ -0,0 +1,328 @@
+"""
+Downsampled hourly/daily/monthly copies of WeatherData.
+
+Each resolution is built from the one below it (raw -> hour -> day -> month),
+so min, max and count merge exactly and the mean is re-weighted by count.
+Builds are incremental: every source row written (``updated_at``) since the
+last incremental build started (its RollupCheckpoint) marks its city dirty
+from its own timestamp on, so readings backfilled behind the newest bucket
+are folded in as well as new ones. Deletes leave no such row behind, so the
+buckets they touched are recorded as RollupDeletions instead (see
+record_deletions()) and rebuilt, or removed once empty, by the next build.
+"""
+from collections import defaultdict, namedtuple
+from datetime import timedelta, timezone as dt_timezone
+
+from django.db.models import Avg, Count, F, Max, Min, Sum
+from django.db.models.functions import Trunc
+from django.utils import timezone
+
+from apps.weather.caching import bump_versions
+from apps.weather.managers import METRICS
+from apps.weather.models import (
+    DailyWeather, HourlyWeather, MonthlyWeather, RollupCheckpoint, RollupDeletion, WeatherData,
+)
+from apps.weather.series import columns_by_city
+
+Resolution = namedtuple('Resolution', ['name', 'model', 'span'])
+
+RAW = Resolution('raw', WeatherData, None)
+HOUR = Resolution('hour', HourlyWeather, timedelta(hours=1))
+DAY = Resolution('day', DailyWeather, timedelta(days=1))
+MONTH = Resolution('month', MonthlyWeather, timedelta(days=30))
+
+# Finest first; each entry is built from the one before it
+RESOLUTIONS = (HOUR, DAY, MONTH)
+SOURCES = {HOUR.name: RAW, DAY.name: HOUR, MONTH.name: DAY}
+COARSER = {HOUR.name: DAY, DAY.name: MONTH, MONTH.name: None}
+
+# Spans short enough to be charted straight from the raw readings
+RAW_MAX_SPAN = timedelta(days=2)
+DEFAULT_MAX_POINTS = 500
+BATCH_SIZE = 1000
+# Source rows written this long before the last build started are looked at
+# again: writers stamp updated_at before they commit, on their own clocks
+DIRTY_SLACK = timedelta(minutes=5)
+
+ROLLUP_FIELDS = ['reading_count'] + [
+    f'{metric}_{stat}' for metric in METRICS for stat in ('min', 'max', 'mean')
+]
+
+
+def pick_resolution(start, end, max_points=DEFAULT_MAX_POINTS):
+    """
+    Return the resolution to read [start, end) from.
+
+    Short spans use raw readings; longer ones use the finest rollup whose
+    bucket count still fits in ``max_points``, falling back to monthly.
+    """
+    span = end - start
+    if span <= RAW_MAX_SPAN:
+        return RAW
+    for resolution in RESOLUTIONS:
+        if span / resolution.span <= max_points:
+            return resolution
+    return MONTH
+
+
+def load_series(city, start, end, metrics=('temperature',), max_points=DEFAULT_MAX_POINTS):
+    """
+    Read one city's series over [start, end) at the resolution that fits.
+
+    Returns ``(resolution, points)`` where each point is a namedtuple with a
+    ``recorded_at`` timestamp and one attribute per metric (the bucket mean
+    for rollups), oldest first.
+    """
+    resolution = pick_resolution(start, end, max_points)
+    Point = namedtuple('Point', ('recorded_at',) + tuple(metrics))
+    rows = series_queryset(resolution, city, start, end, metrics)
+    return resolution, [Point(*row) for row in rows]
+
+
+def series_queryset(resolution, city, start, end, metrics=('temperature',)):
+    """Return ``(timestamp, *metric means)`` tuples of one resolution, oldest first"""
+    if resolution is RAW:
+        return WeatherData.objects.filter(
+            city=city, recorded_at__gte=start, recorded_at__lt=end
+        ).order_by('recorded_at').values_list('recorded_at', *metrics)
+    return resolution.model.objects.filter(
+        city=city, bucket_start__gte=start, bucket_start__lt=end
+    ).order_by('bucket_start').values_list(
+        'bucket_start', *(f'{metric}_mean' for metric in metrics)
+    )
+
+
+def load_columns(resolution, city_ids, start, end, fields):
+    """
+    series.load_columns() for one rollup: ``fields`` of every city's
+    buckets starting in [start, end), read in a single query.
+    """
+    city_ids = list(city_ids)
+    rows = resolution.model.objects.filter(
+        city_id__in=city_ids, bucket_start__gte=start, bucket_start__lt=end
+    ).order_by('city_id', 'bucket_start').values_list('bucket_start', *fields, 'city_id')
+    return columns_by_city(city_ids, rows, fields)
+
+
+def build_rollups(resolution, since=None, until=None, city_ids=None, resume=True):
+    """
+    Build (or refresh) the buckets of one resolution from its source.
+
+    Without ``since`` the build resumes from the source rows written since
+    the last one started (see dirty_ranges()); ``resume=False`` rebuilds
+    every bucket that still has source rows instead. Only these two move
+    the checkpoint; builds limited by ``since``, ``until`` or ``city_ids``
+    leave it alone. Both also rebuild the buckets recorded by
+    record_deletions(). Returns the number of buckets written.
+    """
+    source = SOURCES[resolution.name]
+    started = timezone.now()
+    checkpoint = since is None and until is None and city_ids is None
+
+    if since is None and resume:
+        ranges = dirty_ranges(resolution, city_ids)
+        if ranges is not None:
+            written = sum(
+                _build(resolution, source, start, until, chunk)
+                for start, ids in ranges.items()
+                for chunk in chunks(ids, BATCH_SIZE)
+            )
+            if until is None:
+                written += _rebuild_deleted(resolution, source, city_ids)
+            if checkpoint:
+                _save_checkpoint(resolution, started)
+            return written
+    if since is not None:
+        # Always start on a bucket boundary so no bucket is built half-empty
+        since = truncate(since, resolution.name)
+    written = _build(resolution, source, since, until, city_ids)
+    if since is None and until is None:
+        written += _rebuild_deleted(resolution, source, city_ids)
+    if checkpoint:
+        _save_checkpoint(resolution, started)
+    return written
+
+
+def record_deletions(resolution, buckets):
+    """
+    Have the next build of ``resolution`` rebuild the buckets that the
+    ``(city id, timestamp)`` pairs of deleted source rows fall in.
+    """
+    deletions = {
+        (city_id, truncate(timestamp, resolution.name)) for city_id, timestamp in buckets
+    }
+    RollupDeletion.objects.bulk_create(
+        [
+            RollupDeletion(resolution=resolution.name, city_id=city_id, bucket_start=bucket_start)
+            for city_id, bucket_start in deletions
+        ],
+        batch_size=BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+
+
+def _rebuild_deleted(resolution, source, city_ids):
+    """
+    Rebuild every bucket recorded by record_deletions(), delete the ones
+    left without source rows and pass those on to the coarser resolution.
+    """
+    deletions = RollupDeletion.objects.filter(resolution=resolution.name)
+    if city_ids is not None:
+        deletions = deletions.filter(city_id__in=city_ids)
+
+    written = 0
+    emptied = []
+    done = []
+    for pk, city_id, bucket_start in deletions.values_list('id', 'city_id', 'bucket_start'):
+        end = next_bucket(bucket_start, resolution.name)
+        built = _build(resolution, source, bucket_start, end, [city_id])
+        if not built:
+            resolution.model.objects.filter(city_id=city_id, bucket_start=bucket_start).delete()
+            emptied.append((city_id, bucket_start))
+        written += built
+        done.append(pk)
+
+    coarser = COARSER[resolution.name]
+    if emptied:
+        if coarser is not None:
+            record_deletions(coarser, emptied)
+        bump_versions({city_id for city_id, _ in emptied})
+    for chunk in chunks(done, BATCH_SIZE):
+        RollupDeletion.objects.filter(id__in=chunk).delete()
+    return written
+
+
+def dirty_ranges(resolution, city_ids=None):
+    """
+    Return ``{bucket start: [city ids]}``: for every city with source rows
+    written since the last build of ``resolution`` started, the bucket of
+    the oldest such row. None when it has never been built.
+    """
+    built_from = RollupCheckpoint.objects.filter(
+        resolution=resolution.name
+    ).values_list('built_from', flat=True).first()
+    if built_from is None:
+        return None
+    source = SOURCES[resolution.name]
+    time_field = 'recorded_at' if source is RAW else 'bucket_start'
+    touched = source.model.objects.filter(updated_at__gte=built_from - DIRTY_SLACK)
+    if city_ids is not None:
+        touched = touched.filter(city_id__in=city_ids)
+    ranges = defaultdict(list)
+    for city_id, oldest in touched.values('city_id').annotate(
+        oldest=Min(time_field)
+    ).order_by().values_list('city_id', 'oldest'):
+        ranges[truncate(oldest, resolution.name)].append(city_id)
+    return ranges
+
+
+def _build(resolution, source, since, until, city_ids):
+    model = resolution.model
+    rows = _aggregate(source, resolution.name, since, until, city_ids)
+
+    written = 0
+    batch = []
+    changed = set()
+    for row in rows.iterator(chunk_size=BATCH_SIZE):
+        batch.append(_rollup_from_row(model, source, row))
+        changed.add(row['city_id'])
+        if len(batch) >= BATCH_SIZE:
+            written += _upsert(model, batch)
+            batch = []
+    if batch:
+        written += _upsert(model, batch)
+    if changed:
+        # Range charts are read from the rollups
+        bump_versions(changed)
+    return written
+
+
+def _save_checkpoint(resolution, started):
+    RollupCheckpoint.objects.update_or_create(
+        resolution=resolution.name, defaults={'built_from': started}
+    )
+
+
+def chunks(values, size):
+    """Yield consecutive slices of ``values`` of at most ``size`` items"""
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def build_all(since=None, until=None, city_ids=None, resume=True):
+    """Build every resolution in dependency order; returns {name: buckets written}"""
+    return {
+        resolution.name: build_rollups(resolution, since, until, city_ids, resume)
+        for resolution in RESOLUTIONS
+    }
+
+
+def _aggregate(source, kind, since, until, city_ids):
+    time_field = 'recorded_at' if source is RAW else 'bucket_start'
+    queryset = source.model.objects.order_by()
+    if since is not None:
+        queryset = queryset.filter(**{f'{time_field}__gte': since})
+    if until is not None:
+        queryset = queryset.filter(**{f'{time_field}__lt': until})
+    if city_ids is not None:
+        queryset = queryset.filter(city_id__in=city_ids)
+
+    # Aliases must not shadow the rollup columns they are computed from
+    if source is RAW:
+        aggregates = {'n': Count('id')}
+        for metric in METRICS:
+            aggregates[f'{metric}_low'] = Min(metric)
+            aggregates[f'{metric}_high'] = Max(metric)
+            aggregates[f'{metric}_avg'] = Avg(metric)
+    else:
+        aggregates = {'n': Sum('reading_count')}
+        for metric in METRICS:
+            aggregates[f'{metric}_low'] = Min(f'{metric}_min')
+            aggregates[f'{metric}_high'] = Max(f'{metric}_max')
+            # Weighted by count, divided out in _rollup_from_row
+            aggregates[f'{metric}_avg'] = Sum(F(f'{metric}_mean') * F('reading_count'))
+
+    return queryset.annotate(
+        bucket=Trunc(time_field, kind, tzinfo=dt_timezone.utc)
+    ).values('city_id', 'bucket').annotate(**aggregates).order_by('city_id', 'bucket')
+
+
+def _rollup_from_row(model, source, row):
+    count = row['n']
+    values = {'reading_count': count}
+    for metric in METRICS:
+        values[f'{metric}_min'] = float(row[f'{metric}_low'])
+        values[f'{metric}_max'] = float(row[f'{metric}_high'])
+        mean = float(row[f'{metric}_avg'])
+        values[f'{metric}_mean'] = mean if source is RAW else mean / count
+    return model(city_id=row['city_id'], bucket_start=row['bucket'], **values)
+
+
+def _upsert(model, rollups):
+    model.objects.bulk_create(
+        rollups,
+        update_conflicts=True,
+        unique_fields=['city', 'bucket_start'],
+        update_fields=ROLLUP_FIELDS + ['updated_at'],
+    )
+    return len(rollups)
+
+
+def next_bucket(value, kind):
+    """Start of the ``kind`` bucket after the one ``value`` falls in"""
+    start = truncate(value, kind)
+    if kind == 'hour':
+        return start + timedelta(hours=1)
+    if kind == 'day':
+        return start + timedelta(days=1)
+    return (start + timedelta(days=32)).replace(day=1)
+
+
+def truncate(value, kind):
+    """Start, in UTC, of the ``kind`` bucket ``value`` falls in"""
+    value = value.astimezone(dt_timezone.utc)
+    if kind == 'hour':
+        return value.replace(minute=0, second=0, microsecond=0)
+    if kind == 'day':
+        return value.replace(hour=0, minute=0, second=0, microsecond=0)
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
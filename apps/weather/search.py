@@ -0,0 +1,82 @@
+"""
+In-memory prefix index over the city names and countries.
+
+Every word of a city's name and country starts a key, folded to lowercase
+without accents ("São Paulo" is found by "sao", "paulo" and "são p"). The
+keys are kept in one sorted list, so the matches for a prefix are the
+contiguous run found with two bisections, and the first ``k`` distinct
+cities of that run are the suggestions, in alphabetical order of the
+matched key. Like the spatial index, each process rebuilds it when the
+locations version in the cache changes.
+"""
+import unicodedata
+from bisect import bisect_left
+
+from apps.weather.caching import ProcessSnapshot, locations_version
+from apps.weather.models import City
+
+DEFAULT_SUGGESTIONS = 10
+# Sorts after every folded character, so ``prefix + END`` bounds the run
+END = '\U0010ffff'
+
+
+def fold(text):
+    """Lowercase ``text`` and strip its accents"""
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(char for char in decomposed if not unicodedata.combining(char)).casefold().strip()
+
+
+def word_keys(text):
+    """Every suffix of the folded ``text`` that starts at a word"""
+    words = fold(text).split()
+    return {' '.join(words[i:]) for i in range(len(words))}
+
+
+class CityPrefixIndex:
+    def __init__(self, rows):
+        self.cities = [{'id': pk, 'name': name, 'country': country} for pk, name, country in rows]
+        entries = sorted(
+            (key, position)
+            for position, (_, name, country) in enumerate(rows)
+            for key in word_keys(name) | word_keys(country)
+        )
+        self.keys = [key for key, _ in entries]
+        self.positions = [position for _, position in entries]
+
+    @classmethod
+    def load(cls):
+        return cls(list(City.objects.order_by('name', 'id').values_list('id', 'name', 'country')))
+
+    def __len__(self):
+        return len(self.cities)
+
+    def _run(self, query):
+        prefix = ' '.join(fold(query).split())
+        if not prefix:
+            return range(0)
+        return range(bisect_left(self.keys, prefix), bisect_left(self.keys, prefix + END))
+
+    def suggest(self, query, k=DEFAULT_SUGGESTIONS):
+        """Return up to ``k`` cities with a name or country word starting with ``query``"""
+        seen = set()
+        suggestions = []
+        for entry in self._run(query):
+            position = self.positions[entry]
+            if position not in seen:
+                seen.add(position)
+                suggestions.append(self.cities[position])
+                if len(suggestions) == k:
+                    break
+        return suggestions
+
+    def city_ids(self, query):
+        """Return the ids of every city matching ``query``"""
+        return {self.cities[self.positions[entry]]['id'] for entry in self._run(query)}
+
+
+_index = ProcessSnapshot(locations_version, CityPrefixIndex.load)
+
+
+def city_prefix_index():
+    """Return this process's CityPrefixIndex, rebuilt if the cities changed since it was built"""
+    return _index.get()
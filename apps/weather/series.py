@@ -0,0 +1,158 @@
+"""
+NumPy helpers for reading and shrinking a city's time series.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import numpy as np
+from django.db.models import FloatField, Max
+from django.db.models.functions import Cast
+
+from apps.weather.models import CityStats, WeatherData
+
+CHUNK_SIZE = 5000
+
+
+def load_arrays(city_id, start=None, end=None, metrics=('temperature',), limit=None):
+    """
+    Stream a city's readings over [start, end) into NumPy arrays.
+
+    Returns ``(timestamps, values)`` where ``timestamps`` are epoch seconds
+    (int64) and ``values`` maps each metric to a float64 array, oldest first.
+    Rows are fetched with a server-side cursor in chunks, never as models.
+    With ``limit`` at most that many rows are read.
+    """
+    rows = series_queryset(city_id, start, end, metrics)
+    if limit is not None:
+        rows = rows[:limit]
+    timestamps, columns = _read_columns(rows, len(metrics))
+    return timestamps, dict(zip(metrics, columns))
+
+
+def series_queryset(city_id, start=None, end=None, metrics=('temperature',)):
+    """Return ``(recorded_at, *metrics)`` tuples for one city, oldest first"""
+    queryset = WeatherData.objects.filter(city_id=city_id)
+    if start is not None:
+        queryset = queryset.filter(recorded_at__gte=start)
+    if end is not None:
+        queryset = queryset.filter(recorded_at__lt=end)
+    return queryset.order_by('recorded_at').values_list('recorded_at', *metrics)
+
+
+def latest_range(city_ids, span):
+    """The ``span`` before the newest reading of any of the cities, as ``(start, end)``"""
+    last = CityStats.objects.filter(city_id__in=city_ids).aggregate(last=Max('last_recorded_at'))['last']
+    end = (last or datetime.now(dt_timezone.utc)) + timedelta(seconds=1)
+    return end - span, end
+
+
+def load_columns(city_ids, start=None, end=None, metrics=('temperature',), limit=None):
+    """
+    Read several cities' readings over [start, end) in a single query.
+
+    Returns ``{city_id: (timestamps, values)}`` shaped like load_arrays(),
+    with an entry (possibly empty) for every requested city. The database
+    casts the values to floats, which skips building a Decimal per value.
+    With ``limit`` at most that many rows are read, so a caller that finds
+    ``limit`` of them knows the range may hold more.
+    """
+    city_ids = list(city_ids)
+    queryset = WeatherData.objects.filter(city_id__in=city_ids)
+    if start is not None:
+        queryset = queryset.filter(recorded_at__gte=start)
+    if end is not None:
+        queryset = queryset.filter(recorded_at__lt=end)
+    floats = {f'{metric}_float': Cast(metric, FloatField()) for metric in metrics}
+    rows = queryset.annotate(**floats).order_by('city_id', 'recorded_at').values_list(
+        'recorded_at', *floats, 'city_id'
+    )
+    if limit is not None:
+        rows = rows[:limit]
+
+    return columns_by_city(city_ids, rows, metrics)
+
+
+def columns_by_city(city_ids, rows, names):
+    """
+    Read ``(timestamp, *values, city_id)`` rows ordered by city into
+    ``{city_id: (timestamps, {name: values})}``, one entry per city id.
+    """
+    timestamps, (*values, cities) = _read_columns(rows, len(names) + 1)
+    # Rows are grouped by city, so each city is one contiguous slice
+    cities = cities.astype(np.int64)
+    result = {}
+    for city_id in city_ids:
+        lo, hi = np.searchsorted(cities, [city_id, city_id + 1])
+        result[city_id] = timestamps[lo:hi], {
+            name: column[lo:hi] for name, column in zip(names, values)
+        }
+    return result
+
+
+def _read_columns(rows, width):
+    """
+    Read ``(recorded_at, *values)`` rows in chunks into an int64 array of
+    epoch seconds and ``width`` float64 arrays.
+    """
+    timestamps = []
+    columns = [[] for _ in range(width)]
+    chunk = []
+    for row in rows.iterator(chunk_size=CHUNK_SIZE):
+        chunk.append(row)
+        if len(chunk) >= CHUNK_SIZE:
+            _append_chunk(chunk, timestamps, columns)
+            chunk = []
+    if chunk:
+        _append_chunk(chunk, timestamps, columns)
+
+    if not timestamps:
+        return np.empty(0, dtype=np.int64), [np.empty(0) for _ in range(width)]
+    return np.concatenate(timestamps), [np.concatenate(column) for column in columns]
+
+
+def _append_chunk(chunk, timestamps, columns):
+    timestamps.append(np.fromiter((int(row[0].timestamp()) for row in chunk), np.int64, len(chunk)))
+    for index, column in enumerate(columns, start=1):
+        column.append(np.fromiter((row[index] for row in chunk), np.float64, len(chunk)))
+
+
+def lttb(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling.
+
+    Returns the indices of at most ``threshold`` points of (x, y) that keep
+    the visual shape of the series: the first and last points, plus from
+    each bucket the point forming the largest triangle with the previously
+    kept point and the mean of the next bucket. Only the walk across the
+    buckets is a Python loop; the work inside each bucket is vectorised.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    size = len(x)
+    if threshold >= size or threshold < 3:
+        return np.arange(size)
+
+    # Bucket edges over the points between the fixed first and last ones
+    edges = np.linspace(1, size - 1, threshold - 1).astype(np.int64)
+    # Mean of every bucket up front, used as the third triangle vertex
+    counts = np.diff(edges)
+    x_means = np.add.reduceat(x[1:size - 1], edges[:-1] - 1) / counts
+    y_means = np.add.reduceat(y[1:size - 1], edges[:-1] - 1) / counts
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = size - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, stop = edges[bucket], edges[bucket + 1]
+        if bucket + 1 < threshold - 2:
+            next_x, next_y = x_means[bucket + 1], y_means[bucket + 1]
+        else:
+            next_x, next_y = x[-1], y[-1]
+        ax, ay = x[previous], y[previous]
+        # Twice the triangle area; the constant factor does not change argmax
+        areas = np.abs(
+            (ax - next_x) * (y[start:stop] - ay) - (ax - x[start:stop]) * (next_y - ay)
+        )
+        previous = start + int(np.argmax(areas))
+        selected[bucket + 1] = previous
+    return selected
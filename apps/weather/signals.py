@@ -0,0 +1,33 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.dispatch import Signal
+
+# Sent after bulk_create inserted brand new rows. Receivers get ``instances``.
+readings_created = Signal()
+
+# Sent when rows for ``city_ids`` changed in a way that can only be handled
+# by recomputing (upserts, queryset updates and deletes). Queryset deletes
+# also pass ``deleted``, the (city id, hour) pairs the deleted rows fell in.
+readings_changed = Signal()
+
+_batching = ContextVar('weather_batching', default=False)
+
+
+@contextmanager
+def batched():
+    """
+    Silence the WeatherData write hooks for the duration of a bulk operation.
+
+    Per-row post_save/post_delete handling and the bulk signals above are
+    all skipped; whoever opens the outermost batch reports the change once.
+    """
+    token = _batching.set(True)
+    try:
+        yield
+    finally:
+        _batching.reset(token)
+
+
+def is_batching():
+    return _batching.get()
@@ -0,0 +1,202 @@
+"""
+In-process spatial index over the city coordinates.
+
+Cities are placed on the unit sphere, where the straight-line (chord)
+distance orders points exactly like the great-circle distance and there is
+no seam at the antimeridian or the poles, and indexed with a k-d tree built
+with NumPy. Nearest-neighbour queries walk the tree best first and compare
+whole leaves at once; bounding-box queries binary-search a latitude-sorted
+copy. No spatial database extension is needed.
+
+Each process builds the index once and rebuilds it when the location
+version in the cache changes, which happens whenever a city is created,
+moved or deleted.
+"""
+import heapq
+
+import numpy as np
+
+from apps.weather.caching import ProcessSnapshot, locations_version
+from apps.weather.models import City
+
+EARTH_RADIUS_KM = 6371.0088
+LEAF_SIZE = 32
+
+
+def unit_vectors(latitudes, longitudes):
+    """Return an (n, 3) array of points on the unit sphere for degrees"""
+    lat = np.radians(np.asarray(latitudes, dtype=np.float64))
+    lon = np.radians(np.asarray(longitudes, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+
+def location_keys(latitudes, longitudes):
+    """Pack coordinates, in micro-degrees, into one int64 key per point"""
+    lat = np.rint((np.asarray(latitudes, dtype=np.float64) + 90) * 1e6).astype(np.int64)
+    lon = np.rint((np.asarray(longitudes, dtype=np.float64) + 180) * 1e6).astype(np.int64)
+    return (lat << 29) | lon
+
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(np.asarray(chord) / 2, 1.0))
+
+
+class KDTree:
+    """
+    A static k-d tree over an (n, d) array of points.
+
+    Every node covers a contiguous range of the reordered points and keeps
+    their bounding box; leaves hold at most ``leaf_size`` points.
+    """
+    def __init__(self, points, leaf_size=LEAF_SIZE):
+        points = np.asarray(points, dtype=np.float64)
+        self.leaf_size = leaf_size
+        self.order = np.arange(len(points))
+        starts, ends, children, lowers, uppers = [], [], [], [], []
+
+        def build(lo, hi):
+            node = len(starts)
+            block = points[self.order[lo:hi]]
+            starts.append(lo)
+            ends.append(hi)
+            children.append((-1, -1))
+            lowers.append(block.min(axis=0))
+            uppers.append(block.max(axis=0))
+            if hi - lo > leaf_size:
+                # Split at the median of the widest dimension
+                axis = int(np.argmax(uppers[node] - lowers[node]))
+                mid = (lo + hi) // 2
+                part = np.argpartition(block[:, axis], mid - lo)
+                self.order[lo:hi] = self.order[lo:hi][part]
+                children[node] = (build(lo, mid), build(mid, hi))
+            return node
+
+        if len(points):
+            build(0, len(points))
+        self.points = points[self.order]
+        self.starts = starts
+        self.ends = ends
+        self.children = children
+        self.lowers = np.array(lowers).reshape(len(starts), points.shape[1])
+        self.uppers = np.array(uppers).reshape(len(starts), points.shape[1])
+
+    def __len__(self):
+        return len(self.points)
+
+    def query(self, point, k=1):
+        """
+        Return ``(indices, distances)`` of the ``k`` points nearest to
+        ``point``, nearest first; indices refer to the original array.
+        """
+        k = min(k, len(self))
+        if k < 1:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        point = np.asarray(point, dtype=np.float64)
+        best = np.empty(0)
+        best_index = np.empty(0, dtype=np.int64)
+        heap = [(0.0, 0)]
+        while heap:
+            bound, node = heapq.heappop(heap)
+            if len(best) == k and bound > best[-1]:
+                break
+            left, right = self.children[node]
+            if left < 0:
+                lo, hi = self.starts[node], self.ends[node]
+                distances = ((self.points[lo:hi] - point) ** 2).sum(axis=1)
+                candidates = np.concatenate((best, distances))
+                indices = np.concatenate((best_index, np.arange(lo, hi)))
+                keep = np.argsort(candidates, kind='stable')[:k]
+                best, best_index = candidates[keep], indices[keep]
+                continue
+            # Squared distance from the point to both children's boxes
+            pair = [left, right]
+            gaps = (
+                np.maximum(self.lowers[pair] - point, 0) + np.maximum(point - self.uppers[pair], 0)
+            )
+            for child, gap in zip(pair, (gaps ** 2).sum(axis=1)):
+                if len(best) < k or gap <= best[-1]:
+                    heapq.heappush(heap, (float(gap), child))
+        return self.order[best_index], np.sqrt(best)
+
+
+class CityIndex:
+    """Nearest-city and bounding-box lookups over a snapshot of the cities"""
+    def __init__(self, rows):
+        ids, names, countries, latitudes, longitudes = zip(*rows) if rows else ((),) * 5
+        self.ids = np.array(ids, dtype=np.int64)
+        self.names = list(names)
+        self.countries = list(countries)
+        self.latitudes = np.array(latitudes, dtype=np.float64)
+        self.longitudes = np.array(longitudes, dtype=np.float64)
+        self.tree = KDTree(unit_vectors(self.latitudes, self.longitudes))
+        self.by_latitude = np.argsort(self.latitudes, kind='stable')
+        self.sorted_latitudes = self.latitudes[self.by_latitude]
+        # Exact coordinates (the model keeps six places) packed into one key
+        locations = location_keys(self.latitudes, self.longitudes)
+        self.by_location = np.argsort(locations, kind='stable')
+        self.sorted_locations = locations[self.by_location]
+
+    @classmethod
+    def load(cls):
+        return cls(list(City.objects.values_list('id', 'name', 'country', 'latitude', 'longitude')))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def city(self, position, **extra):
+        return {
+            'id': int(self.ids[position]),
+            'name': self.names[position],
+            'country': self.countries[position],
+            'latitude': float(self.latitudes[position]),
+            'longitude': float(self.longitudes[position]),
+            **extra,
+        }
+
+    def nearest(self, latitude, longitude, k=10):
+        """Return the ``k`` cities nearest to a point, nearest first, with ``distance_km``"""
+        positions, chords = self.tree.query(unit_vectors([latitude], [longitude])[0], k)
+        return [
+            self.city(position, distance_km=round(float(km), 3))
+            for position, km in zip(positions, chord_to_km(chords))
+        ]
+
+    def locate(self, latitudes, longitudes):
+        """
+        Return the id of the city at exactly each of the given coordinates,
+        or -1 where there is none. Coordinates must be in range.
+        """
+        keys = location_keys(latitudes, longitudes)
+        positions = np.searchsorted(self.sorted_locations, keys)
+        positions = np.minimum(positions, max(len(self) - 1, 0))
+        found = np.zeros(len(keys), dtype=bool)
+        if len(self):
+            found = self.sorted_locations[positions] == keys
+        ids = np.full(len(keys), -1, dtype=np.int64)
+        ids[found] = self.ids[self.by_location[positions[found]]]
+        return ids
+
+    def within(self, south, west, north, east):
+        """
+        Return the positions of the cities inside a latitude/longitude box,
+        ordered by latitude. ``west > east`` means the box crosses the
+        antimeridian.
+        """
+        lo = np.searchsorted(self.sorted_latitudes, south, side='left')
+        hi = np.searchsorted(self.sorted_latitudes, north, side='right')
+        positions = self.by_latitude[lo:hi]
+        longitudes = self.longitudes[positions]
+        if west <= east:
+            inside = (longitudes >= west) & (longitudes <= east)
+        else:
+            inside = (longitudes >= west) | (longitudes <= east)
+        return positions[inside]
+
+
+_index = ProcessSnapshot(locations_version, CityIndex.load)
+
+
+def city_index():
+    """Return this process's CityIndex, rebuilt if the cities changed since it was built"""
+    return _index.get()
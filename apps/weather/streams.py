@@ -0,0 +1,280 @@
+"""
+Publish/subscribe of new readings for the live city pages.
+
+With WEATHER_LIVE_UPDATES on, every write path publishes the readings it
+added: single saves and bulk_create through the receivers,
+``ingest_weather`` and the live writer directly. Readings that an upsert
+wrote over are not published again. Subscribers are Server-Sent Events streams (see
+async_views.ReadingStreamView) served under ASGI, where an idle one is a
+suspended coroutine and a small asyncio.Queue rather than a thread.
+
+The in-process backend hands readings to this process's subscribers once
+the writing transaction commits, so it only reaches streams served by the
+process that wrote them. On PostgreSQL the readings are sent with
+``pg_notify`` instead, which the database also delivers on commit, and
+every server process runs one thread that LISTENs and hands them to its
+own subscribers; a reading ingested by a command or another worker reaches
+them all. WEATHER_STREAM_BACKEND picks one ("memory" or "postgres"), by
+default the one that fits the database.
+
+A subscriber that falls WEATHER_STREAM_QUEUE_SIZE messages behind is
+disconnected rather than buffered without bound; the browser reconnects
+with the id of the last message it saw and the missed readings are read
+from the database.
+"""
+import asyncio
+import json
+import logging
+import select
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import connection, connections, transaction
+from django.utils import timezone
+
+from apps.weather.pagination import EPOCH, MICROSECOND
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'weather_readings'
+# NOTIFY payloads must stay under 8000 bytes
+NOTIFY_PAYLOAD_LIMIT = 7000
+LISTEN_TIMEOUT = 5.0
+
+
+def reading_event(city_id, recorded_at, temperature, humidity, pressure, wind_speed, description,
+                  pk=None):
+    """The JSON-ready form of one reading sent to subscribers"""
+    return {
+        'id': pk,
+        'city': city_id,
+        'recorded_at': timezone.localtime(recorded_at).isoformat(),
+        'micros': (recorded_at - EPOCH) // MICROSECOND,
+        'temperature': float(temperature),
+        'humidity': int(humidity),
+        'pressure': int(pressure),
+        'wind_speed': float(wind_speed),
+        'description': description,
+    }
+
+
+def instance_event(reading):
+    return reading_event(
+        reading.city_id, reading.recorded_at, reading.temperature, reading.humidity,
+        reading.pressure, reading.wind_speed, reading.description, pk=reading.pk,
+    )
+
+
+class Subscription:
+    """One stream's queue of event lists, fed from any thread"""
+    def __init__(self, city_ids, loop, size):
+        self.city_ids = frozenset(city_ids)
+        self.loop = loop
+        self.queue = asyncio.Queue(size)
+        self.overflowed = False
+
+    def offer(self, events):
+        """Queue ``events``; runs on the subscription's event loop"""
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(events)
+        except asyncio.QueueFull:
+            # The stream ends and the client catches up from the database
+            self.overflowed = True
+            self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+
+class Hub:
+    """This process's subscriptions, by city id"""
+    def __init__(self):
+        self._by_city = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len({subscription for subscriptions in self._by_city.values()
+                    for subscription in subscriptions})
+
+    def subscribe(self, city_ids, loop=None):
+        subscription = Subscription(
+            city_ids, loop or asyncio.get_running_loop(),
+            getattr(settings, 'WEATHER_STREAM_QUEUE_SIZE', 100),
+        )
+        with self._lock:
+            for city_id in subscription.city_ids:
+                self._by_city[city_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for city_id in subscription.city_ids:
+                subscribers = self._by_city.get(city_id)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._by_city[city_id]
+
+    def wants(self, city_id):
+        return city_id in self._by_city
+
+    def clear(self):
+        with self._lock:
+            self._by_city.clear()
+
+    def dispatch(self, events):
+        """Hand each subscription the ``events`` of its cities; safe from any thread"""
+        with self._lock:
+            targets = defaultdict(list)
+            for event in events:
+                for subscription in self._by_city.get(event['city'], ()):
+                    targets[subscription].append(event)
+        for subscription, matched in targets.items():
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.offer, matched)
+            except RuntimeError:
+                # Its event loop is closed
+                self.unsubscribe(subscription)
+
+
+class MemoryBackend:
+    """Deliver to this process's subscribers once the transaction commits"""
+    def __init__(self, hub):
+        self.hub = hub
+
+    def wants(self, city_id):
+        return self.hub.wants(city_id)
+
+    def publish(self, events):
+        transaction.on_commit(lambda: self.hub.dispatch(events))
+
+    def start(self):
+        pass
+
+
+class PostgresBackend:
+    """Deliver through NOTIFY/LISTEN, to the subscribers of every process"""
+    def __init__(self, hub):
+        self.hub = hub
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def wants(self, city_id):
+        # Subscribers may be in any process
+        return True
+
+    def publish(self, events):
+        with connection.cursor() as cursor:
+            for payload in self.payloads(events):
+                cursor.execute('SELECT pg_notify(%s, %s)', [CHANNEL, payload])
+
+    @staticmethod
+    def payloads(events):
+        """Split ``events`` into JSON arrays that each fit one notification"""
+        chunk, size = [], 2
+        for event in events:
+            encoded = json.dumps(event, separators=(',', ':'))
+            if chunk and size + len(encoded) + 1 > NOTIFY_PAYLOAD_LIMIT:
+                yield '[' + ','.join(chunk) + ']'
+                chunk, size = [], 2
+            chunk.append(encoded)
+            size += len(encoded) + 1
+        if chunk:
+            yield '[' + ','.join(chunk) + ']'
+
+    def start(self):
+        """Start listening, once per process"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._listen, name='weather-stream-listener',
+                                                daemon=True)
+                self._thread.start()
+
+    def _listen(self):
+        wrapper = connections.create_connection('default')
+        while True:
+            raw = None
+            try:
+                raw = wrapper.get_new_connection(wrapper.get_connection_params())
+                raw.autocommit = True
+                raw.cursor().execute(f'LISTEN {CHANNEL}')
+                for payload in self._notifications(raw):
+                    self.hub.dispatch(json.loads(payload))
+            except Exception:
+                logger.exception('The weather stream listener lost its connection; reconnecting')
+                threading.Event().wait(LISTEN_TIMEOUT)
+            finally:
+                if raw is not None:
+                    try:
+                        raw.close()
+                    except Exception:
+                        pass
+
+    @staticmethod
+    def _notifications(raw):
+        if callable(getattr(raw, 'notifies', None)):  # psycopg 3
+            while True:
+                for notify in raw.notifies(timeout=LISTEN_TIMEOUT):
+                    yield notify.payload
+        else:  # psycopg2
+            while True:
+                if select.select([raw], [], [], LISTEN_TIMEOUT) == ([], [], []):
+                    continue
+                raw.poll()
+                while raw.notifies:
+                    yield raw.notifies.pop(0).payload
+
+
+_hub = Hub()
+_backends = {}
+
+
+def hub():
+    """Return this process's Hub"""
+    return _hub
+
+
+def backend():
+    """Return the WEATHER_STREAM_BACKEND of this process"""
+    name = getattr(settings, 'WEATHER_STREAM_BACKEND', None) or (
+        'postgres' if connection.vendor == 'postgresql' else 'memory'
+    )
+    if name not in _backends:
+        _backends[name] = {'memory': MemoryBackend, 'postgres': PostgresBackend}[name](_hub)
+    return _backends[name]
+
+
+def publishing():
+    """Whether readings are published at all; only with WEATHER_LIVE_UPDATES"""
+    return settings.WEATHER_LIVE_UPDATES
+
+
+def streams_served(request):
+    """Whether the server answering ``request`` serves reading streams: ASGI, with live updates on"""
+    return publishing() and isinstance(request, ASGIRequest)
+
+
+def publish_instances(readings):
+    """Send saved WeatherData rows to the subscribers of their cities"""
+    if not publishing():
+        return
+    target = backend()
+    events = [instance_event(reading) for reading in readings if target.wants(reading.city_id)]
+    if events:
+        target.publish(events)
+
+
+def publish_rows(readings):
+    """
+    publish_instances() for ingest.READING_FIELDS tuples, which have no
+    primary keys. Pass only new readings (see ingest.new_readings); an
+    upsert that rewrote a stored one is not a new reading.
+    """
+    if not publishing():
+        return
+    target = backend()
+    events = [reading_event(*reading) for reading in readings if target.wants(reading[0])]
+    if events:
+        target.publish(events)
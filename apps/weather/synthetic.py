@@ -0,0 +1,211 @@
+"""
+Seeded, vectorised synthetic weather for load testing.
+
+Every city gets its own random stream derived from ``(seed, city index)``,
+so a dataset is reproducible whatever the batch size or number of worker
+processes. Series are generated with NumPy a batch at a time and written
+through the ingest upsert path, so memory stays flat however many rows are
+requested.
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import django
+import numpy as np
+
+from apps.weather.caching import bump_locations
+from apps.weather.ingest import upsert_readings
+from apps.weather.models import City
+from apps.weather.signals import batched
+
+DEFAULT_BATCH_SIZE = 10000
+DAY_SECONDS = 24 * 3600
+YEAR_SECONDS = 365.25 * DAY_SECONDS
+
+DESCRIPTIONS = np.array([
+    'Clear sky', 'Sunny', 'Partly cloudy', 'Overcast', 'Light rain', 'Heavy rain', 'Foggy',
+])
+
+
+def city_specs(count, seed=0, named=()):
+    """
+    Return ``count`` city dicts (name, country, lat, lon), ``named`` first.
+
+    The generated cities sit on a 0.01 degree grid without repeats, so they
+    never collide on the (latitude, longitude) unique constraint.
+    """
+    specs = list(named)[:count]
+    rng = np.random.default_rng([seed, 0])
+    taken = {(round(spec['lat'], 2), round(spec['lon'], 2)) for spec in specs}
+    while len(specs) < count:
+        lat = round(float(rng.uniform(-60, 70)), 2)
+        lon = round(float(rng.uniform(-180, 180)), 2)
+        if (lat, lon) in taken:
+            continue
+        taken.add((lat, lon))
+        number = len(specs) + 1
+        specs.append({'name': f'Synthetic {number:05d}', 'country': 'Synthetic', 'lat': lat, 'lon': lon})
+    return specs
+
+
+def create_cities(specs):
+    """
+    Create the cities in ``specs`` that do not exist yet.
+
+    Returns ``(index, id, latitude)`` for every spec, the shape load_shard takes.
+    """
+    City.objects.bulk_create(
+        [
+            City(name=spec['name'], country=spec['country'], latitude=spec['lat'], longitude=spec['lon'])
+            for spec in specs
+        ],
+        ignore_conflicts=True
+    )
+    bump_locations()
+    ids = {
+        (name, country): (pk, float(latitude))
+        for pk, name, country, latitude in City.objects.filter(
+            name__in={spec['name'] for spec in specs}
+        ).values_list('pk', 'name', 'country', 'latitude')
+    }
+    return [
+        (index, *ids[spec['name'], spec['country']])
+        for index, spec in enumerate(specs)
+        if (spec['name'], spec['country']) in ids
+    ]
+
+
+class SeriesGenerator:
+    """
+    Metric generator for one city, fed consecutive timestamp batches.
+
+    Temperature follows a seasonal cycle scaled by latitude (flipped in the
+    southern hemisphere), a diurnal cycle peaking mid-afternoon and slowly
+    wandering noise. Humidity moves against the daily swing, pressure is a
+    bounded random walk and wind speed is Weibull distributed. Each component
+    draws from its own stream and the walks carry over between batches, so
+    the output does not depend on how the timestamps are split up.
+    """
+    def __init__(self, latitude, seed=0, index=0):
+        self.latitude = latitude
+        streams = np.random.SeedSequence([seed, index + 1]).spawn(5)
+        self.drift_rng, self.noise_rng, self.humidity_rng, self.pressure_rng, self.wind_rng = (
+            np.random.default_rng(stream) for stream in streams
+        )
+        self.drift = 0.0
+        self.pressure = 0.0
+
+    def generate(self, timestamps):
+        """Return the metric arrays at the given epoch-second timestamps"""
+        size = len(timestamps)
+        latitude = self.latitude
+        hemisphere = 1.0 if latitude >= 0 else -1.0
+        year_phase = 2 * np.pi * (timestamps % YEAR_SECONDS) / YEAR_SECONDS
+        day_phase = 2 * np.pi * (timestamps % DAY_SECONDS) / DAY_SECONDS
+
+        base = 27 - abs(latitude) * 0.4
+        seasonal = -hemisphere * (4 + abs(latitude) * 0.25) * np.cos(year_phase - 0.35)
+        diurnal = -4.5 * np.cos(day_phase - 0.65)
+        drift = self.drift + np.cumsum(self.drift_rng.normal(0, 0.03, size))
+        self.drift = float(drift[-1]) if size else self.drift
+        temperature = base + seasonal + diurnal + drift + self.noise_rng.normal(0, 1.2, size)
+
+        humidity = 70 - (temperature - base - seasonal) * 3 + self.humidity_rng.normal(0, 8, size)
+        humidity = np.clip(np.rint(humidity), 5, 100)
+
+        walk = self.pressure + np.cumsum(self.pressure_rng.normal(0, 0.8, size))
+        self.pressure = float(walk[-1]) if size else self.pressure
+        pressure = np.rint(1013 + np.clip(walk, -35, 35))
+
+        wind_speed = np.clip(self.wind_rng.weibull(2.0, size) * 6, 0, 60)
+
+        description = np.select(
+            [
+                (humidity >= 95) & (temperature < 8),
+                humidity >= 90,
+                humidity >= 80,
+                humidity >= 70,
+                humidity >= 55,
+                np.cos(day_phase - np.pi) > 0,
+            ],
+            [6, 5, 4, 3, 2, 1],
+            default=0,
+        )
+        return {
+            'temperature': np.round(temperature, 2),
+            'humidity': humidity.astype(np.int64),
+            'pressure': pressure.astype(np.int64),
+            'wind_speed': np.round(wind_speed, 2),
+            'description': DESCRIPTIONS[description],
+        }
+
+
+def city_readings(city_id, index, latitude, start, end, interval, seed=0, batch_size=DEFAULT_BATCH_SIZE):
+    """Yield batches of READING_FIELDS tuples for one city over [start, end)"""
+    generator = SeriesGenerator(latitude, seed, index)
+    step = int(interval.total_seconds())
+    first = int(start.timestamp())
+    total = max(0, -(-(int(end.timestamp()) - first) // step))
+    for offset in range(0, total, batch_size):
+        timestamps = first + step * np.arange(offset, min(offset + batch_size, total), dtype=np.int64)
+        series = generator.generate(timestamps)
+        recorded_at = [
+            datetime.fromtimestamp(ts, tz=dt_timezone.utc) for ts in timestamps.tolist()
+        ]
+        yield list(zip(
+            [city_id] * len(recorded_at),
+            recorded_at,
+            series['temperature'].tolist(),
+            series['humidity'].tolist(),
+            series['pressure'].tolist(),
+            series['wind_speed'].tolist(),
+            series['description'].tolist(),
+        ))
+
+
+def load_shard(cities, start, end, interval, seed=0, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Generate and upsert readings for ``cities``, a list of (index, id, latitude).
+
+    Returns the number of rows written. Callers are expected to hold a
+    ``batched()`` block and report the touched cities afterwards.
+    """
+    written = 0
+    for index, city_id, latitude in cities:
+        for batch in city_readings(city_id, index, latitude, start, end, interval, seed, batch_size):
+            written += upsert_readings(batch)
+    return written
+
+
+def _load_shard_process(cities, start, end, interval, seed, batch_size):
+    with batched():
+        return load_shard(cities, start, end, interval, seed, batch_size)
+
+
+def load_shards(cities, start, end, interval, seed=0, batch_size=DEFAULT_BATCH_SIZE, workers=1):
+    """
+    Split ``cities`` into ``workers`` shards and load each in its own process.
+
+    Each worker opens its own database connection, so this only pays off on
+    a server database; SQLite serialises the writers.
+    """
+    shards = [cities[number::workers] for number in range(workers)]
+    context = multiprocessing.get_context('spawn')
+    # Spawned children set Django up before unpickling any task that needs models
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=context, initializer=django.setup
+    ) as executor:
+        futures = [
+            executor.submit(_load_shard_process, shard, start, end, interval, seed, batch_size)
+            for shard in shards if shard
+        ]
+        return sum(future.result() for future in futures)
+
+
+def time_range(days, interval, now=None):
+    """Return ``(start, end)`` covering ``days`` up to ``now``, aligned to ``interval``"""
+    now = now or datetime.now(dt_timezone.utc)
+    step = int(interval.total_seconds())
+    end = datetime.fromtimestamp(int(now.timestamp()) // step * step, tz=dt_timezone.utc)
+    return end - timedelta(days=days), end
@@ -1,14 +1,66 @@
-from django.test import TestCase
-from django.core.exceptions import ValidationError
+from django.core.cache import cache
+from django.db import DatabaseError, IntegrityError, OperationalError, connection
+from django.db.models import F
+from django.test.utils import CaptureQueriesContext
+import time
+from django.test import TestCase, override_settings
+from django.core.exceptions import RequestDataTooBig, ValidationError
 from django.urls import reverse
 from django.utils import timezone
+from datetime import datetime, timedelta, timezone as dt_timezone
 from decimal import Decimal
-from .models import City, WeatherData
+from .models import (
+    City, CityStats, DailyWeather, HourlyWeather, MonthlyWeather, RollupDeletion, WeatherData,
+)
+from .rollups import DAY, HOUR, MONTH, RAW, build_all, pick_resolution
+from .series import lttb
+from .pagination import KeysetPaginator, encode_cursor
+from .charts import HISTORY_PAGE_SIZE
+from .rollups import series_queryset as rollup_series_queryset
+from .series import series_queryset
+from .views import CityDetailView, CityListView
+from apps.users.models import User
+from django.contrib import admin
+from django.test import RequestFactory
+import re
+import csv
+import gzip
+import json
+from .exports import EXPORT_FIELDS
 from .utils import generate_temperature_chart
+from . import renderer
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+import numpy as np
 from django.core.management import call_command
-from io import StringIO
-from django.test import Client
-from unittest.mock import patch
+from io import BytesIO, StringIO
+from django.test import AsyncClient, Client
+from unittest.mock import AsyncMock, patch
+import os
+import tempfile
+from .ingest import Ingestor, _copy_upsert, open_records, upsert_readings
+from .benchmarks import Measurement, compare
+from .signals import batched, readings_changed
+from django.core.management.base import CommandError
+from asgiref.sync import async_to_sync, sync_to_async
+from django.http import Http404
+from django.middleware.csrf import get_token
+from django.test import AsyncRequestFactory
+from .async_views import AsyncCityChartView, AsyncCityDetailView, AsyncCityListView
+from .charts import chart_version
+from .spatial import KDTree, unit_vectors
+from .search import CityPrefixIndex, fold
+from apps.common.paginator import EstimatedCountPaginator
+from .hotcache import hot_series, to_micros, warm_hot_series, warm_on_startup
+from .live import Batch, BloomFilter, LiveWriter, body_lines, reading_keys
+from .streams import MemoryBackend, PostgresBackend, hub, publish_rows, reading_event
+from .async_views import ReadingStreamView
+from .analytics import city_analytics, daily_extremes, ewma, rolling_stats
+from .compare import align, compare_cities
+from .spatial import city_index
+import asyncio
+import importlib
+import sys
 
 class CityModelTests(TestCase):
     def setUp(self):
@@ -175,6 +227,28 @@ class ManagementCommandTests(TestCase):
         call_command('load_weather_data', stdout=out)
         self.assertIn('Error loading weather data', out.getvalue())
 
+    def test_load_weather_data_scale_mode(self):
+        out = StringIO()
+        call_command(
+            'load_weather_data', '--cities=8', '--days=3', '--interval=30',
+            '--seed=7', '--until=2025-06-01T12:00:00', '--batch-size=50', stdout=out
+        )
+        self.assertIn('Successfully created 1152 weather records for 8 cities', out.getvalue())
+        self.assertEqual(City.objects.count(), 8)
+        self.assertEqual(CityStats.objects.get(city__name='London').reading_count, 144)
+        first = list(WeatherData.objects.order_by('city_id', 'recorded_at').values_list('temperature', flat=True))
+
+        # The same seed regenerates the same readings, whatever the batch size
+        call_command(
+            'load_weather_data', '--cities=8', '--days=3', '--interval=30',
+            '--seed=7', '--until=2025-06-01T12:00:00', '--batch-size=1000', stdout=StringIO()
+        )
+        self.assertEqual(WeatherData.objects.count(), 1152)
+        self.assertEqual(
+            list(WeatherData.objects.order_by('city_id', 'recorded_at').values_list('temperature', flat=True)),
+            first
+        )
+
 class ErrorHandlerTests(TestCase):
     def setUp(self):
         self.client = Client()
@@ -352,3 +426,2021 @@ class AdvancedWeatherTests(TestCase):
             reverse('city_detail', args=[self.city.pk]) + '?page=9999'
         )
         self.assertEqual(response.status_code, 200)  # Should handle gracefully
+
+class CityStatsRollupTests(TestCase):
+    def setUp(self):
+        self.city = City.objects.create(
+            name='London',
+            country='UK',
+            latitude=51.5074,
+            longitude=-0.1278
+        )
+        self.base_time = timezone.now()
+
+    def _reading(self, hours, temperature, humidity=60, wind_speed=5.0):
+        return WeatherData(
+            city=self.city,
+            temperature=temperature,
+            humidity=humidity,
+            pressure=1013,
+            wind_speed=wind_speed,
+            description='Test weather',
+            recorded_at=self.base_time + timezone.timedelta(hours=hours)
+        )
+
+    def test_stats_follow_single_and_bulk_inserts(self):
+        self._reading(0, 10.0).save()
+        WeatherData.objects.bulk_create([self._reading(i, 20.0 + i) for i in range(1, 4)])
+
+        stats = CityStats.objects.get(city=self.city)
+        self.assertEqual(stats.reading_count, 4)
+        self.assertAlmostEqual(stats.avg_temp, (10 + 21 + 22 + 23) / 4)
+        self.assertEqual(stats.temperature_min, 10.0)
+        self.assertEqual(stats.temperature_max, 23.0)
+        self.assertEqual(stats.last_recorded_at, self.base_time + timezone.timedelta(hours=3))
+
+    def test_stats_follow_deletes(self):
+        WeatherData.objects.bulk_create([self._reading(i, 20.0 + i) for i in range(5)])
+
+        WeatherData.objects.get(temperature=22).delete()
+        stats = CityStats.objects.get(city=self.city)
+        self.assertEqual(stats.reading_count, 4)
+        self.assertAlmostEqual(stats.avg_temp, (20 + 21 + 23 + 24) / 4)
+
+        WeatherData.objects.filter(temperature__gte=23).delete()
+        stats.refresh_from_db()
+        self.assertEqual(stats.reading_count, 2)
+        self.assertEqual(stats.temperature_max, 21.0)
+
+        WeatherData.objects.all().delete()
+        stats.refresh_from_db()
+        self.assertEqual(stats.reading_count, 0)
+        self.assertIsNone(stats.avg_temp)
+
+    def test_deleting_city_removes_stats(self):
+        WeatherData.objects.bulk_create([self._reading(i, 20.0) for i in range(3)])
+        self.city.delete()
+        self.assertFalse(CityStats.objects.exists())
+
+    def test_rebuild_command(self):
+        WeatherData.objects.bulk_create([self._reading(i, 15.0) for i in range(3)])
+        CityStats.objects.all().delete()
+
+        out = StringIO()
+        call_command('rebuild_city_stats', stdout=out)
+        self.assertIn('Successfully rebuilt stats for 1 cities', out.getvalue())
+        self.assertEqual(CityStats.objects.get(city=self.city).reading_count, 3)
+
+    def test_city_list_queries_do_not_grow_with_cities(self):
+        for i in range(10):
+            city = City.objects.create(name=f'City {i}', country='X', latitude=i, longitude=i)
+            WeatherData.objects.create(
+                city=city, temperature=i, humidity=50 + i, pressure=1000,
+                wind_speed=i, description='Test', recorded_at=self.base_time
+            )
+
+        # The HTTP validators (once per data version), the cities joined
+        # with their stats, and the extremes
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('city_list'))
+        summary = response.context['weather_summary']
+        self.assertEqual(summary['hottest_city'].name, 'City 9')
+        self.assertEqual(summary['coldest_city'].name, 'City 0')
+        self.assertEqual(summary['most_humid_city'].name, 'City 9')
+        self.assertEqual(summary['windiest_city'].name, 'City 9')
+        self.assertAlmostEqual(summary['hottest_city'].stats['avg_temp'], 9.0)
+
+class WeatherRollupTests(TestCase):
+    def setUp(self):
+        self.city = City.objects.create(
+            name='London',
+            country='UK',
+            latitude=51.5074,
+            longitude=-0.1278
+        )
+        self.start = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+        # Four readings per hour over two days
+        WeatherData.objects.bulk_create([
+            WeatherData(
+                city=self.city,
+                temperature=10 + (i % 4),
+                humidity=50,
+                pressure=1000 + i % 4,
+                wind_speed=2.0,
+                description='Test weather',
+                recorded_at=self.start + timedelta(minutes=15 * i)
+            )
+            for i in range(4 * 48)
+        ])
+
+    def test_build_all_resolutions(self):
+        written = build_all()
+        self.assertEqual(written, {'hour': 48, 'day': 2, 'month': 1})
+
+        hour = HourlyWeather.objects.get(city=self.city, bucket_start=self.start)
+        self.assertEqual(hour.reading_count, 4)
+        self.assertEqual(hour.temperature_min, 10)
+        self.assertEqual(hour.temperature_max, 13)
+        self.assertAlmostEqual(hour.temperature_mean, 11.5)
+
+        month = MonthlyWeather.objects.get(city=self.city)
+        self.assertEqual(month.reading_count, 192)
+        self.assertAlmostEqual(month.temperature_mean, 11.5)
+        self.assertAlmostEqual(month.pressure_mean, 1001.5)
+
+    def age(self, **delta):
+        """Pretend the readings so far were written ``delta`` before the last build"""
+        WeatherData.objects.update(updated_at=F('updated_at') - timedelta(**delta))
+
+    def test_incremental_build_resumes_from_written_rows(self):
+        build_all()
+        self.age(hours=1)
+        WeatherData.objects.create(
+            city=self.city, temperature=30, humidity=50, pressure=1000,
+            wind_speed=2.0, description='Late', recorded_at=self.start + timedelta(days=2)
+        )
+
+        out = StringIO()
+        call_command('build_weather_rollups', stdout=out)
+        self.assertIn('Built 1 hour buckets', out.getvalue())
+        self.assertEqual(HourlyWeather.objects.count(), 49)
+        self.assertEqual(DailyWeather.objects.count(), 3)
+        self.assertEqual(MonthlyWeather.objects.get().reading_count, 193)
+
+    def test_backfilled_readings_are_folded_in(self):
+        build_all()
+        self.age(hours=1)
+        # Behind the newest bucket, in an hour that already has a bucket
+        WeatherData.objects.create(
+            city=self.city, temperature=50, humidity=50, pressure=1000,
+            wind_speed=2.0, description='Late', recorded_at=self.start + timedelta(minutes=5)
+        )
+        build_all()
+        hour = HourlyWeather.objects.get(city=self.city, bucket_start=self.start)
+        self.assertEqual((hour.reading_count, hour.temperature_max), (5, 50))
+        self.assertEqual(DailyWeather.objects.get(bucket_start=self.start).reading_count, 97)
+        self.assertEqual(MonthlyWeather.objects.get().reading_count, 193)
+
+    def test_deleted_readings_are_taken_out(self):
+        build_all()
+        self.age(hours=1)
+        WeatherData.objects.get(city=self.city, recorded_at=self.start).delete()
+        # Every reading of the second day, through the queryset
+        WeatherData.objects.filter(recorded_at__gte=self.start + timedelta(days=1)).delete()
+        build_all()
+
+        hour = HourlyWeather.objects.get(city=self.city, bucket_start=self.start)
+        self.assertEqual((hour.reading_count, hour.temperature_min), (3, 11))
+        self.assertEqual(HourlyWeather.objects.count(), 24)
+        self.assertEqual(DailyWeather.objects.get().reading_count, 95)
+        self.assertEqual(MonthlyWeather.objects.get().reading_count, 95)
+        self.assertFalse(RollupDeletion.objects.exists())
+
+    def test_pick_resolution(self):
+        self.assertIs(pick_resolution(self.start, self.start + timedelta(days=1)), RAW)
+        self.assertIs(pick_resolution(self.start, self.start + timedelta(days=7)), HOUR)
+        self.assertIs(pick_resolution(self.start, self.start + timedelta(days=365)), DAY)
+        self.assertIs(pick_resolution(self.start, self.start + timedelta(days=3650)), MONTH)
+
+    def test_detail_view_charts_range_from_rollups(self):
+        build_all()
+        response = self.client.get(reverse('city_detail', args=[self.city.pk]) + '?range=7d')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['chart_resolution'], 'hour')
+
+class CompactionTests(TestCase):
+    def setUp(self):
+        self.city = City.objects.create(
+            name='London',
+            country='UK',
+            latitude=51.5074,
+            longitude=-0.1278
+        )
+        self.start = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+        # Four readings per hour over two days
+        WeatherData.objects.bulk_create([
+            WeatherData(
+                city=self.city,
+                temperature=10 + (i % 4),
+                humidity=50,
+                pressure=1000,
+                wind_speed=2.0,
+                description='Test weather',
+                recorded_at=self.start + timedelta(minutes=15 * i)
+            )
+            for i in range(4 * 48)
+        ])
+        # Raw readings are cut at 2025-01-02 12:00, hourly rollups at 2025-01-02
+        self.options = {'keep': ['raw=30', 'hour=30'], 'now': '2025-02-01T12:30:00+00:00'}
+
+    def compact(self, **options):
+        out = StringIO()
+        call_command('compact_weather', stdout=out, **{**self.options, **options})
+        return out.getvalue()
+
+    def test_folds_and_prunes_each_level(self):
+        output = self.compact(batch_size=50)
+        self.assertIn('Deleted 144 raw rows before 2025-01-02T12:00:00+00:00', output)
+        self.assertIn('Deleted 24 hour rows before 2025-01-02T00:00:00+00:00', output)
+        self.assertIn('Keeping all day rows', output)
+        self.assertRegex(output, r'Deleted 168 rows in total, reclaiming ~[\d.]+ (bytes|KB)')
+
+        self.assertEqual(WeatherData.objects.count(), 48)
+        self.assertEqual(HourlyWeather.objects.count(), 24)
+        self.assertEqual(
+            list(DailyWeather.objects.order_by('bucket_start').values_list('reading_count', flat=True)),
+            [96, 96]
+        )
+        self.assertAlmostEqual(DailyWeather.objects.first().temperature_mean, 11.5)
+        # Like a rebuild, the stats cover the readings that are still stored
+        self.assertEqual(CityStats.objects.get(city=self.city).reading_count, 48)
+        CityStats.objects.rebuild([self.city.pk])
+        self.assertEqual(CityStats.objects.get(city=self.city).reading_count, 48)
+
+        self.assertIn('Deleted 0 rows in total', self.compact())
+
+    def test_interrupted_run_resumes_without_refolding(self):
+        with patch('apps.weather.compaction.time.sleep', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                self.compact(batch_size=10, pause=1)
+        # The first batch ran on to the end of the hour its last row was in
+        self.assertEqual(WeatherData.objects.count(), 180)
+
+        self.compact()
+        self.assertEqual(WeatherData.objects.count(), 48)
+        # The hour the first run thinned out was not folded again
+        self.assertEqual(
+            sum(DailyWeather.objects.values_list('reading_count', flat=True)), 192
+        )
+
+    def test_backfilled_readings_are_folded_before_they_are_pruned(self):
+        build_all()
+        WeatherData.objects.bulk_create([
+            WeatherData(
+                city=self.city, temperature=5, humidity=50, pressure=1000, wind_speed=2.0,
+                description='Backfilled', recorded_at=datetime(2024, 12, 1, hour, tzinfo=dt_timezone.utc)
+            )
+            for hour in range(24)
+        ])
+        # Written before the last build as far as its checkpoint can tell
+        WeatherData.objects.filter(description='Backfilled').update(
+            updated_at=timezone.now() - timedelta(days=1)
+        )
+        self.compact()
+        self.assertFalse(WeatherData.objects.filter(description='Backfilled').exists())
+        backfilled = DailyWeather.objects.get(bucket_start=datetime(2024, 12, 1, tzinfo=dt_timezone.utc))
+        self.assertEqual((backfilled.reading_count, backfilled.temperature_mean), (24, 5))
+
+    def test_dry_run_and_invalid_policies(self):
+        self.assertIn('Would delete 144 raw rows', self.compact(dry_run=True))
+        self.assertEqual(WeatherData.objects.count(), 192)
+        self.assertFalse(HourlyWeather.objects.exists())
+
+        for keep in (['raw=30', 'hour=7'], ['day=30'], ['minute=1'], ['raw=soon']):
+            with self.assertRaises(CommandError):
+                self.compact(keep=keep)
+
+
+class CityChartCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.city = City.objects.create(
+            name='London',
+            country='UK',
+            latitude=51.5074,
+            longitude=-0.1278
+        )
+        self.base_time = timezone.now()
+        for i in range(3):
+            WeatherData.objects.create(
+                city=self.city, temperature=20 + i, humidity=60, pressure=1013,
+                wind_speed=5.0, description='Test weather',
+                recorded_at=self.base_time + timezone.timedelta(hours=i)
+            )
+
+    def _chart_url(self):
+        response = self.client.get(reverse('city_detail', args=[self.city.pk]))
+        return response.context['temperature_chart']
+
+    def test_detail_page_links_chart_instead_of_inlining_it(self):
+        response = self.client.get(reverse('city_detail', args=[self.city.pk]))
+        self.assertNotContains(response, 'data:image/png;base64')
+        self.assertContains(response, reverse('city_chart', args=[self.city.pk]))
+
+    def test_chart_is_rendered_once_per_version(self):
+        url = self._chart_url()
+        with patch('apps.weather.charts.render_records', return_value=b'png') as render:
+            first = self.client.get(url)
+            second = self.client.get(url)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first['Content-Type'], 'image/png')
+        self.assertIn('immutable', first['Cache-Control'])
+        self.assertEqual(second.content, b'png')
+        self.assertEqual(render.call_count, 1)
+
+    def test_new_data_changes_chart_url(self):
+        url = self._chart_url()
+        WeatherData.objects.create(
+            city=self.city, temperature=30, humidity=60, pressure=1013,
+            wind_speed=5.0, description='Test weather',
+            recorded_at=self.base_time + timezone.timedelta(hours=5)
+        )
+        new_url = self._chart_url()
+        self.assertNotEqual(url, new_url)
+
+        # The old URL now redirects to the current version
+        response = self.client.get(url)
+        self.assertRedirects(response, new_url, fetch_redirect_response=False)
+
+    def test_in_place_changes_and_rollup_builds_change_chart_url(self):
+        url = self._chart_url()
+        # Same reading, new temperature: the count and newest time stay put
+        Ingestor().ingest([{
+            'city': 'London', 'country': 'UK', 'temperature': 35, 'humidity': 60,
+            'pressure': 1013, 'wind_speed': 5.0, 'description': 'Corrected',
+            'recorded_at': self.base_time.isoformat(),
+        }])
+        corrected = self._chart_url()
+        self.assertNotEqual(url, corrected)
+
+        build_all()
+        self.assertNotEqual(corrected, self._chart_url())
+
+class ChartRendererTests(TestCase):
+    def setUp(self):
+        base_time = timezone.now()
+        self.datasets = [
+            [
+                SimpleNamespace(recorded_at=base_time + timezone.timedelta(hours=i), temperature=n + i)
+                for i in range(10)
+            ]
+            for n in range(6)
+        ]
+
+    def test_render_records_returns_png(self):
+        png = renderer.render_records(self.datasets[0])
+        self.assertTrue(png.startswith(b'\x89PNG'))
+        self.assertTrue(renderer.render_records([]).startswith(b'\x89PNG'))
+
+    @patch('apps.weather.utils.plt')
+    def test_renderer_does_not_use_pyplot(self, mock_plt):
+        renderer.render_records(self.datasets[0])
+        self.assertFalse(mock_plt.method_calls)
+
+    def test_concurrent_renders_from_threads(self):
+        jobs = [('temperature', *renderer.chart_data(readings)) for readings in self.datasets]
+        jobs = [(name, dates, [('temperature', values)]) for name, dates, values in jobs]
+        expected = [renderer.render(*job) for job in jobs]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            rendered = list(executor.map(lambda job: renderer.render(*job), jobs))
+        self.assertEqual(rendered, expected)
+
+class CitySeriesTests(TestCase):
+    def setUp(self):
+        self.city = City.objects.create(
+            name='London',
+            country='UK',
+            latitude=51.5074,
+            longitude=-0.1278
+        )
+        self.start = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+        WeatherData.objects.bulk_create([
+            WeatherData(
+                city=self.city,
+                temperature=50 if i == 1234 else 10 + (i % 24) / 2,
+                humidity=50,
+                pressure=1000,
+                wind_speed=2.0,
+                description='Test weather',
+                recorded_at=self.start + timedelta(minutes=10 * i)
+            )
+            for i in range(3000)
+        ])
+
+    def test_lttb_keeps_endpoints_and_peaks(self):
+        x = np.arange(100000, dtype=float)
+        y = np.sin(x / 1000)
+        y[54321] = 50
+        keep = lttb(x, y, 1000)
+        self.assertEqual(len(keep), 1000)
+        self.assertEqual(keep[0], 0)
+        self.assertEqual(keep[-1], 99999)
+        self.assertIn(54321, keep)
+        self.assertTrue(np.all(np.diff(keep) > 0))
+
+    def test_series_endpoint_downsamples(self):
+        response = self.client.get(
+            reverse('city_series', args=[self.city.pk]),
+            {'from': '2025-01-01', 'to': '2025-02-01', 'max_points': 200}
+        )
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['total_points'], 3000)
+        self.assertEqual(len(data['timestamps']), 200)
+        self.assertEqual(len(data['values']), 200)
+        self.assertEqual(data['timestamps'][0], int(self.start.timestamp()))
+        self.assertIn(50.0, data['values'])
+
+    def test_series_endpoint_defaults_to_latest_data(self):
+        response = self.client.get(reverse('city_series', args=[self.city.pk]), {'metric': 'humidity'})
+        data = response.json()
+        self.assertEqual(data['total_points'], 3000)
+        self.assertEqual(set(data['values']), {50.0})
+
+    def test_series_endpoint_rejects_bad_parameters(self):
+        url = reverse('city_series', args=[self.city.pk])
+        self.assertEqual(self.client.get(url, {'from': 'yesterday'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'max_points': 'lots'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'metric': 'rain'}).status_code, 400)
+        response = self.client.get(url, {'from': '2025-01-02', 'to': '2025-01-01'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], "'from' must be before 'to'")
+        self.assertEqual(self.client.get(url, {'from': '2025-01-01', 'to': '2025-01-01'}).status_code, 400)
+
+    def test_long_ranges_are_read_from_the_rollups(self):
+        build_all()
+        url = reverse('city_series', args=[self.city.pk])
+        query = {'from': '2025-01-01', 'to': '2025-02-01'}
+        with patch('apps.weather.api.MAX_SERIES_ROWS', 1000):
+            data = self.client.get(url, query).json()
+            # 500 hourly buckets of six readings each
+            self.assertEqual((data['resolution'], data['total_points']), ('hour', 500))
+            # Fewer points asked for than a month has hours: daily buckets
+            data = self.client.get(url, {**query, 'max_points': 200}).json()
+            self.assertEqual((data['resolution'], data['total_points']), ('day', 21))
+        self.assertEqual(self.client.get(url, query).json()['resolution'], 'raw')
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.city = City.objects.create(
+            name='London',
+            country='UK',
+            latitude=51.5074,
+            longitude=-0.1278
+        )
+        self.start = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+
+    def _create_readings(self, count):
+        WeatherData.objects.bulk_create([
+            WeatherData(
+                city=self.city, temperature=20, humidity=60, pressure=1013,
+                wind_speed=5.0, description='Test weather',
+                recorded_at=self.start + timedelta(minutes=i)
+            )
+            for i in range(count)
+        ], batch_size=5000)
+
+    def test_walk_older_and_back(self):
+        self._create_readings(25)
+        paginator = KeysetPaginator(self.city.weather_data.all(), 10)
+
+        first = paginator.page()
+        self.assertFalse(first.has_previous())
+        second = paginator.page(first.next_cursor)
+        third = paginator.page(second.next_cursor)
+        self.assertEqual(len(third), 5)
+        self.assertFalse(third.has_next())
+
+        back = paginator.page(third.previous_cursor)
+        self.assertEqual([r.pk for r in back], [r.pk for r in second])
+        newest = paginator.page(back.previous_cursor)
+        self.assertEqual([r.pk for r in newest], [r.pk for r in first])
+        self.assertFalse(newest.has_previous())
+
+        seen = [r.recorded_at for page in (first, second, third) for r in page]
+        self.assertEqual(seen, sorted(seen, reverse=True))
+        self.assertEqual(len(set(seen)), 25)
+
+    def test_invalid_cursor_falls_back_to_first_page(self):
+        self._create_readings(15)
+        response = self.client.get(reverse('city_detail', args=[self.city.pk]), {'cursor': 'bogus!'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.context['weather_data'][0].recorded_at, self.start + timedelta(minutes=14)
+        )
+        self.assertContains(response, '?cursor=' + response.context['weather_data'].next_cursor)
+
+    # The hot series cache would serve the first page without a query
+    @override_settings(WEATHER_PAGE_CACHE_TIMEOUT=0, WEATHER_HOT_READINGS=0)
+    def test_deep_page_costs_the_same_as_the_first(self):
+        per_page = 10
+        self._create_readings(per_page * 10000 + per_page)
+        # The cursor a visitor holds after paging 10,000 times
+        anchor = self.city.weather_data.order_by('-recorded_at', '-id')[per_page * 10000 - 1]
+        deep_cursor = encode_cursor('o', anchor.recorded_at, anchor.pk)
+        url = reverse('city_detail', args=[self.city.pk])
+
+        def timed(params):
+            timings = []
+            for _ in range(5):
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    response = self.client.get(url, params)
+                    timings.append(time.perf_counter() - started)
+            return response, min(timings), queries
+
+        first, first_time, first_queries = timed({})
+        deep, deep_time, deep_queries = timed({'cursor': deep_cursor})
+
+        self.assertEqual(len(deep.context['weather_data']), per_page)
+        self.assertEqual(
+            deep.context['weather_data'][0].recorded_at,
+            self.start + timedelta(minutes=per_page - 1)
+        )
+        self.assertEqual(len(first_queries), len(deep_queries))
+        for query in deep_queries.captured_queries:
+            self.assertNotIn('OFFSET', query['sql'])
+            self.assertNotIn('COUNT(', query['sql'])
+        # Generous bound: an OFFSET scan over 100k rows would be far slower
+        self.assertLess(deep_time, first_time * 3 + 0.01)
+
+def plan_problems(plan, vendor, allow_scan=()):
+    """Return the lines of an EXPLAIN plan that are full table scans or sorts"""
+    problems = []
+    for line in plan.splitlines():
+        step = line.strip(' |-`')
+        if vendor == 'sqlite':
+            match = re.search(r'\bSCAN (\w+)$', step)
+            if (match and match.group(1) not in allow_scan) or 'TEMP B-TREE' in step:
+                problems.append(step)
+        elif vendor == 'postgresql':
+            match = re.search(r'Seq Scan on (\w+)', step)
+            if (match and match.group(1) not in allow_scan) or re.match(r'(->\s*)?Sort\b', step):
+                problems.append(step)
+    return problems
+
+
+class QueryPlanTests(TestCase):
+    """
+    EXPLAIN the ORM queries behind the views and admin changelists on a
+    seeded dataset, and fail if any needs a full table scan or a sort.
+
+    PostgreSQL would happily seq-scan tables this small, so seq scans and
+    sorts are disabled there: any that remain have no index to use instead.
+    The city searches go through the prefix index and end up as id lookups.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cities = City.objects.bulk_create([
+            City(name=f'City {i:02d}', country=f'Country {i % 5}', latitude=i, longitude=i)
+            for i in range(20)
+        ])
+        cls.city = cities[0]
+        cls.start = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+        WeatherData.objects.bulk_create([
+            WeatherData(
+                city=city, temperature=i % 30, humidity=i % 100, pressure=1000,
+                wind_speed=i % 20, description='Test weather',
+                recorded_at=cls.start + timedelta(hours=i)
+            )
+            for city in cities
+            for i in range(500)
+        ], batch_size=2000)
+        build_all()
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        cls.admin_user = User.objects.create_superuser('admin', 'password')
+
+    def assertUsesIndexes(self, queryset, allow_scan=()):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute('SET LOCAL enable_sort = off')
+        plan = queryset.explain()
+        self.assertEqual(plan_problems(plan, connection.vendor, allow_scan), [], plan)
+
+    def _changelist(self, model, params=None):
+        request = RequestFactory().get('/admin/', params or {})
+        request.user = self.admin_user
+        model_admin = admin.site._registry[model]
+        changelist = model_admin.get_changelist_instance(request)
+        return changelist.queryset[:changelist.list_per_page]
+
+    def test_city_list_queries(self):
+        self.assertUsesIndexes(CityListView().get_queryset())
+        # The outer row source is LIMIT 1 with no ordering; the extremes
+        # themselves come from the indexed subqueries
+        self.assertUsesIndexes(CityStats.objects.extremes_queryset(), allow_scan=('weather_citystats',))
+
+    def test_city_detail_queries(self):
+        paginator = KeysetPaginator(self.city.weather_data.all(), HISTORY_PAGE_SIZE)
+        first = paginator.page()
+        older = paginator.page(first.next_cursor)
+        self.assertUsesIndexes(CityDetailView().get_queryset().filter(pk=self.city.pk))
+        self.assertUsesIndexes(paginator.query())
+        self.assertUsesIndexes(paginator.query(first.next_cursor))
+        self.assertUsesIndexes(paginator.query(older.previous_cursor))
+
+    def test_series_queries(self):
+        end = self.start + timedelta(days=20)
+        self.assertUsesIndexes(series_queryset(self.city.pk, self.start, end))
+        for resolution in (RAW, HOUR, DAY, MONTH):
+            self.assertUsesIndexes(rollup_series_queryset(resolution, self.city, self.start, end))
+
+    def test_admin_changelist_queries(self):
+        self.assertUsesIndexes(self._changelist(WeatherData))
+        self.assertUsesIndexes(self._changelist(WeatherData, {'city__id__exact': self.city.pk}))
+        self.assertUsesIndexes(self._changelist(WeatherData, {
+            'recorded_at__gte': '2025-01-02 00:00:00+00:00',
+            'recorded_at__lt': '2025-01-03 00:00:00+00:00',
+        }))
+        self.assertUsesIndexes(self._changelist(WeatherData, {
+            'city__id__exact': self.city.pk, 'month': '2025-01',
+        }))
+        self.assertUsesIndexes(self._changelist(City))
+        self.assertUsesIndexes(self._changelist(City, {'country': 'Country 1'}))
+        # Searches are answered from the prefix index, not by LIKE scans
+        self.assertUsesIndexes(self._changelist(City, {'q': 'city 0'}))
+
+    def test_unindexed_query_is_flagged(self):
+        plan = WeatherData.objects.filter(description='Test weather').order_by('temperature').explain()
+        self.assertTrue(plan_problems(plan, connection.vendor))
+
+class WeatherExportTests(TestCase):
+    def setUp(self):
+        self.city = City.objects.create(
+            name='London',
+            country='UK',
+            latitude=51.5074,
+            longitude=-0.1278
+        )
+        self.start = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+        WeatherData.objects.bulk_create([
+            WeatherData(
+                city=self.city, temperature=20.5, humidity=60, pressure=1013,
+                wind_speed=5.25, description='Partly cloudy, windy',
+                recorded_at=self.start + timedelta(hours=i)
+            )
+            for i in range(4500)
+        ])
+
+    def test_csv_export_streams_all_rows(self):
+        response = self.client.get(reverse('city_export_csv', args=[self.city.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertIn('london-weather.csv', response['Content-Disposition'])
+        rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(rows[0], list(EXPORT_FIELDS))
+        self.assertEqual(len(rows), 4501)
+        self.assertEqual(rows[1], [self.start.isoformat(), '20.5', '60', '1013', '5.25', 'Partly cloudy, windy'])
+
+    def test_gzipped_ndjson_export_with_date_range(self):
+        response = self.client.get(
+            reverse('city_export_ndjson', args=[self.city.pk]),
+            {'from': '2025-01-02T00:00:00+00:00', 'to': '2025-01-03T00:00:00+00:00', 'gzip': '1'}
+        )
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        lines = gzip.decompress(b''.join(response.streaming_content)).decode().splitlines()
+        self.assertEqual(len(lines), 24)
+        self.assertEqual(json.loads(lines[0])['recorded_at'], '2025-01-02T00:00:00+00:00')
+
+    def test_columns_api_is_smaller_than_the_row_export(self):
+        url = reverse('weather_columns')
+        everything = {'from': '2025-01-01', 'to': '2026-01-01'}
+        with self.assertNumQueries(1):
+            response = self.client.get(
+                url, {'cities': self.city.pk, 'fields': 'temperature,wind_speed', **everything}
+            )
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['fields'], ['temperature', 'wind_speed'])
+        columns = data['cities'][str(self.city.pk)]
+        self.assertEqual(len(columns['timestamps']), 4500)
+        self.assertEqual(columns['timestamps'][0], int(self.start.timestamp()))
+        self.assertEqual(columns['temperature'][:2], [20.5, 20.5])
+        self.assertEqual(columns['wind_speed'][0], 5.25)
+
+        response = self.client.get(url, {'cities': self.city.pk, **everything})
+        export = self.client.get(reverse('city_export_ndjson', args=[self.city.pk]))
+        self.assertLess(len(response.content) * 3, len(b''.join(export.streaming_content)))
+
+    def test_columns_api_defaults_to_a_week_and_caps_rows(self):
+        url = reverse('weather_columns')
+        data = self.client.get(url, {'cities': self.city.pk}).json()
+        self.assertEqual(len(data['cities'][str(self.city.pk)]['timestamps']), 7 * 24)
+        self.assertEqual(data['to'], (self.start + timedelta(hours=4499, seconds=1)).isoformat())
+
+        with patch('apps.weather.api.MAX_COLUMN_ROWS', 100):
+            response = self.client.get(url, {'cities': self.city.pk})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('more than 100 readings', response.json()['error'])
+            response = self.client.get(url, {
+                'cities': self.city.pk, 'from': self.start.isoformat(),
+                'to': (self.start + timedelta(days=4)).isoformat(),
+            })
+            self.assertEqual(len(response.json()['cities'][str(self.city.pk)]['timestamps']), 96)
+
+    def test_columns_api_splits_cities(self):
+        other = City.objects.create(name='Paris', country='France', latitude=48.85, longitude=2.35)
+        WeatherData.objects.create(
+            city=other, temperature=10, humidity=70, pressure=1000, wind_speed=1,
+            description='Rain', recorded_at=self.start + timedelta(hours=5)
+        )
+        response = self.client.get(reverse('weather_columns'), {
+            'cities': f'{other.pk},{self.city.pk},0',
+            'fields': 'humidity',
+            'from': '2025-01-01T05:00:00+00:00',
+            'to': '2025-01-01T07:00:00+00:00',
+        })
+        cities = response.json()['cities']
+        self.assertEqual(list(cities), [str(other.pk), str(self.city.pk), '0'])
+        self.assertEqual(
+            cities[str(other.pk)],
+            {'timestamps': [int(self.start.timestamp()) + 5 * 3600], 'humidity': [70.0]}
+        )
+        self.assertEqual(len(cities[str(self.city.pk)]['humidity']), 2)
+        self.assertEqual(cities['0'], {'timestamps': [], 'humidity': []})
+
+    def test_columns_api_rejects_bad_parameters(self):
+        url = reverse('weather_columns')
+        for params in ({}, {'cities': 'london'}, {'cities': '1', 'fields': 'rain'},
+                       {'cities': '1', 'from': 'yesterday'},
+                       {'cities': '1', 'from': '2025-01-02', 'to': '2025-01-01'},
+                       {'cities': '1', 'from': '2025-01-01', 'to': '2025-01-01'}):
+            self.assertEqual(self.client.get(url, params).status_code, 400)
+
+    def test_admin_export_action(self):
+        admin_user = User.objects.create_superuser('admin', 'password')
+        self.client.force_login(admin_user)
+        ids = list(WeatherData.objects.values_list('pk', flat=True)[:3])
+        response = self.client.post(reverse('admin:weather_weatherdata_changelist'), {
+            'action': 'export_as_csv',
+            '_selected_action': ids,
+        })
+        rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(rows[0][0], 'city__name')
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[1][0], 'London')
+
+
+class IngestWeatherTests(TestCase):
+    def setUp(self):
+        self.city = City.objects.create(
+            name='London',
+            country='UK',
+            latitude=51.5074,
+            longitude=-0.1278
+        )
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write_csv(self, rows):
+        path = os.path.join(self.directory.name, 'readings.csv')
+        fields = ['city', 'country', 'recorded_at', 'temperature', 'humidity', 'pressure', 'wind_speed', 'description']
+        with open(path, 'w', newline='') as handle:
+            writer = csv.DictWriter(handle, fields)
+            writer.writeheader()
+            writer.writerows(rows)
+        return path
+
+    def reading(self, hour, temperature=20.5):
+        return {
+            'city': 'london', 'country': 'UK',
+            'recorded_at': f'2025-01-01T{hour:02d}:00:00',
+            'temperature': temperature, 'humidity': 60, 'pressure': 1013,
+            'wind_speed': 5.2, 'description': 'Cloudy',
+        }
+
+    def test_csv_ingest_is_idempotent(self):
+        path = self.write_csv([self.reading(hour) for hour in range(24)])
+        out = StringIO()
+        call_command('ingest_weather', path, '--batch-size=10', stdout=out)
+        self.assertIn('Ingested 24 rows', out.getvalue())
+        self.assertIn('rows/s', out.getvalue())
+
+        # Re-running with changed values updates in place instead of failing
+        path = self.write_csv([self.reading(hour, temperature=30) for hour in range(24)])
+        call_command('ingest_weather', path, stdout=StringIO())
+        self.assertEqual(WeatherData.objects.count(), 24)
+        self.assertEqual(WeatherData.objects.filter(temperature=30).count(), 24)
+        self.assertEqual(
+            WeatherData.objects.earliest('recorded_at').recorded_at,
+            datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+        )
+        stats = CityStats.objects.get(city=self.city)
+        self.assertEqual(stats.reading_count, 24)
+        self.assertEqual(stats.avg_temp, 30)
+
+    def test_invalid_rows_are_skipped(self):
+        rows = [self.reading(0), self.reading(1), self.reading(2)]
+        rows[1]['humidity'] = 150
+        rows[2]['city'] = 'Atlantis'
+        out = StringIO()
+        call_command('ingest_weather', self.write_csv(rows), '--no-create-cities', stdout=out)
+        self.assertIn('Ingested 1 rows, skipped 2', out.getvalue())
+        self.assertEqual(WeatherData.objects.count(), 1)
+
+    def test_ndjson_ingest_creates_cities(self):
+        path = os.path.join(self.directory.name, 'readings.ndjson.gz')
+        with gzip.open(path, 'wt') as handle:
+            for hour in range(3):
+                record = self.reading(hour)
+                record.update(city='Paris', country='France', latitude=48.8566, longitude=2.3522)
+                handle.write(json.dumps(record) + '\n')
+
+        with CaptureQueriesContext(connection) as queries:
+            ingestor = Ingestor().ingest(open_records(path))
+        self.assertEqual(ingestor.written, 3)
+        paris = City.objects.get(name='Paris')
+        self.assertEqual(paris.weather_data.count(), 3)
+        self.assertEqual(CityStats.objects.get(city=paris).reading_count, 3)
+        # No per-row city lookups or inserts
+        self.assertLess(len(queries), 15)
+
+    def test_copy_keeps_blank_descriptions_not_null(self):
+        reading = (self.city.pk, datetime(2025, 1, 1, tzinfo=dt_timezone.utc), Decimal('1.50'), 60, 1013,
+                   Decimal('4'), '')
+        with patch('apps.weather.ingest.connection') as database:
+            _copy_upsert([reading])
+        cursor = database.cursor.return_value.__enter__.return_value
+        copy_sql, data = cursor.cursor.copy_expert.call_args.args
+        self.assertIn('FORCE_NOT_NULL (description)', copy_sql)
+        # The field is empty and unquoted, which COPY would otherwise load as NULL
+        self.assertEqual(data.getvalue(), f'{self.city.pk},2025-01-01T00:00:00+00:00,1.50,60,1013,4,\r\n')
+
+
+class BenchWeatherTests(TestCase):
+    def test_bench_weather_writes_and_compares_results(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'bench.json')
+
+        out = StringIO()
+        call_command(
+            'bench_weather', '--in-place', '--scales', '3', '--days=1', '--repeat=1',
+            f'--output={path}', stdout=out
+        )
+        with open(path) as handle:
+            results = json.load(handle)['results']
+        self.assertEqual(
+            {result['name'] for result in results},
+            {'city_list', 'city_detail', 'city_detail_deep_page', 'temperature_chart',
+             'city_export_ndjson', 'api_weather_columns', 'admin_city_changelist',
+             'admin_weatherdata_changelist'}
+        )
+        self.assertTrue(all(result['scale'] == 3 for result in results))
+        self.assertGreater(next(r for r in results if r['name'] == 'city_list')['queries'], 0)
+
+        # A baseline with fewer queries turns the run into a failure
+        for result in results:
+            result['queries'] -= 1
+            result['time_ms'] = result['peak_kb'] = 1e9
+        with open(path, 'w') as handle:
+            json.dump({'results': results}, handle)
+        with self.assertRaisesMessage(CommandError, 'regressed against the baseline'):
+            call_command(
+                'bench_weather', '--in-place', '--scales', '3', '--days=1', '--repeat=1',
+                f'--compare={path}', stdout=StringIO()
+            )
+
+    def test_compare_flags_slower_results(self):
+        baseline = [{'scale': 10, 'name': 'city_list', 'time_ms': 10.0, 'queries': 2, 'peak_kb': 100.0}]
+        fast = Measurement(10, 'city_list', 11.0, 11.0, 2, 100.0)
+        slow = Measurement(10, 'city_list', 13.0, 13.0, 2, 100.0)
+        new = Measurement(100, 'city_list', 50.0, 50.0, 2, 100.0)
+        report = compare([fast, slow, new], baseline, threshold=0.2)
+        self.assertEqual([problems for _, _, problems in report], [[], ['time 10.0ms -> 13.0ms'], []])
+        self.assertIsNone(report[2][1])
+
+
+class PageCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.city = City.objects.create(
+            name='London',
+            country='UK',
+            latitude=51.5074,
+            longitude=-0.1278
+        )
+        self.start = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+        WeatherData.objects.create(
+            city=self.city, temperature=20.5, humidity=60, pressure=1013,
+            wind_speed=5.2, description='Cloudy', recorded_at=self.start
+        )
+
+    def add_reading(self, hours, temperature):
+        return WeatherData.objects.create(
+            city=self.city, temperature=temperature, humidity=60, pressure=1013,
+            wind_speed=5.2, description='Cloudy', recorded_at=self.start + timedelta(hours=hours)
+        )
+
+    def test_repeat_hits_are_served_without_queries(self):
+        for url in (reverse('city_list'), reverse('city_detail', args=[self.city.pk])):
+            first = self.client.get(url)
+            with self.assertNumQueries(0):
+                second = self.client.get(url)
+            self.assertEqual(first.content, second.content)
+
+    def test_new_readings_invalidate_the_pages(self):
+        list_url = reverse('city_list')
+        detail_url = reverse('city_detail', args=[self.city.pk])
+        self.client.get(list_url)
+        self.client.get(detail_url)
+
+        self.add_reading(1, 30.5)
+        self.assertContains(self.client.get(list_url), '25.5°C')
+        self.assertContains(self.client.get(detail_url), '30.50')
+
+        # Bulk ingestion reports once and invalidates the same way
+        with batched():
+            WeatherData.objects.filter(city=self.city).update(temperature=10)
+        self.assertContains(self.client.get(detail_url), '25.5°C')
+        readings_changed.send(sender=WeatherData, city_ids=[self.city.pk])
+        self.assertContains(self.client.get(detail_url), '10.0°C')
+
+    def test_other_cities_stay_cached(self):
+        other = City.objects.create(name='Paris', country='France', latitude=48.8566, longitude=2.3522)
+        other_url = reverse('city_detail', args=[other.pk])
+        self.client.get(other_url)
+        self.add_reading(1, 30.5)
+        with self.assertNumQueries(0):
+            self.client.get(other_url)
+
+    def test_query_string_is_part_of_the_key(self):
+        url = reverse('city_detail', args=[self.city.pk])
+        self.client.get(url)
+        response = self.client.get(url, {'range': '7d'})
+        self.assertEqual(response.context['chart_range'], '7d')
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.city = City.objects.create(
+            name='London',
+            country='UK',
+            latitude=51.5074,
+            longitude=-0.1278
+        )
+        WeatherData.objects.create(
+            city=self.city, temperature=20.5, humidity=60, pressure=1013, wind_speed=5.2,
+            description='Cloudy', recorded_at=datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+        )
+
+    def urls(self):
+        return [
+            reverse('city_list'),
+            reverse('city_detail', args=[self.city.pk]),
+            reverse('city_export_csv', args=[self.city.pk]),
+        ]
+
+    def test_matching_etag_gets_304_without_running_the_view(self):
+        for url in self.urls():
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('public', response['Cache-Control'])
+            self.assertIn('max-age=60', response['Cache-Control'])
+            self.assertIn('Cookie', response['Vary'])
+            self.assertTrue(response.has_header('Last-Modified'))
+
+            with self.assertNumQueries(0):
+                revalidated = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(revalidated.status_code, 304)
+            self.assertEqual(revalidated.content, b'')
+
+            revalidated = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+            self.assertEqual(revalidated.status_code, 304)
+
+    def test_new_readings_change_the_validators(self):
+        etags = [self.client.get(url)['ETag'] for url in self.urls()]
+        WeatherData.objects.create(
+            city=self.city, temperature=30.5, humidity=60, pressure=1013, wind_speed=5.2,
+            description='Cloudy', recorded_at=datetime(2025, 1, 2, tzinfo=dt_timezone.utc)
+        )
+        for url, etag in zip(self.urls(), etags):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+
+    def test_chart_keeps_its_immutable_headers(self):
+        response = self.client.get(reverse('city_chart', args=[self.city.pk]), follow=True)
+        self.assertIn('immutable', response['Cache-Control'])
+        revalidated = self.client.get(response.request['PATH_INFO'] + '?' + response.request['QUERY_STRING'],
+                                      HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(revalidated.status_code, 304)
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.city = City.objects.create(
+            name='London',
+            country='UK',
+            latitude=51.5074,
+            longitude=-0.1278
+        )
+        for day in range(3):
+            WeatherData.objects.create(
+                city=self.city, temperature=20 + day, humidity=60, pressure=1013, wind_speed=5.2,
+                description='Cloudy', recorded_at=datetime(2025, 1, 1 + day, tzinfo=dt_timezone.utc)
+            )
+
+    def render_both(self, sync_view, async_view, path, **kwargs):
+        # Uncached, so the async view renders its own page under the same versions
+        with self.settings(WEATHER_PAGE_CACHE_TIMEOUT=0):
+            sync_response = sync_view.as_view()(RequestFactory().get(path), **kwargs)
+            sync_response.render()
+            async_response = async_to_sync(async_view.as_view())(AsyncRequestFactory().get(path), **kwargs)
+        return sync_response, async_response
+
+    def test_list_matches_sync_view(self):
+        sync_response, async_response = self.render_both(
+            CityListView, AsyncCityListView, reverse('city_list')
+        )
+        self.assertEqual(async_response.status_code, 200)
+        self.assertContains(async_response, 'London')
+        self.assertEqual(async_response.content, sync_response.content)
+
+    def test_detail_matches_sync_view(self):
+        sync_response, async_response = self.render_both(
+            CityDetailView, AsyncCityDetailView, reverse('city_detail', args=[self.city.pk]),
+            pk=self.city.pk,
+        )
+        self.assertEqual(async_response.status_code, 200)
+        self.assertEqual(async_response.content, sync_response.content)
+        self.assertTrue(async_response.has_header('ETag'))
+
+    def test_detail_without_stats_row_matches_sync_view(self):
+        # Both views aggregate the readings when the rollup row is missing
+        CityStats.objects.filter(city=self.city).delete()
+        sync_response, async_response = self.render_both(
+            CityDetailView, AsyncCityDetailView, reverse('city_detail', args=[self.city.pk]),
+            pk=self.city.pk,
+        )
+        self.assertContains(async_response, '21.0')
+        self.assertEqual(async_response.content, sync_response.content)
+
+    def test_detail_warms_the_chart_cache(self):
+        view = async_to_sync(AsyncCityDetailView.as_view())
+        view(AsyncRequestFactory().get('/'), pk=self.city.pk)
+        with patch('apps.weather.charts.arender_records') as render_records:
+            response = async_to_sync(AsyncCityChartView.as_view())(
+                AsyncRequestFactory().get('/', {'v': chart_version(self.city)}), pk=self.city.pk
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        render_records.assert_not_called()
+
+    def test_unknown_city_is_404(self):
+        with self.assertRaises(Http404):
+            async_to_sync(AsyncCityDetailView.as_view())(AsyncRequestFactory().get('/'), pk=0)
+
+    async def test_async_helpers_match_sync_ones(self):
+        paginator = KeysetPaginator(WeatherData.objects.filter(city=self.city), 2)
+        page = await paginator.apage(None)
+        self.assertEqual(
+            [reading.pk for reading in page],
+            [reading.pk async for reading in WeatherData.objects.order_by('-recorded_at', '-id')[:2]],
+        )
+        self.assertEqual(await CityStats.objects.aextremes(), await sync_to_async(CityStats.objects.extremes)())
+
+
+class SpatialIndexTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        for name, country, latitude, longitude in (
+            ('London', 'UK', 51.5074, -0.1278),
+            ('Paris', 'France', 48.8566, 2.3522),
+            ('New York', 'USA', 40.7128, -74.0060),
+            ('Suva', 'Fiji', -18.1248, 178.4501),
+            ('Apia', 'Samoa', -13.8507, -171.7514),
+        ):
+            City.objects.create(name=name, country=country, latitude=latitude, longitude=longitude)
+
+    def test_tree_matches_brute_force(self):
+        rng = np.random.default_rng(0)
+        latitudes = np.degrees(np.arcsin(rng.uniform(-1, 1, 2000)))
+        points = unit_vectors(latitudes, rng.uniform(-180, 180, 2000))
+        tree = KDTree(points, leaf_size=8)
+        for query in points[:50] + rng.normal(0, 0.01, (50, 3)):
+            indices, distances = tree.query(query, 7)
+            expected = np.argsort(((points - query) ** 2).sum(axis=1))[:7]
+            self.assertEqual(indices.tolist(), expected.tolist())
+            self.assertTrue(np.all(np.diff(distances) >= 0))
+        self.assertEqual(len(KDTree(np.empty((0, 3))).query([1, 0, 0], 3)[0]), 0)
+
+    def test_nearby_cities(self):
+        url = reverse('cities_nearby')
+        # Reading, west of London
+        response = self.client.get(url, {'lat': 51.45, 'lon': -0.97, 'k': 2})
+        cities = response.json()['cities']
+        self.assertEqual([city['name'] for city in cities], ['London', 'Paris'])
+        self.assertAlmostEqual(cities[0]['distance_km'], 58.6, delta=1)
+
+        # Across the antimeridian, Apia is nearer to Suva than anything else
+        with self.assertNumQueries(0):
+            response = self.client.get(url, {'lat': -18.1, 'lon': 179.9, 'k': 2})
+        self.assertEqual([city['name'] for city in response.json()['cities']], ['Suva', 'Apia'])
+
+    def test_index_follows_city_changes(self):
+        url = reverse('cities_nearby')
+        berlin = {'lat': 52.52, 'lon': 13.40, 'k': 1}
+        self.assertEqual(self.client.get(url, berlin).json()['cities'][0]['name'], 'Paris')
+        City.objects.create(name='Berlin', country='Germany', latitude=52.52, longitude=13.405)
+        self.assertEqual(self.client.get(url, berlin).json()['cities'][0]['name'], 'Berlin')
+
+    def test_bounding_box(self):
+        url = reverse('cities_bbox')
+        response = self.client.get(url, {'south': 40, 'west': -10, 'north': 55, 'east': 10})
+        self.assertEqual(response.json()['count'], 2)
+        self.assertEqual([city['name'] for city in response.json()['cities']], ['Paris', 'London'])
+
+        response = self.client.get(url, {'south': -20, 'west': 170, 'north': 0, 'east': -170, 'limit': 1})
+        self.assertEqual(response.json()['count'], 2)
+        self.assertEqual(len(response.json()['cities']), 1)
+
+    def test_bad_parameters(self):
+        for url, params in (
+            (reverse('cities_nearby'), {'lat': 91, 'lon': 0}),
+            (reverse('cities_nearby'), {'lon': 0}),
+            (reverse('cities_nearby'), {'lat': 0, 'lon': 'east'}),
+            (reverse('cities_bbox'), {'south': 10, 'north': 0, 'west': 0, 'east': 1}),
+        ):
+            self.assertEqual(self.client.get(url, params).status_code, 400)
+
+
+class CityPrefixIndexTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        for name, country, latitude in (
+            ('São Paulo', 'Brazil', -23.55),
+            ('London', 'UK', 51.51),
+            ('Londonderry', 'UK', 55.0),
+            ('Long Beach', 'USA', 33.77),
+            ('New York', 'USA', 40.71),
+            ('Zürich', 'Switzerland', 47.37),
+        ):
+            City.objects.create(name=name, country=country, latitude=latitude, longitude=0)
+
+    def suggest(self, query, **params):
+        response = self.client.get(reverse('cities_suggest'), {'q': query, **params})
+        return [city['name'] for city in response.json()['cities']]
+
+    def test_fold(self):
+        self.assertEqual(fold('  Zürich '), 'zurich')
+        self.assertEqual(fold('SÃO'), 'sao')
+
+    def test_prefixes_of_every_word_ignoring_accents(self):
+        self.assertEqual(self.suggest('lon'), ['London', 'Londonderry', 'Long Beach'])
+        self.assertEqual(self.suggest('LONDON'), ['London', 'Londonderry'])
+        self.assertEqual(self.suggest('sao'), ['São Paulo'])
+        self.assertEqual(self.suggest('paulo'), ['São Paulo'])
+        self.assertEqual(self.suggest('zur'), ['Zürich'])
+        self.assertEqual(self.suggest('new  y'), ['New York'])
+        self.assertEqual(self.suggest('beach'), ['Long Beach'])
+        # Countries match too, each city once
+        self.assertEqual(self.suggest('usa'), ['Long Beach', 'New York'])
+        self.assertEqual(self.suggest('lon', k=1), ['London'])
+        self.assertEqual(self.suggest(' '), [])
+        self.assertEqual(self.suggest('york city'), [])
+
+    def test_suggestions_need_no_queries_and_follow_changes(self):
+        self.suggest('par')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.suggest('par'), [])
+        City.objects.create(name='Paris', country='France', latitude=48.86, longitude=2.35)
+        self.assertEqual(self.suggest('par'), ['Paris'])
+
+    def test_admin_search_uses_the_index(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'password'))
+        response = self.client.get(reverse('admin:weather_city_changelist'), {'q': 'zur'})
+        self.assertEqual([city.name for city in response.context['cl'].result_list], ['Zürich'])
+        response = self.client.get(reverse('admin:weather_city_changelist'), {'q': 'uk'})
+        self.assertEqual(response.context['cl'].result_count, 2)
+
+    def test_city_ids(self):
+        index = CityPrefixIndex([(1, 'Oslo', 'Norway'), (2, 'Osaka', 'Japan')])
+        self.assertEqual(index.city_ids('os'), {1, 2})
+        self.assertEqual(index.city_ids('nor'), {1})
+
+
+class WeatherDataAdminTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.start = datetime(2025, 1, 20, tzinfo=dt_timezone.utc)
+        self.cities = [
+            City.objects.create(name=f'City {i}', country='Country', latitude=i, longitude=i)
+            for i in range(3)
+        ]
+        self.client.force_login(User.objects.create_superuser('admin', 'password'))
+        self.url = reverse('admin:weather_weatherdata_changelist')
+        self.added = 0
+
+    def add_readings(self, count):
+        # One reading a day per city, in turn
+        WeatherData.objects.bulk_create([
+            WeatherData(
+                city=self.cities[i % 3], temperature=20, humidity=60, pressure=1013, wind_speed=5,
+                description='Cloudy', recorded_at=self.start + timedelta(days=i // 3)
+            )
+            for i in range(self.added, self.added + count)
+        ])
+        self.added += count
+
+    def changelist_queries(self, params=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, params or {})
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_query_count_does_not_grow_with_the_page(self):
+        self.add_readings(3)
+        _, few = self.changelist_queries()
+        self.add_readings(60)
+        response, many = self.changelist_queries()
+        self.assertEqual(few, many)
+        self.assertEqual(response.context['cl'].result_count, 63)
+
+    def test_city_filter_renders_only_the_selected_city(self):
+        self.add_readings(9)
+        response, _ = self.changelist_queries({'city__id__exact': self.cities[1].pk})
+        self.assertEqual(response.context['cl'].result_count, 3)
+        self.assertContains(response, 'data-url="/cities/suggest"')
+        self.assertContains(response, 'City 1, Country')
+        self.assertNotContains(response, 'City 2, Country')
+        self.assertEqual(self.client.get(self.url, {'city__id__exact': 'x'}).status_code, 302)
+
+    def test_month_filter_lists_rollup_months(self):
+        self.add_readings(45)
+        build_all()
+        response, _ = self.changelist_queries()
+        month_filter = next(
+            spec for spec in response.context['cl'].filter_specs if spec.parameter_name == 'month'
+        )
+        self.assertEqual(
+            month_filter.lookup_choices, [('2025-02', 'February 2025'), ('2025-01', 'January 2025')]
+        )
+
+        response, _ = self.changelist_queries({'month': '2025-02'})
+        self.assertEqual(response.context['cl'].result_count, 3 * 3)
+        self.assertEqual(self.client.get(self.url, {'month': '2025-13'}).status_code, 302)
+
+    def test_search_matches_city_names(self):
+        self.add_readings(9)
+        response, _ = self.changelist_queries({'q': 'city 2'})
+        self.assertEqual(response.context['cl'].result_count, 3)
+        # Descriptions match by their start too
+        WeatherData.objects.filter(city=self.cities[0]).update(description='Light rain')
+        response, _ = self.changelist_queries({'q': 'light'})
+        self.assertEqual(response.context['cl'].result_count, 3)
+
+    def test_stats_and_rollups_are_read_only(self):
+        self.add_readings(3)
+        build_all()
+        CityStats.objects.rebuild([city.pk for city in self.cities])
+        for model in (CityStats, HourlyWeather, DailyWeather, MonthlyWeather):
+            model_admin = admin.site._registry[model]
+            request = RequestFactory().get('/')
+            request.user = User.objects.get(username='admin')
+            obj = model.objects.first()
+            self.assertFalse(model_admin.has_add_permission(request))
+            self.assertFalse(model_admin.has_change_permission(request, obj))
+            self.assertFalse(model_admin.has_delete_permission(request, obj))
+            self.assertNotIn('delete_selected', model_admin.get_actions(request))
+
+    def test_paginator_estimates_large_counts(self):
+        self.add_readings(30)
+        queryset = WeatherData.objects.all()
+        with patch.object(EstimatedCountPaginator, 'exact_limit', 10):
+            with patch('apps.common.paginator.estimate_count', return_value=1000) as estimate:
+                self.assertEqual(EstimatedCountPaginator(queryset, 5).count, 1000)
+            estimate.assert_called_once()
+            # Without an estimate the exact count is used
+            self.assertEqual(EstimatedCountPaginator(queryset, 5).count, 30)
+        with patch('apps.common.paginator.estimate_count') as estimate:
+            self.assertEqual(EstimatedCountPaginator(queryset, 5).count, 30)
+        estimate.assert_not_called()
+
+
+@override_settings(WEATHER_PAGE_CACHE_TIMEOUT=0, WEATHER_HOT_READINGS=12, WEATHER_HOT_CITIES=2)
+class HotSeriesTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        hot_series().clear()
+        self.city = City.objects.create(
+            name='London',
+            country='UK',
+            latitude=51.5074,
+            longitude=-0.1278
+        )
+        self.start = datetime(2025, 1, 1, 0, 0, 0, 250000, tzinfo=dt_timezone.utc)
+        self.added = 0
+        self.add_readings(20)
+
+    def tearDown(self):
+        hot_series().clear()
+
+    def add_readings(self, count, city=None):
+        WeatherData.objects.bulk_create([
+            WeatherData(
+                city=city or self.city, temperature=20.47 + i, humidity=60 + i % 5, pressure=1013,
+                wind_speed=5.2, description=('Cloudy', 'Sunny')[i % 2],
+                recorded_at=self.start + timedelta(hours=self.added + i)
+            )
+            for i in range(count)
+        ])
+        self.added += count
+        CityStats.objects.rebuild([self.city.pk])
+        readings_changed.send(sender=WeatherData, city_ids=[self.city.pk])
+
+    def test_first_page_and_chart_are_served_without_queries(self):
+        url = reverse('city_detail', args=[self.city.pk])
+        with self.settings(WEATHER_HOT_READINGS=0):
+            expected = self.client.get(url)
+
+        warm_hot_series()
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.content, expected.content)
+        self.assertContains(response, '39.47°C')
+        self.assertEqual(
+            [reading.pk for reading in response.context['weather_data']],
+            [reading.pk for reading in expected.context['weather_data']],
+        )
+
+        with patch('apps.weather.charts.render_records', return_value=b'png') as render:
+            with self.assertNumQueries(0):
+                chart = self.client.get(response.context['temperature_chart'])
+        self.assertEqual(chart.content, b'png')
+        self.assertEqual(
+            [reading.temperature for reading in render.call_args[0][0]],
+            [Decimal(f'{39.47 - i:.2f}') for i in range(HISTORY_PAGE_SIZE)],
+        )
+
+        # Older pages still come from the database, and continue the hot one
+        older = self.client.get(url, {'cursor': response.context['weather_data'].next_cursor})
+        self.assertEqual(
+            [reading.pk for reading in older.context['weather_data']],
+            list(self.city.weather_data.order_by('-recorded_at', '-id').values_list('pk', flat=True)[10:20]),
+        )
+
+    def test_ring_keeps_the_newest_readings(self):
+        series = hot_series().get(self.city.pk)
+        self.assertEqual(len(series), 12)
+        self.assertFalse(series.complete)
+        newest = series.readings(3)
+        self.assertEqual(newest[0].recorded_at, self.start + timedelta(hours=19))
+        self.assertEqual([reading.description for reading in newest], ['Sunny', 'Cloudy', 'Sunny'])
+
+        # Appending past the capacity overwrites the oldest reading in place
+        for hour in range(20, 25):
+            series.push(1000 + hour, to_micros(self.start + timedelta(hours=hour)), [1, 2, 3, 4], 'Rain')
+        self.assertEqual(len(series), 12)
+        self.assertEqual(series.readings(12)[-1].recorded_at, self.start + timedelta(hours=13))
+        self.assertEqual(series.readings(1)[0].humidity, 2)
+        with self.assertRaises(ValueError):
+            series.push(1, 0, [1, 2, 3, 4], 'Rain')
+
+        # A city with fewer readings than a page is complete
+        other = City.objects.create(name='Paris', country='France', latitude=48.8566, longitude=2.3522)
+        page = hot_series().get(other.pk).page(HISTORY_PAGE_SIZE)
+        self.assertEqual(len(page), 0)
+        self.assertFalse(page.has_next())
+
+    def test_changes_elsewhere_reload_the_series(self):
+        held = hot_series().get(self.city.pk)
+        with batched():
+            WeatherData.objects.filter(city=self.city).update(temperature=10)
+        self.assertIs(hot_series().get(self.city.pk), held)
+        readings_changed.send(sender=WeatherData, city_ids=[self.city.pk])
+        self.assertEqual(hot_series().get(self.city.pk).readings(1)[0].temperature, Decimal('10.00'))
+
+    def test_created_readings_are_appended(self):
+        hot_series().get(self.city.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            reading = WeatherData.objects.create(
+                city=self.city, temperature=-3.5, humidity=90, pressure=990, wind_speed=12.25,
+                description='Snow', recorded_at=self.start + timedelta(days=2)
+            )
+        with self.assertNumQueries(0):
+            series = hot_series().peek(self.city.pk)
+        self.assertIsNotNone(series)
+        newest = series.readings(1)[0]
+        self.assertEqual(
+            (newest.pk, newest.recorded_at, newest.temperature, newest.wind_speed, newest.description),
+            (reading.pk, reading.recorded_at, Decimal('-3.50'), Decimal('12.25'), 'Snow'),
+        )
+        self.assertEqual(series.city.weather_stats.reading_count, 21)
+
+    def test_least_recently_used_cities_are_dropped(self):
+        others = [
+            City.objects.create(name=f'City {i}', country='Country', latitude=i, longitude=i)
+            for i in range(2)
+        ]
+        hot_series().get(self.city.pk)
+        for city in others:
+            hot_series().get(city.pk)
+        self.assertNotIn(self.city.pk, hot_series())
+        self.assertEqual(len(hot_series()), 2)
+        self.assertIsNone(hot_series().get(0))
+
+        # Several cities are read in one windowed query
+        self.add_readings(3, city=others[0])
+        with self.assertNumQueries(2):
+            loaded = hot_series().load([self.city.pk, others[0].pk])
+        self.assertEqual({city_id: len(series) for city_id, series in loaded.items()},
+                         {self.city.pk: 12, others[0].pk: 3})
+        self.assertEqual(loaded[self.city.pk].readings(1)[0].recorded_at, self.start + timedelta(hours=19))
+
+    def test_memory_report(self):
+        out = StringIO()
+        call_command('hot_series', stdout=out)
+        per_city = 12 * (8 + 8 + 2 + 4 * 4)
+        self.assertEqual(hot_series().memory(), {self.city.pk: per_city})
+        self.assertIn(f'London, UK (#{self.city.pk}): 12 readings, {per_city:,} bytes', out.getvalue())
+        with self.settings(WEATHER_HOT_READINGS=0):
+            with self.assertRaises(CommandError):
+                call_command('hot_series', stdout=StringIO())
+
+    @patch('apps.weather.hotcache._warmed', False)
+    def test_asgi_lifespan_startup_warms_the_cache(self):
+        application = AsyncMock()
+        messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message['type'])
+
+        async_to_sync(warm_on_startup(application))({'type': 'lifespan'}, receive, send)
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        self.assertIsNotNone(hot_series().peek(self.city.pk))
+        application.assert_not_called()
+
+    async def test_server_modules_import_inside_an_event_loop(self):
+        # Servers import them with their loop already running
+        for module in ('core.asgi', 'core.wsgi'):
+            sys.modules.pop(module, None)
+            importlib.import_module(module)
+
+
+@override_settings(WEATHER_INGEST_TOKENS=['station-secret'], WEATHER_LIVE_WRITER_THREAD=False)
+class LiveReadingsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.city = City.objects.create(
+            name='London',
+            country='UK',
+            latitude=51.5074,
+            longitude=-0.1278
+        )
+        self.writer = LiveWriter()
+        patcher = patch('apps.weather.api.live_writer', return_value=self.writer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def reading(self, hour, **fields):
+        return {
+            'city': self.city.pk, 'recorded_at': f'2025-01-01T{hour:02d}:00:00Z',
+            'temperature': 20.5, 'humidity': 60, 'pressure': 1013, 'wind_speed': 5.2,
+            'description': 'Cloudy', **fields,
+        }
+
+    def post(self, records, token='station-secret'):
+        body = '\n'.join(json.dumps(record) for record in records)
+        headers = {'HTTP_AUTHORIZATION': f'Bearer {token}'} if token else {}
+        return self.client.post(
+            reverse('live_readings'), body, content_type='application/x-ndjson', **headers
+        )
+
+    def test_readings_are_validated_and_written_in_one_batch(self):
+        records = [self.reading(hour) for hour in range(5)]
+        records[1]['humidity'] = 101
+        records[2]['city'] = 999999
+        # The city can also be named by its coordinates
+        records[3] = self.reading(3, city=None, latitude=51.5074, longitude=-0.1278)
+        records.append(self.reading(6, city=None, latitude=91, longitude=0))
+
+        response = self.post(records)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()['accepted'], 3)
+        self.assertEqual(response.json()['rejected'], 3)
+        self.assertEqual(
+            [(error['line'], error['error']) for error in response.json()['errors']],
+            [(2, "'humidity' must be between 0 and 100"), (3, "'city' is not a known city id"),
+             (6, "'latitude' must be between -90 and 90")],
+        )
+        # Nothing is written on the request path
+        self.assertEqual(WeatherData.objects.count(), 0)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.writer.drain(), 3)
+        self.assertLess(len(queries), 15)
+        self.assertEqual(WeatherData.objects.count(), 3)
+        self.assertEqual(CityStats.objects.get(city=self.city).reading_count, 3)
+        reading = WeatherData.objects.get(recorded_at=datetime(2025, 1, 1, 3, tzinfo=dt_timezone.utc))
+        self.assertEqual(reading.wind_speed, Decimal('5.20'))
+
+    def test_resent_readings_are_skipped(self):
+        self.post([self.reading(hour) for hour in range(3)])
+        self.writer.drain()
+
+        # Resending overlaps the stored readings; repeats inside a batch count too
+        records = [self.reading(hour) for hour in range(1, 5)] + [self.reading(4)]
+        response = self.post(records)
+        self.assertEqual(response.json()['accepted'], 2)
+        self.assertEqual(response.json()['duplicates'], 3)
+        self.writer.drain()
+        self.assertEqual(WeatherData.objects.count(), 5)
+
+        # Keys the filter has never seen need no lookup
+        batch = Batch.parse([json.dumps(self.reading(hour)) for hour in range(10, 20)])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.writer.accept(batch), (10, 0))
+
+    def test_authentication_and_backpressure(self):
+        self.assertEqual(self.post([self.reading(0)], token=None).status_code, 401)
+        self.assertEqual(self.post([self.reading(0)], token='wrong').status_code, 401)
+        user = User.objects.create_user(username='viewer', password='pass')
+        self.client.force_login(user)
+        self.assertEqual(self.post([self.reading(0)], token=None).status_code, 403)
+        user.is_superuser = True
+        user.save()
+        self.assertEqual(self.post([self.reading(0)], token=None).status_code, 202)
+
+        with self.settings(WEATHER_LIVE_MAX_PENDING=2):
+            response = self.post([self.reading(hour) for hour in range(1, 4)])
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(self.post(['not json']).status_code, 202)
+        self.assertEqual(self.client.post(reverse('live_readings'), '', content_type='application/x-ndjson',
+                                          HTTP_AUTHORIZATION='Bearer station-secret').status_code, 400)
+
+    def test_values_are_checked_as_stored(self):
+        records = [self.reading(0, temperature=999.996), self.reading(1, humidity=50.7),
+                   self.reading(2, pressure=1013.5), self.reading(3, temperature=999.994, humidity=50.0)]
+        response = self.post(records)
+        self.assertEqual(
+            [(error['line'], error['error']) for error in response.json()['errors']],
+            [(1, "'temperature' is out of range"), (2, "'humidity' must be an integer"),
+             (3, "'pressure' must be an integer")],
+        )
+        self.assertEqual(self.writer.drain(), 1)
+        self.assertEqual(WeatherData.objects.get().temperature, Decimal('999.99'))
+
+    def test_a_refused_reading_does_not_drop_its_batch(self):
+        bad = datetime(2025, 1, 1, 2, tzinfo=dt_timezone.utc)
+
+        def upsert(readings):
+            if any(reading[1] == bad for reading in readings):
+                raise IntegrityError('refused')
+            return upsert_readings(readings)
+
+        self.post([self.reading(hour) for hour in range(5)])
+        with patch('apps.weather.live.upsert_readings', side_effect=upsert), \
+                self.assertLogs('apps.weather.live', 'ERROR'):
+            self.assertEqual(self.writer.drain(), 4)
+        self.assertEqual(self.writer.failed, 1)
+        self.assertEqual(WeatherData.objects.count(), 4)
+        self.assertFalse(WeatherData.objects.filter(recorded_at=bad).exists())
+
+    def test_known_bad_readings_and_outages_are_not_bisected(self):
+        good = [(self.city.pk, datetime(2025, 1, 1, hour, tzinfo=dt_timezone.utc), Decimal('1'), 50, 1000,
+                 Decimal('2'), '') for hour in range(4)]
+        # A city deleted after the reading was accepted, and a value out of range
+        gone = (999999, good[0][1], Decimal('1'), 50, 1000, Decimal('2'), 'Fog')
+        too_wet = (self.city.pk, good[0][1], Decimal('1'), 150, 1000, Decimal('2'), 'Fog')
+        self.writer.submit(good[:2] + [gone, too_wet] + good[2:])
+        with patch('apps.weather.live.upsert_readings', side_effect=upsert_readings) as upsert, \
+                self.assertLogs('apps.weather.live', 'ERROR'):
+            self.assertEqual(self.writer.drain(), 4)
+        self.assertEqual(upsert.call_count, 1)
+        self.assertEqual(self.writer.failed, 2)
+
+        self.writer.submit(good)
+        with patch('apps.weather.live.upsert_readings', side_effect=OperationalError('gone away')) as upsert, \
+                self.assertLogs('apps.weather.live', 'ERROR'):
+            self.assertEqual(self.writer.drain(), 0)
+        self.assertEqual(upsert.call_count, 1)
+        self.assertEqual(self.writer.failed, 6)
+
+    def test_session_posts_need_a_csrf_token(self):
+        client = Client(enforce_csrf_checks=True)
+        client.force_login(User.objects.create_superuser(username='admin', password='pass'))
+        body = json.dumps(self.reading(0))
+        url = reverse('live_readings')
+        response = client.post(url, body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.json()['error'], 'CSRF verification failed')
+
+        token = get_token(RequestFactory().get('/'))
+        client.cookies['csrftoken'] = token
+        response = client.post(url, body, content_type='application/x-ndjson', HTTP_X_CSRFTOKEN=token)
+        self.assertEqual(response.status_code, 202)
+        # Token callers have no session to forge
+        response = client.post(url, body, content_type='application/x-ndjson',
+                               HTTP_AUTHORIZATION='Bearer station-secret')
+        self.assertEqual(response.status_code, 202)
+
+    def test_large_bodies_are_refused_while_read(self):
+        records = [self.reading(hour) for hour in range(5)]
+        with self.settings(DATA_UPLOAD_MAX_MEMORY_SIZE=300):
+            self.assertEqual(self.post(records).status_code, 413)
+        with patch('apps.weather.api.MAX_LIVE_READINGS', 4):
+            response = self.post(records)
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(response.json()['error'], 'The body holds more than 4 readings')
+        self.assertEqual(self.post(records).status_code, 202)
+
+        # Counting stops at the cap, before the rest of the body is read
+        stream = BytesIO(b'{}\n' * 100)
+        lines = body_lines(stream, max_lines=10, chunk_size=8)
+        with self.assertRaises(RequestDataTooBig):
+            list(lines)
+        self.assertLess(stream.tell(), 50)
+        self.assertEqual(list(body_lines(BytesIO(b'a\n\nb'), max_lines=2)), ['a', '', 'b'])
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        keys = reading_keys(np.arange(1000), np.arange(1000) * 3600 * 10 ** 6)
+        bloom.add(keys)
+        self.assertTrue(bloom.contains(keys).all())
+        others = reading_keys(np.arange(1000, 11000), np.zeros(10000))
+        self.assertLess(bloom.contains(others).mean(), 0.03)
+        # Past its capacity it starts over rather than filling up
+        bloom.add(others[:10])
+        self.assertEqual(len(bloom), 10)
+
+
+@override_settings(WEATHER_LIVE_UPDATES=True, WEATHER_STREAM_BACKEND='memory', WEATHER_STREAM_HEARTBEAT=0.05)
+class ReadingStreamTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.city = City.objects.create(
+            name='London',
+            country='UK',
+            latitude=51.5074,
+            longitude=-0.1278
+        )
+        self.start = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+
+    def tearDown(self):
+        hub().clear()
+
+    def event(self, hour, **fields):
+        return {**reading_event(self.city.pk, self.start + timedelta(hours=hour), 20.5, 60, 1013,
+                                5.2, 'Cloudy'), **fields}
+
+    async def open_stream(self, **headers):
+        request = AsyncRequestFactory().get(reverse('reading_stream'), {'cities': str(self.city.pk)},
+                                            **headers)
+        response = await ReadingStreamView.as_view()(request)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        messages = response.streaming_content
+        self.assertEqual(await anext(messages), b'retry: 3000\n\n')
+        return messages
+
+    async def test_stream_pushes_published_readings(self):
+        messages = await self.open_stream()
+        self.assertEqual(len(hub()), 1)
+        # Idle streams send keep-alive comments
+        self.assertEqual(await anext(messages), b': keep-alive\n\n')
+
+        other = await City.objects.acreate(name='Paris', country='France', latitude=48.8566, longitude=2.3522)
+        hub().dispatch([self.event(1), self.event(2, city=other.pk)])
+        message = (await anext(messages)).decode()
+        self.assertTrue(message.startswith(f'id: {self.event(1)["micros"]}\nevent: readings\ndata: '))
+        events = json.loads(message.split('data: ', 1)[1])
+        self.assertEqual([(event['city'], event['temperature']) for event in events], [(self.city.pk, 20.5)])
+        await messages.aclose()
+
+    async def test_reconnect_replays_missed_readings(self):
+        for hour in range(3):
+            await WeatherData.objects.acreate(
+                city=self.city, temperature=20 + hour, humidity=60, pressure=1013, wind_speed=5.2,
+                description='Cloudy', recorded_at=self.start + timedelta(hours=hour)
+            )
+        messages = await self.open_stream(headers={"Last-Event-ID": str(self.event(0)["micros"])})
+        events = json.loads((await anext(messages)).decode().split('data: ', 1)[1])
+        self.assertEqual([event['temperature'] for event in events], [21.0, 22.0])
+        await messages.aclose()
+
+    def test_saved_and_ingested_readings_are_published(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        subscription = hub().subscribe([self.city.pk], loop=loop)
+        with self.captureOnCommitCallbacks(execute=True):
+            WeatherData.objects.create(
+                city=self.city, temperature=-3.5, humidity=90, pressure=990, wind_speed=12.25,
+                description='Snow', recorded_at=self.start
+            )
+        events = loop.run_until_complete(asyncio.wait_for(subscription.queue.get(), 1))
+        self.assertEqual((events[0]['temperature'], events[0]['description']), (-3.5, 'Snow'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Ingestor().ingest([{
+                'city': 'London', 'country': 'UK', 'recorded_at': '2025-01-02T00:00:00',
+                'temperature': 1, 'humidity': 50, 'pressure': 1000, 'wind_speed': 2, 'description': 'Fog',
+            }])
+        events = loop.run_until_complete(asyncio.wait_for(subscription.queue.get(), 1))
+        self.assertEqual(events[0]['description'], 'Fog')
+
+    def test_only_added_readings_are_published(self):
+        record = {
+            'city': 'London', 'country': 'UK', 'recorded_at': '2025-01-02T00:00:00Z',
+            'temperature': 1, 'humidity': 50, 'pressure': 1000, 'wind_speed': 2, 'description': 'Fog',
+        }
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        hub().subscribe([self.city.pk], loop=loop)
+        published = []
+        with patch.object(MemoryBackend, 'publish', side_effect=published.extend):
+            Ingestor().ingest([record, {**record, 'recorded_at': '2025-01-02T01:00:00Z'}])
+            # A resend rewrites the stored reading; only the new one goes out
+            Ingestor().ingest([{**record, 'temperature': 2}, {**record, 'recorded_at': '2025-01-02T02:00:00Z'}])
+            self.assertEqual([event['micros'] for event in published],
+                             [self.event(hour)['micros'] for hour in (24, 25, 26)])
+
+            # A live writer whose filter never saw them upserts them too
+            writer = LiveWriter()
+            writer.submit([(self.city.pk, self.start + timedelta(days=1), 3, 50, 1000, 2, 'Fog'),
+                           (self.city.pk, self.start + timedelta(days=2), 3, 50, 1000, 2, 'Fog')])
+            self.assertEqual(writer.drain(), 2)
+        self.assertEqual(len(published), 4)
+        self.assertEqual(published[-1]['micros'], self.event(48)['micros'])
+        self.assertEqual(WeatherData.objects.get(recorded_at=self.start + timedelta(days=1)).temperature, 3)
+
+    def test_nothing_is_published_with_live_updates_off(self):
+        with self.settings(WEATHER_LIVE_UPDATES=False, WEATHER_STREAM_BACKEND='postgres'), \
+                patch.object(PostgresBackend, 'publish') as publish:
+            WeatherData.objects.create(
+                city=self.city, temperature=1, humidity=50, pressure=1000, wind_speed=2,
+                description='Fog', recorded_at=self.start
+            )
+            publish_rows([(self.city.pk, self.start + timedelta(hours=1), 1, 50, 1000, 2, 'Fog')])
+            response = self.client.get(reverse('reading_stream'), {'cities': self.city.pk})
+        publish.assert_not_called()
+        self.assertEqual(response.status_code, 404)
+
+    def test_slow_subscribers_are_dropped(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        with self.settings(WEATHER_STREAM_QUEUE_SIZE=2):
+            subscription = hub().subscribe([self.city.pk], loop=loop)
+        for hour in range(3):
+            subscription.offer([self.event(hour)])
+        self.assertTrue(subscription.overflowed)
+        self.assertEqual(subscription.queue.get_nowait(), [self.event(1)])
+        self.assertIsNone(subscription.queue.get_nowait())
+
+    def test_invalid_requests(self):
+        view = async_to_sync(ReadingStreamView.as_view())
+        self.assertEqual(view(AsyncRequestFactory().get('/stream', {'cities': 'x'})).status_code, 400)
+        self.assertEqual(view(AsyncRequestFactory().get('/stream', {'cities': '0'})).status_code, 404)
+        # WSGI workers are not tied up by streams
+        self.assertEqual(self.client.get(reverse('reading_stream'), {'cities': self.city.pk}).status_code, 501)
+
+    @override_settings(WEATHER_PAGE_CACHE_TIMEOUT=0)
+    def test_detail_pages_follow_streams_only_where_they_are_served(self):
+        url = reverse('city_detail', args=[self.city.pk])
+        WeatherData.objects.create(
+            city=self.city, temperature=1, humidity=50, pressure=1000, wind_speed=2,
+            description='Fog', recorded_at=self.start
+        )
+        CityStats.objects.rebuild([self.city.pk])
+        # Under WSGI the stream answers 501, so the page must not open one
+        self.assertNotContains(self.client.get(url), 'EventSource')
+        response = async_to_sync(AsyncClient().get)(url)
+        self.assertContains(response, 'EventSource')
+        with self.settings(WEATHER_LIVE_UPDATES=False):
+            self.assertNotContains(async_to_sync(AsyncClient().get)(url), 'EventSource')
+
+    def test_listener_closes_each_lost_connection(self):
+        class Stop(Exception):
+            pass
+
+        listener = PostgresBackend(hub())
+        with patch('apps.weather.streams.connections') as database, \
+                patch.object(PostgresBackend, '_notifications', side_effect=OSError('lost')), \
+                patch('apps.weather.streams.threading.Event') as event, \
+                self.assertLogs('apps.weather.streams', 'ERROR'):
+            event.return_value.wait.side_effect = [None, Stop]
+            with self.assertRaises(Stop):
+                listener._listen()
+        raw = database.create_connection.return_value.get_new_connection.return_value
+        self.assertEqual(raw.close.call_count, 2)
+
+    def test_notify_payloads_fit_postgres_limit(self):
+        events = [self.event(hour, description='x' * 150) for hour in range(200)]
+        payloads = list(PostgresBackend.payloads(events))
+        self.assertGreater(len(payloads), 1)
+        self.assertTrue(all(len(payload) <= 7000 for payload in payloads))
+        self.assertEqual(sum(len(json.loads(payload)) for payload in payloads), 200)
+
+
+class AnalyticsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        hot_series().clear()
+        self.city = City.objects.create(
+            name='London',
+            country='UK',
+            latitude=51.5074,
+            longitude=-0.1278
+        )
+        self.start = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+        # Ten days of hourly readings with a daily cycle and one heat spike
+        temperatures = 10 + 5 * np.sin(np.arange(240) * 2 * np.pi / 24)
+        temperatures[200] = 40
+        WeatherData.objects.bulk_create([
+            WeatherData(
+                city=self.city, temperature=round(float(temperature), 2), humidity=60 + hour % 3,
+                pressure=1013, wind_speed=5.2, description='Cloudy',
+                recorded_at=self.start + timedelta(hours=hour)
+            )
+            for hour, temperature in enumerate(temperatures)
+        ])
+        CityStats.objects.rebuild([self.city.pk])
+        self.city = City.objects.select_related('weather_stats').get(pk=self.city.pk)
+        self.spike = int((self.start + timedelta(hours=200)).timestamp())
+
+    def test_rolling_stats_match_a_plain_loop(self):
+        rng = np.random.default_rng(7)
+        timestamps = np.cumsum(rng.integers(60, 7200, 500))
+        values = rng.normal(1000, 5, 500)
+        means, stds, counts = rolling_stats(timestamps, values, 6 * 3600)
+        before, _, before_counts = rolling_stats(timestamps, values, 6 * 3600, closed='left')
+        for i in (0, 1, 17, 250, 499):
+            window = values[(timestamps > timestamps[i] - 6 * 3600) & (timestamps <= timestamps[i])]
+            self.assertEqual(counts[i], len(window))
+            self.assertAlmostEqual(means[i], window.mean())
+            if len(window) > 1:
+                self.assertAlmostEqual(stds[i], window.std(ddof=1))
+            earlier = values[(timestamps >= timestamps[i] - 6 * 3600) & (timestamps < timestamps[i])]
+            self.assertEqual(before_counts[i], len(earlier))
+            if len(earlier):
+                self.assertAlmostEqual(before[i], earlier.mean())
+
+    def test_ewma_matches_the_recursion(self):
+        values = np.random.default_rng(3).normal(0, 1, 1000)
+        expected = [values[0]]
+        for value in values[1:]:
+            expected.append(0.3 * value + 0.7 * expected[-1])
+        np.testing.assert_allclose(ewma(values, 0.3, block=64), expected)
+        np.testing.assert_allclose(ewma(values, 1.0), values)
+
+    def test_daily_extremes(self):
+        days, minimums, maximums = daily_extremes([0, 3600, 86400, 90000, 200000], [3, 1, 5, 2, 7])
+        self.assertEqual(days.tolist(), [0, 86400, 172800])
+        self.assertEqual(minimums.tolist(), [1, 2, 7])
+        self.assertEqual(maximums.tolist(), [3, 5, 7])
+
+    def test_spike_is_flagged_by_both_methods(self):
+        with self.assertNumQueries(1):
+            summary = city_analytics(self.city)
+        self.assertEqual(summary['readings'], 240)
+        self.assertEqual(len(summary['daily']['temperature']['days']), 10)
+        self.assertIn(
+            (self.spike, 'temperature', 40.0),
+            [(a['timestamp'], a['metric'], a['value']) for a in summary['anomalies']],
+        )
+        ewma_summary = city_analytics(self.city, method='ewma')
+        self.assertIn(self.spike, [a['timestamp'] for a in ewma_summary['anomalies']])
+
+        # Cached until the city's readings change
+        with self.assertNumQueries(0):
+            city_analytics(self.city)
+        readings_changed.send(sender=WeatherData, city_ids=[self.city.pk])
+        with self.assertNumQueries(1):
+            city_analytics(self.city)
+
+    def test_detail_page_and_api_show_unusual_readings(self):
+        response = self.client.get(reverse('city_detail', args=[self.city.pk]))
+        self.assertContains(response, 'Unusual Readings')
+        self.assertContains(response, '40.00°C')
+
+        url = reverse('city_analytics', args=[self.city.pk])
+        data = self.client.get(url, {'metrics': 'temperature', 'days': 30}).json()
+        self.assertEqual(list(data['daily']), ['temperature'])
+        self.assertEqual(data['anomalies'][0]['metric'], 'temperature')
+        self.assertEqual(self.client.get(url, {'method': 'median'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'window': 0}).status_code, 400)
+
+
+    def test_async_detail_page_fetches_unusual_readings_with_the_rest(self):
+        view = async_to_sync(AsyncCityDetailView.as_view())
+        with self.settings(WEATHER_PAGE_CACHE_TIMEOUT=0):
+            response = view(AsyncRequestFactory().get('/'), pk=self.city.pk)
+            self.assertContains(response, '40.00°C')
+
+            with patch('apps.weather.async_views.city_analytics', side_effect=DatabaseError):
+                response = view(AsyncRequestFactory().get('/'), pk=self.city.pk)
+        self.assertNotContains(response, 'Unusual Readings')
+        self.assertContains(response, 'London')
+
+class CompareTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.london = City.objects.create(name='London', country='UK', latitude=51.5074, longitude=-0.1278)
+        self.paris = City.objects.create(name='Paris', country='France', latitude=48.8566, longitude=2.3522)
+        self.start = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+        self.end = self.start + timedelta(days=2)
+        # London reports every hour, Paris every three hours
+        WeatherData.objects.bulk_create([
+            WeatherData(
+                city=city, temperature=base + hour % 24, humidity=60, pressure=1013,
+                wind_speed=5.2, description='Cloudy', recorded_at=self.start + timedelta(hours=hour)
+            )
+            for city, base, every in ((self.london, 10, 1), (self.paris, 15, 3))
+            for hour in range(0, 48, every)
+        ])
+        CityStats.objects.rebuild([self.london.pk, self.paris.pk])
+        self.query = {'cities': f'{self.london.pk},{self.paris.pk}', 'from': '2025-01-01', 'to': '2025-01-03'}
+
+    def test_align_averages_each_city_onto_one_grid(self):
+        grid, means = align({
+            1: (np.array([0, 10, 70, 250]), np.array([1.0, 3.0, 5.0, 7.0])),
+            2: (np.array([130, 400]), np.array([4.0, 9.0])),
+        }, 0, 240, 60)
+        self.assertEqual(grid.tolist(), [0, 60, 120, 180])
+        np.testing.assert_array_equal(means[1], [2.0, 5.0, np.nan, np.nan])
+        np.testing.assert_array_equal(means[2], [np.nan, np.nan, 4.0, np.nan])
+
+    def test_one_query_for_all_cities_then_cached(self):
+        # The names come from the process-wide city index, built once
+        city_index()
+        with self.assertNumQueries(1):
+            result = compare_cities([self.london.pk, self.paris.pk], self.start, self.end, max_points=48)
+        self.assertEqual(result['step'], 3600)
+        self.assertEqual(len(result['grid']), 48)
+        london, paris = result['cities']
+        self.assertEqual((london['name'], london['count'], london['min'], london['max']),
+                         ('London, UK', 48, 10.0, 33.0))
+        self.assertEqual(paris['count'], 16)
+        self.assertEqual(paris['values'][:4], [15.0, None, None, 18.0])
+
+        with self.assertNumQueries(0):
+            compare_cities([self.london.pk, self.paris.pk], self.start, self.end, max_points=48)
+        readings_changed.send(sender=WeatherData, city_ids=[self.paris.pk])
+        with self.assertNumQueries(1):
+            compare_cities([self.london.pk, self.paris.pk], self.start, self.end, max_points=48)
+
+    def test_json_chart_and_page(self):
+        data = self.client.get(reverse('compare_series'), self.query).json()
+        self.assertEqual([city['id'] for city in data['cities']], [self.london.pk, self.paris.pk])
+        self.assertEqual(self.client.get(reverse('compare_series'), {'cities': self.london.pk}).status_code, 200)
+
+        with patch('apps.weather.compare.submit') as submit:
+            submit.return_value.result.return_value = b'png'
+            response = self.client.get(reverse('compare_chart'), self.query)
+            self.client.get(reverse('compare_chart'), self.query)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(response.content, b'png')
+        self.assertEqual(submit.call_count, 1)
+        self.assertEqual([name for name, _ in submit.call_args.args[2]], ['London, UK', 'Paris, France'])
+
+        response = self.client.get(reverse('compare'), self.query)
+        self.assertContains(response, 'Paris, France')
+        self.assertContains(response, reverse('compare_chart'))
+
+    def test_long_spans_are_read_from_the_rollups(self):
+        build_all()
+        end = self.start + timedelta(days=60)
+        city_index()
+        with self.assertNumQueries(1):
+            rolled = compare_cities([self.london.pk, self.paris.pk], self.start, end, metric='temperature')
+        self.assertEqual((rolled['resolution'], rolled['step']), ('hour', 3 * 60 * 60))
+        cache.clear()
+        with patch('apps.weather.compare.RAW_COMPARE_SPAN', timedelta(days=90)):
+            raw = compare_cities([self.london.pk, self.paris.pk], self.start, end, metric='temperature')
+        self.assertEqual(raw['resolution'], 'raw')
+        # Bucket means weighted by their reading counts give the raw figures
+        for rolled_city, raw_city in zip(rolled['cities'], raw['cities']):
+            self.assertEqual(rolled_city, raw_city)
+
+        # Steps past a day read the daily rollup, past a month the monthly one
+        for days, resolution in ((400, 'day'), (100 * 365, 'month')):
+            result = compare_cities([self.london.pk], self.start, self.start + timedelta(days=days))
+            self.assertEqual((result['resolution'], result['cities'][0]['count']), (resolution, 48))
+
+    def test_dense_short_spans_are_read_from_the_hourly_rollup(self):
+        build_all()
+        city_ids = [self.london.pk, self.paris.pk]
+        # 64 readings between the two cities, over the cap
+        with patch('apps.weather.compare.MAX_RAW_ROWS', 60):
+            result = compare_cities(city_ids, self.start, self.end, max_points=500)
+        self.assertEqual((result['resolution'], result['step']), ('hour', 3600))
+        self.assertEqual([city['count'] for city in result['cities']], [48, 16])
+
+        cache.clear()
+        with patch('apps.weather.compare.MAX_RAW_ROWS', 64):
+            self.assertEqual(compare_cities(city_ids, self.start, self.end)['resolution'], 'raw')
+
+    def test_page_renders_only_the_selected_cities(self):
+        City.objects.create(name='Tokyo', country='Japan', latitude=35.6762, longitude=139.6503)
+        response = self.client.get(reverse('compare'))
+        self.assertNotContains(response, 'Paris')
+        self.assertContains(response, reverse('cities_suggest'))
+        response = self.client.get(reverse('compare'), {'cities': [self.london.pk, self.paris.pk]})
+        self.assertContains(response, f'<input type="hidden" name="cities" value="{self.paris.pk}">', html=True)
+        self.assertNotContains(response, 'Tokyo')
+
+    def test_bad_requests(self):
+        url = reverse('compare_series')
+        self.assertEqual(self.client.get(url).status_code, 400)
+        self.assertEqual(self.client.get(url, {**self.query, 'metric': 'rain'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {**self.query, 'from': '2025-01-03'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'cities': '999999'}).status_code, 404)
+        self.assertEqual(self.client.get(url, {'cities': 'x'}).status_code, 400)
@@ -1,7 +1,32 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import api, async_views, views
+
+if settings.WEATHER_ASYNC_VIEWS:
+    city_list = async_views.AsyncCityListView
+    city_detail = async_views.AsyncCityDetailView
+    city_chart = async_views.AsyncCityChartView
+else:
+    city_list = views.CityListView
+    city_detail = views.CityDetailView
+    city_chart = views.CityChartView
 
 urlpatterns = [
-    path('', views.CityListView.as_view(), name='city_list'),
-    path('city/<int:pk>/', views.CityDetailView.as_view(), name='city_detail'),
+    path('', city_list.as_view(), name='city_list'),
+    path('city/<int:pk>/', city_detail.as_view(), name='city_detail'),
+    path('city/<int:pk>/chart.png', city_chart.as_view(), name='city_chart'),
+    path('city/<int:pk>/series.json', api.CitySeriesView.as_view(), name='city_series'),
+    path('city/<int:pk>/analytics.json', api.CityAnalyticsView.as_view(), name='city_analytics'),
+    path('city/<int:pk>/export.csv', api.CityExportView.as_view(), {'fmt': 'csv'}, name='city_export_csv'),
+    path('city/<int:pk>/export.ndjson', api.CityExportView.as_view(), {'fmt': 'ndjson'},
+         name='city_export_ndjson'),
+    path('compare', views.CompareView.as_view(), name='compare'),
+    path('compare.png', api.CompareChartView.as_view(), name='compare_chart'),
+    path('compare.json', api.CompareSeriesView.as_view(), name='compare_series'),
+    path('api/weather', api.WeatherColumnsView.as_view(), name='weather_columns'),
+    path('api/readings', api.LiveReadingsView.as_view(), name='live_readings'),
+    path('stream', async_views.ReadingStreamView.as_view(), name='reading_stream'),
+    path('cities/nearby', api.CityNearbyView.as_view(), name='cities_nearby'),
+    path('cities/bbox', api.CityBoxView.as_view(), name='cities_bbox'),
+    path('cities/suggest', api.CitySuggestView.as_view(), name='cities_suggest'),
 ]
\ No newline at end of file
@@ -2,10 +2,11 @@ import io
 import base64
 import matplotlib.pyplot as plt
 from matplotlib.dates import DateFormatter
+from apps.common.timing import timed
 
 
-def generate_temperature_chart(weather_data):
-    """Generate a temperature chart using matplotlib"""
+def render_temperature_chart_png(weather_data):
+    """Render a temperature chart using matplotlib and return the PNG bytes"""
     plt.switch_backend('Agg')
     plt.figure(figsize=(10, 4))
     
@@ -27,9 +28,13 @@ def generate_temperature_chart(weather_data):
     # Save plot to a temporary buffer
     buffer = io.BytesIO()
     plt.savefig(buffer, format='png', bbox_inches='tight')
-    buffer.seek(0)
     plt.close()
-    
+    return buffer.getvalue()
+
+
+@timed('chart')
+def generate_temperature_chart(weather_data):
+    """Generate a temperature chart using matplotlib as a base64 data URI"""
     # Encode the image to base64
-    image_base64 = base64.b64encode(buffer.getvalue()).decode()
-    return f"data:image/png;base64,{image_base64}"
\ No newline at end of file
+    image_base64 = base64.b64encode(render_temperature_chart_png(weather_data)).decode()
+    return f"data:image/png;base64,{image_base64}"
@@ -1,14 +1,57 @@
-from django.views.generic import ListView, DetailView
+from django.views.generic import ListView, DetailView, TemplateView
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib import messages
-from django.db.models import Avg
 from django.db import DatabaseError
-from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
-from django.shortcuts import render
-from django.http import Http404
+from django.db.models import Avg
+from django.shortcuts import redirect, render
+from django.urls import reverse
+from django.http import Http404, HttpResponse
+from django.utils.cache import patch_cache_control
+from django.utils.decorators import method_decorator
+from django.utils.functional import SimpleLazyObject
+
+from .analytics import city_analytics, unusual_readings
+from .api import BadRequest, parse_compare
+from .caching import (
+    cache_page_versioned, city_page_version, city_version, conditional_page,
+    list_page_validators, list_page_version, list_version, page_timeout,
+)
+from .charts import (
+    CHART_MAX_AGE, CHART_RANGES, HISTORY_PAGE_SIZE, chart_url, chart_version,
+    get_chart_png, history_page,
+)
+from .compare import compare_cities
+from .hotcache import hot_page_validators, hot_series
+from .managers import METRICS
+from .models import City, CityStats
+from .pagination import decode_cursor
+from .rollups import pick_resolution
+from .streams import streams_served
+
+
+def city_stats(city):
+    """Return the rolled-up averages for a city, or empty ones if it has no readings"""
+    try:
+        return city.weather_stats.as_dict()
+    except CityStats.DoesNotExist:
+        return CityStats().as_dict()
 
-from .models import City
-from .utils import generate_temperature_chart
+
+def stats_aggregates():
+    """The averages of CityStats, as aggregates over a city's readings"""
+    return {
+        'avg_temp': Avg('temperature'),
+        'avg_humidity': Avg('humidity'),
+        'avg_wind_speed': Avg('wind_speed'),
+    }
+
+
+def detail_stats(city):
+    """city_stats(), aggregating the readings directly if the rollup row is missing"""
+    try:
+        return city.weather_stats.as_dict()
+    except CityStats.DoesNotExist:
+        return city.weather_data.aggregate(**stats_aggregates())
 
 
 def custom_404(request, exception):
@@ -21,70 +64,62 @@ def custom_500(request):
     return render(request, 'errors/500.html', status=500)
 
 
+@method_decorator(conditional_page(list_page_validators), name='dispatch')
+@method_decorator(cache_page_versioned(list_page_version), name='dispatch')
 class CityListView(ListView):
     """View to list all cities with their weather data"""
     model = City
     template_name = 'weather/city_list.html'
     context_object_name = 'cities'
-    
+
+    def get_queryset(self):
+        return super().get_queryset().select_related('weather_stats')
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        context['cache_version'] = list_version()
+        context['cache_timeout'] = page_timeout()
         try:
-            # Add average weather stats for each city
+            # Averages come from the CityStats rollup joined onto each city
             cities_with_stats = []
-            hottest_city = None
-            coldest_city = None
-            most_humid_city = None
-            windiest_city = None
-            max_temp = float('-inf')
-            min_temp = float('inf')
-            max_humidity = float('-inf')
-            max_wind = float('-inf')
-
             for city in context['cities']:
-                stats = city.weather_data.aggregate(
-                    avg_temp=Avg('temperature'),
-                    avg_humidity=Avg('humidity'),
-                    avg_wind_speed=Avg('wind_speed')
-                )
-                city.stats = stats
+                city.stats = city_stats(city)
                 cities_with_stats.append(city)
-                
-                # Track extreme values
-                if stats['avg_temp'] is not None:
-                    if stats['avg_temp'] > max_temp:
-                        max_temp = stats['avg_temp']
-                        hottest_city = city
-                    if stats['avg_temp'] < min_temp:
-                        min_temp = stats['avg_temp']
-                        coldest_city = city
-                
-                if stats['avg_humidity'] is not None and stats['avg_humidity'] > max_humidity:
-                    max_humidity = stats['avg_humidity']
-                    most_humid_city = city
-                    
-                if stats['avg_wind_speed'] is not None and stats['avg_wind_speed'] > max_wind:
-                    max_wind = stats['avg_wind_speed']
-                    windiest_city = city
 
+            # One indexed query picks the extremes; map them back onto the
+            # city objects so the cards can show their stats. It only runs
+            # when the cached summary fragment has to be rendered again.
+            cities_by_id = {city.id: city for city in cities_with_stats}
             context['cities'] = cities_with_stats
-            context['weather_summary'] = {
-                'hottest_city': hottest_city,
-                'coldest_city': coldest_city,
-                'most_humid_city': most_humid_city,
-                'windiest_city': windiest_city
-            }
+            context['weather_summary'] = SimpleLazyObject(lambda: {
+                label: cities_by_id.get(city_id)
+                for label, city_id in CityStats.objects.extremes().items()
+            })
         except DatabaseError as e:
             messages.error(self.request, f"Database error while calculating statistics: {str(e)}")
         return context
 
 
-class CityDetailView(DetailView):
+class HotCityMixin:
+    """Take the city and its stats row from the hot series cache when it is enabled"""
+    def get_object(self, queryset=None):
+        series = hot_series().get(self.kwargs[self.pk_url_kwarg])
+        if series is None:
+            return super().get_object(queryset)
+        return series.city
+
+
+@method_decorator(conditional_page(hot_page_validators), name='dispatch')
+@method_decorator(cache_page_versioned(city_page_version), name='dispatch')
+class CityDetailView(HotCityMixin, DetailView):
     """View to display detailed information about a specific city and its weather data"""
     model = City
     template_name = 'weather/city_detail.html'
     context_object_name = 'city'
-    paginate_by = 10  # Number of records per page
+    paginate_by = HISTORY_PAGE_SIZE  # Number of records per page
+
+    def get_queryset(self):
+        return super().get_queryset().select_related('weather_stats')
 
     def get_object(self, queryset=None):
         try:
@@ -94,33 +129,88 @@ class CityDetailView(DetailView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        context['cache_version'] = city_version(self.object.pk)
+        context['cache_timeout'] = page_timeout()
         try:
-            # Get the weather data with pagination
-            page = self.request.GET.get('page', 1)
-            weather_data_list = self.object.weather_data.order_by('-recorded_at')
-            paginator = Paginator(weather_data_list, self.paginate_by)
-            
-            try:
-                weather_data = paginator.page(page)
-            except PageNotAnInteger:
-                weather_data = paginator.page(1)
-            except EmptyPage:
-                weather_data = paginator.page(paginator.num_pages)
-            
+            # Get the weather data with keyset pagination
+            cursor = self.request.GET.get('cursor')
+            weather_data = history_page(self.object, cursor)
             context['weather_data'] = weather_data
             
-            # Calculate averages
-            stats = self.object.weather_data.aggregate(
-                avg_temp=Avg('temperature'),
-                avg_humidity=Avg('humidity'),
-                avg_wind_speed=Avg('wind_speed')
+            # Averages are maintained in the CityStats rollup
+            context['stats'] = detail_stats(self.object)
+            context['unusual_readings'] = SimpleLazyObject(
+                lambda: unusual_readings(city_analytics(self.object))
             )
-            context['stats'] = stats
 
-            # Generate temperature chart
-            context['temperature_chart'] = generate_temperature_chart(weather_data.object_list[:10])
+            # The chart is served from its own cacheable URL, either for this
+            # page or for a longer range read from the rollups
+            chart_range = self.request.GET.get('range')
+            stats = getattr(self.object, 'weather_stats', None)
+            if chart_range in CHART_RANGES and stats is not None and stats.last_recorded_at:
+                end = stats.last_recorded_at
+                context['chart_range'] = chart_range
+                context['chart_resolution'] = pick_resolution(end - CHART_RANGES[chart_range], end).name
+                context['temperature_chart'] = chart_url(self.object, chart_range=chart_range)
+            else:
+                context['temperature_chart'] = chart_url(self.object, cursor=cursor)
+            context['chart_ranges'] = list(CHART_RANGES)
+            # Newest pages follow new readings over the reading stream, where one is served
+            context['live_updates'] = streams_served(self.request) and not cursor
         except ObjectDoesNotExist:
             pass 
         except DatabaseError:
             pass  
         return context
+
+
+# The view sets its own long-lived headers on versioned URLs
+@method_decorator(conditional_page(hot_page_validators, cache_control=False), name='dispatch')
+class CityChartView(HotCityMixin, DetailView):
+    """Serve a city's temperature chart as a PNG with long-lived cache headers"""
+    model = City
+
+    def get_queryset(self):
+        return super().get_queryset().select_related('weather_stats')
+
+    def get(self, request, *args, **kwargs):
+        city = self.get_object()
+        chart_range = request.GET.get('range')
+        if chart_range not in CHART_RANGES:
+            chart_range = None
+        cursor = request.GET.get('cursor')
+        if decode_cursor(cursor) is None:
+            cursor = None
+
+        # Stale or missing versions are sent to the current URL, so the
+        # versioned one can be cached as immutable
+        if request.GET.get('v') != chart_version(city):
+            return redirect(chart_url(city, cursor=cursor, chart_range=chart_range))
+
+        response = HttpResponse(get_chart_png(city, cursor, chart_range), content_type='image/png')
+        patch_cache_control(response, public=True, max_age=CHART_MAX_AGE, immutable=True)
+        return response
+
+
+class CompareView(TemplateView):
+    """
+    Compare several cities in one chart, with a summary of each city's
+    readings. Cities are picked from /cities/suggest as you type; only the
+    selected ones are rendered.
+    """
+    template_name = 'weather/compare.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['metrics'] = METRICS
+        if self.request.GET.get('cities'):
+            try:
+                query = parse_compare(self.request)
+            except BadRequest as e:
+                messages.error(self.request, str(e))
+                return context
+            # One query for every city's readings; the chart reuses it from the cache
+            context['comparison'] = compare_cities(**query)
+            context['chart_url'] = f"{reverse('compare_chart')}?{self.request.GET.urlencode()}"
+            context['json_url'] = f"{reverse('compare_series')}?{self.request.GET.urlencode()}"
+        return context
@@ -11,5 +11,15 @@ python manage.py collectstatic --no-input
 # Apply database migrations
 python manage.py migrate
 
+# The shared cache table (CACHE_URL=dbcache://weather_cache)
+python manage.py createcachetable
+
 #Load initial weather data
 python manage.py load_weather_data --records-per-city 500
+
+
+# Refresh the hourly/daily/monthly rollups
+python manage.py build_weather_rollups
+
+# Fold readings past their retention into the rollups and delete them
+python manage.py compact_weather
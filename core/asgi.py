@@ -11,6 +11,12 @@ import os
 
 from django.core.asgi import get_asgi_application
 
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings.production')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# The hot series cache (apps.weather.hotcache) is filled before the first
+# request, never while this module is imported
+from apps.weather.hotcache import warm_on_startup  # noqa: E402
+
+application = warm_on_startup(django_application)
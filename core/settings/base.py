@@ -48,6 +48,7 @@ THIRD_PARTY_APPS = []
 INSTALLED_APPS = DJANGO_APPS + CUSTOM_APPS + THIRD_PARTY_APPS
 
 MIDDLEWARE = [
+    "apps.common.middleware.ServerTimingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     'whitenoise.middleware.WhiteNoiseMiddleware',
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -133,3 +134,77 @@ MEDIA_ROOT = BASE_DIR / "media"
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 AUTH_USER_MODEL = "users.User"
+
+# Weather app
+# Worker processes used to render charts; 0 renders in the request thread
+WEATHER_CHART_WORKERS = env.int("WEATHER_CHART_WORKERS", default=0)
+# Route the city pages to the async views (apps.weather.async_views); only
+# worth it when serving through core.asgi
+WEATHER_ASYNC_VIEWS = env.bool("WEATHER_ASYNC_VIEWS", default=False)
+
+# Newest readings kept in memory per city for the detail pages (0 disables
+# the hot series cache), how many cities each process holds, and how many
+# of the most recently updated ones it loads when it starts
+WEATHER_HOT_READINGS = env.int("WEATHER_HOT_READINGS", default=240)
+WEATHER_HOT_CITIES = env.int("WEATHER_HOT_CITIES", default=1000)
+WEATHER_HOT_WARM_CITIES = env.int("WEATHER_HOT_WARM_CITIES", default=100)
+
+# Live readings posted to /api/readings: the bearer tokens station feeds
+# authenticate with, how many readings the background writer upserts at
+# once, how often it writes a partial batch, how many may wait before
+# feeds get a 503, and how many recent reading keys each process remembers
+# to skip resends (setting WEATHER_LIVE_WRITER_THREAD off leaves writing to
+# live_writer().drain())
+WEATHER_INGEST_TOKENS = env.list("WEATHER_INGEST_TOKENS", default=[])
+WEATHER_LIVE_BATCH_SIZE = env.int("WEATHER_LIVE_BATCH_SIZE", default=10000)
+WEATHER_LIVE_FLUSH_SECONDS = env.float("WEATHER_LIVE_FLUSH_SECONDS", default=1.0)
+WEATHER_LIVE_MAX_PENDING = env.int("WEATHER_LIVE_MAX_PENDING", default=200000)
+WEATHER_LIVE_FILTER_CAPACITY = env.int("WEATHER_LIVE_FILTER_CAPACITY", default=1000000)
+WEATHER_LIVE_WRITER_THREAD = env.bool("WEATHER_LIVE_WRITER_THREAD", default=True)
+
+# Server-Sent Events of new readings (/stream, served under core.asgi):
+# whether the detail pages subscribe to them, the pub/sub backend ("memory"
+# or "postgres", by default the one matching the database), how many
+# unsent messages a stream may fall behind before it is dropped, and the
+# seconds between keep-alive comments
+WEATHER_LIVE_UPDATES = env.bool("WEATHER_LIVE_UPDATES", default=False)
+WEATHER_STREAM_BACKEND = env.str("WEATHER_STREAM_BACKEND", default="") or None
+WEATHER_STREAM_QUEUE_SIZE = env.int("WEATHER_STREAM_QUEUE_SIZE", default=100)
+WEATHER_STREAM_HEARTBEAT = env.float("WEATHER_STREAM_HEARTBEAT", default=15.0)
+
+# Days each level of readings is kept by compact_weather before it is folded
+# into the next coarser rollup and deleted; None keeps it forever
+WEATHER_RETENTION = {
+    "raw": env.int("WEATHER_RETAIN_RAW_DAYS", default=30),
+    "hour": env.int("WEATHER_RETAIN_HOURLY_DAYS", default=365),
+    "day": None,
+    "month": None,
+}
+
+# Caching
+# locmemcache:// (default), filecache:///var/tmp/django_cache, dbcache://weather_cache
+# or redis://host:6379/1. Page versions are bumped in the cache, so run more
+# than one process only with a shared backend; locmem is per process, and
+# the production settings refuse it.
+CACHES = {
+    "default": env.cache("CACHE_URL", default="locmemcache://"),
+}
+# Cached pages are versioned per city, so this only bounds how long unused ones linger
+WEATHER_PAGE_CACHE_TIMEOUT = env.int("WEATHER_PAGE_CACHE_TIMEOUT", default=60 * 60)
+# How long browsers, proxies and CDNs may reuse a page before revalidating it
+WEATHER_HTTP_MAX_AGE = env.int("WEATHER_HTTP_MAX_AGE", default=60)
+
+# Performance instrumentation
+# Fraction of requests that get a Server-Timing header and a timing log line
+SERVER_TIMING_SAMPLE_RATE = env.float("SERVER_TIMING_SAMPLE_RATE", default=0.1)
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {
+        "console": {"class": "logging.StreamHandler"},
+    },
+    "loggers": {
+        "apps.common.middleware": {"handlers": ["console"], "level": "INFO", "propagate": False},
+    },
+}
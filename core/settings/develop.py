@@ -1,4 +1,5 @@
 from .base import *
+from .base import env
 
 DEBUG  = True  
 
@@ -11,3 +12,6 @@ DATABASES = {
         "NAME": BASE_DIR / "db.sqlite3",
     }
 }
+
+# Time every request while developing
+SERVER_TIMING_SAMPLE_RATE = env.float("SERVER_TIMING_SAMPLE_RATE", default=1.0)
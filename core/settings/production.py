@@ -1,6 +1,7 @@
 from .base import *  # noqa
 import os
 import dj_database_url
+from django.core.exceptions import ImproperlyConfigured
 
 ###################################################################
 # General
@@ -63,6 +64,18 @@ else:
         }
     }
 
+###################################################################
+# Cache
+###################################################################
+
+# Page versions, ETags and chart URLs are bumped in the cache, so every
+# worker must share it: a per-process cache would keep serving stale pages
+# from the workers that did not see the write
+if "CACHE_URL" not in os.environ:
+    raise ImproperlyConfigured("Set CACHE_URL to a shared cache (redis:// or dbcache://) in production")
+if CACHES["default"]["BACKEND"] == "django.core.cache.backends.locmem.LocMemCache":
+    raise ImproperlyConfigured("CACHE_URL must name a cache shared by all workers, not locmemcache://")
+
 ###################################################################
 # CORS
 ###################################################################
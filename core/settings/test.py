@@ -0,0 +1,4 @@
+from .develop import *  # noqa
+
+# Keep the test output readable; the middleware tests turn timing on themselves
+SERVER_TIMING_SAMPLE_RATE = 0
@@ -13,4 +13,10 @@ from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "core.settings.production")
 
-application = get_wsgi_application()
+django_application = get_wsgi_application()
+
+# The hot series cache (apps.weather.hotcache) is filled before the first
+# request, never while this module is imported
+from apps.weather.hotcache import warm_on_first_request  # noqa: E402
+
+application = warm_on_first_request(django_application)